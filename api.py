@@ -19,15 +19,69 @@ for now just return python objects. The transformation to JSON should
 be pretty straightforward.
 """
 import re
+import json
+import time
+import base64
+import random
 import logging
+import datetime
 from google.appengine.ext import db
 from google.appengine.api import users
-from model import Domain, Task, TaskIndex, Context, User
+from google.appengine.api import memcache
+from model import Domain, DomainShard, Task, TaskIndex, Context, User
+from model import DirtyTask, PropagationState, TaskTreeSnapshot
+from model import AssigneeNames, Inbox, DomainStatistics, ProgressSeries
+from model import TaskLogPage, TaskSearchTerms
+from model import MAX_SHARDS, prefetch_references_async
+import caching
+import search
 import workers
 
 # Regexp for all valid domain identifiers
 VALID_DOMAIN_IDENTIFIER = r'[a-z][a-z0-9-]{1,100}'
 
+# Maximum number of tasks in a single import.
+MAX_IMPORT_TASKS = 10000
+# Number of entities that are stored in a single batch put during
+# an import.
+IMPORT_BATCH_SIZE = 500
+# Maximum number of tasks returned by get_subtree().
+MAX_SUBTREE_TASKS = 2000
+# Maximum number of matching tasks returned by search_tasks().
+MAX_SEARCH_RESULTS = 100
+# Maximum number of decoded task tree snapshots that are kept in the
+# memory of an instance, see get_task_tree().
+TASK_TREE_CACHE_SIZE = 20
+
+# Decoded task tree snapshots, keyed by the tuple of the group keys of
+# a domain. Each value is a pair of the snapshot revisions of the
+# groups and the (merged) snapshot.
+_task_trees = {}
+
+
+class Future(object):
+    """
+    The result of an asynchronous api call, such as get_task_async().
+    The result is computed from the results of zero or more datastore
+    or memcache futures, when get_result() is called.
+    """
+    def __init__(self, function, *futures):
+        self._function = function
+        self._futures = futures
+        self._done = False
+        self._result = None
+
+    def get_result(self):
+        """
+        Waits for the futures this future depends on, and returns the
+        result of the call.
+        """
+        if not self._done:
+            self._result = self._function(*[future.get_result()
+                                            for future in self._futures])
+            self._done = True
+            self._futures = None
+        return self._result
 
 
 def member_of_domain(domain, user, *args):
@@ -80,28 +134,57 @@ def get_logged_in_user():
         An instance of the User model, or None if the user is not
         logged in.
     """
-    guser = users.get_current_user()
-    if not guser:
-        return None
-    user = User.get_by_key_name(guser.user_id())
-    if not user:
-        user = User(key_name=guser.user_id(), name=guser.nickname())
-        user.put()
-    return user
+    return get_logged_in_user_async().get_result()
 
 
-def get_user(user_identifier):
+def get_logged_in_user_async():
+    """
+    Asynchronous version of get_logged_in_user().
+
+    Returns:
+        A Future instance of which the result is an instance of the
+        User model, or None if the user is not logged in.
+    """
+    guser = users.get_current_user()
+    if not guser:
+        return Future(lambda: None)
+    def user_or_new_user(user):
+        if not user:
+            user = User(key_name=guser.user_id(), name=guser.nickname())
+            caching.put(user)
+        return user
+    return Future(user_or_new_user,
+                  caching.get_async(db.Key.from_path('User',
+                                                     guser.user_id())))
+
+
+def get_user(user_identifier, use_cache=True):
     """
     Returns the user corresponding to the given identifier.
 
     Args:
-        The user identifier string
+        user_identifier: The user identifier string
+        use_cache: If set to False, the user is always fetched from
+            the datastore.
 
     Returns:
         An instance of the User model, or None if no user exists
         with that identifier.
     """
-    return User.get_by_key_name(user_identifier)
+    return caching.get(db.Key.from_path('User', user_identifier),
+                       use_cache=use_cache)
+
+
+def get_user_async(user_identifier, use_cache=True):
+    """
+    Asynchronous version of get_user().
+
+    Returns:
+        A future of which the result is an instance of the User
+        model, or None.
+    """
+    return caching.get_async(db.Key.from_path('User', user_identifier),
+                             use_cache=use_cache)
 
 
 def get_and_validate_user(domain_identifier):
@@ -118,24 +201,93 @@ def get_and_validate_user(domain_identifier):
         An instance of the User model, or None if the user
         is not logged in or not a member of the domain.
     """
-    user = get_logged_in_user()
-    if not user or not member_of_domain(domain_identifier, user):
-        return None
-    return user
+    return get_and_validate_user_async(domain_identifier).get_result()
 
 
-def get_domain(domain_identifier):
+def get_and_validate_user_async(domain_identifier):
+    """
+    Asynchronous version of get_and_validate_user().
+
+    Returns:
+        A Future instance of which the result is an instance of the
+        User model, or None.
+    """
+    def validate(user):
+        if not user or not member_of_domain(domain_identifier, user):
+            return None
+        return user
+    return Future(validate, get_logged_in_user_async())
+
+
+def get_domain(domain_identifier, use_cache=True):
     """
     Returns the Domain model instance corresponding to the identifier.
 
     Args:
         domain_identifier: The domain identifier string
+        use_cache: If set to False, the domain is always fetched from
+            the datastore.
 
     Returns:
         An instance of the Domain model, or None if no domain exist
         with the given identifier.
     """
-    return Domain.get_by_key_name(domain_identifier)
+    return caching.get(Domain.key_from_name(domain_identifier),
+                       use_cache=use_cache)
+
+
+def get_domain_async(domain_identifier, use_cache=True):
+    """
+    Asynchronous version of get_domain().
+
+    Returns:
+        A future of which the result is an instance of the Domain
+        model, or None.
+    """
+    return caching.get_async(Domain.key_from_name(domain_identifier),
+                             use_cache=use_cache)
+
+
+def _modification_counter_key(domain_identifier):
+    return 'modified:%s' % domain_identifier
+
+
+def get_modification_counter(domain_identifier):
+    """
+    Returns the modification counter of a domain, which is increased
+    after every change to the tasks of the domain, by the api and by
+    the workers. The counter is kept in memcache. If it is missing,
+    it is restarted from the current time in microseconds, so a value
+    is never repeated.
+
+    The counter must be read before the data that depends on it, and
+    increased after the change is committed.
+
+    Args:
+        domain_identifier: The domain identifier string
+
+    Returns:
+        An integer, or None if memcache is not available.
+    """
+    key = _modification_counter_key(domain_identifier)
+    counter = memcache.get(key)
+    if counter is None:
+        memcache.add(key, int(time.time() * 10**6))
+        counter = memcache.get(key)
+    return counter
+
+
+def increment_modification_counter(domain_identifier):
+    """
+    Increases the modification counter of a domain, see
+    get_modification_counter(). Must be called after the change is
+    committed.
+
+    Args:
+        domain_identifier: The domain identifier string
+    """
+    memcache.incr(_modification_counter_key(domain_identifier),
+                  initial_value=int(time.time() * 10**6))
 
 
 def get_all_domains_for_user(user):
@@ -151,17 +303,173 @@ def get_all_domains_for_user(user):
     """
     keys = [db.Key.from_path('Domain', domain)
             for domain in user.domains]
-    return Domain.get(keys)
+    return caching.get(keys)
+
+
+def get_domain_statistics(domains):
+    """
+    Returns the statistics of all the tasks in each of the domains.
+    The counter shards of all domains are fetched in a single batch
+    get, and summed per domain.
+
+    Args:
+        domains: A list of Domain model instances
+
+    Returns:
+        A list with a dictionary for each domain, with the fields
+        total, atomic, completed and open, and the dictionary of
+        assignee records assignees, as in DomainStatistics.
+    """
+    group_keys = [domain.group_keys() for domain in domains]
+    shards = caching.get([DomainStatistics.key_from_group_key(group_key)
+                          for keys in group_keys
+                          for group_key in keys])
+    results = []
+    position = 0
+    for keys in group_keys:
+        total = DomainStatistics()
+        for shard in shards[position:position + len(keys)]:
+            if shard:
+                workers.add_statistics(total, {
+                        'total': shard.total,
+                        'atomic': shard.atomic,
+                        'completed': shard.completed,
+                        'open': shard.open,
+                        'assignees': shard.assignees })
+        position += len(keys)
+        results.append({ 'total': total.total,
+                         'atomic': total.atomic,
+                         'completed': total.completed,
+                         'open': total.open,
+                         'assignees': total.assignees })
+    return results
+
+
+def get_progress_samples(domain, root_task=None):
+    """
+    Returns the hourly progress samples of a root task, or of all the
+    tasks of a domain. The samples of the entity groups of a domain
+    are merged: at the hour of each sample, the last known counts of
+    all groups are summed.
+
+    Args:
+        domain: A Domain model instance
+        root_task: Optional instance of the Task model of a root task.
+
+    Returns:
+        A list of (hour, completed, atomic) tuples ordered by hour,
+        with the hour in hours since the epoch, and the number of
+        completed atomic tasks and of all atomic tasks.
+    """
+    if root_task:
+        series = caching.get(ProgressSeries.key_from_parent_key(
+                root_task.key()))
+        return series.samples() if series else []
+    series = [series for series in caching.get(
+            [ProgressSeries.key_from_parent_key(group_key)
+             for group_key in domain.group_keys()])
+              if series]
+    if len(series) == 1:
+        return series[0].samples()
+    hours = sorted(set(hour for samples in series
+                       for hour in samples.hours))
+    positions = [0] * len(series)
+    counts = [(0, 0)] * len(series)
+    results = []
+    for hour in hours:
+        for index, samples in enumerate(series):
+            while (positions[index] < len(samples.hours) and
+                   samples.hours[positions[index]] <= hour):
+                counts[index] = (samples.completed[positions[index]],
+                                 samples.atomic[positions[index]])
+                positions[index] += 1
+        results.append((hour,
+                        sum(completed for completed, atomic in counts),
+                        sum(atomic for completed, atomic in counts)))
+    return results
+
+
+def get_inbox(user):
+    """
+    Returns the uncompleted atomic tasks that are assigned to the
+    user, in all domains, from the inbox of the user with a single
+    get. The inbox is maintained by a worker, so recent changes may
+    not be included yet.
+
+    Args:
+        user: An instance of the User model
+
+    Returns:
+        A tuple with a list of task records and a boolean that is
+        True if the list is incomplete. The records are grouped by
+        domain, see Inbox.tasks for the fields.
+    """
+    inbox = caching.get(Inbox.key_from_user_identifier(user.identifier()))
+    if not inbox:
+        return [], False
+    domains = set(user.domains)
+    return ([record for record in inbox.tasks
+             if record['domain'] in domains],
+            inbox.truncated)
+
+
+def get_group_keys(domain_identifier):
+    """
+    Returns the root keys of all the entity groups in which the tasks
+    of a domain are stored.
+
+    Args:
+        domain_identifier: The domain identifier string
+
+    Returns:
+        A list of db.Key instances of the Domain and its DomainShards.
+    """
+    domain = get_domain(domain_identifier)
+    if not domain:
+        return [Domain.key_from_name(domain_identifier)]
+    return domain.group_keys()
+
+
+def _new_root_task_group_key(domain_identifier):
+    """
+    Returns the root key of the entity group in which a new root task
+    of the domain is stored. In a sharded domain, the shard is picked
+    at random.
+    """
+    domain = get_domain(domain_identifier)
+    if not domain or not domain.shard_count:
+        return Domain.key_from_name(domain_identifier)
+    return DomainShard.key_from_shard(domain_identifier,
+                                      random.randrange(domain.shard_count))
+
+
+def _task_group_keys(domain_identifier, root_task=None, group_key=None):
+    """
+    Returns the root keys of the entity groups of the domain that can
+    contain subtasks of |root_task|. If a |root_task| is provided,
+    this is only the entity group of that task. Otherwise, if a
+    |group_key| is provided, this is only that entity group.
+    """
+    if root_task:
+        return [root_task.group_key()]
+    if group_key:
+        return [group_key]
+    return get_group_keys(domain_identifier)
 
 
-def get_task(domain_identifier, task_identifier):
+def get_task(domain_identifier, task_identifier, use_cache=True):
     """Gets a task in a domain.
 
+    The task is read from memcache if possible, unless this function
+    is called inside a transaction.
+
     Args:
         domain: The domain identifier
         task: The task identifier, as an int or string.
            This argument can also be None, in which
            case None will be returned.
+        use_cache: If set to False, the task is always fetched from
+           the datastore.
 
     Returns:
         A task instance or None if no task exists. If
@@ -171,12 +479,156 @@ def get_task(domain_identifier, task_identifier):
     if not task_identifier:
         return None
 
-    domain_key = Domain.key_from_name(domain_identifier)
-    try:
-        task_id = int(task_identifier)
-        return Task.get_by_id(task_id, parent=domain_key)
-    except ValueError:
-        return Task.get_by_key_name(task_identifier, parent=domain_key)
+    return caching.get(Task.key_from_identifier(domain_identifier,
+                                                task_identifier),
+                       use_cache=use_cache)
+
+
+def get_task_async(domain_identifier, task_identifier, use_cache=True):
+    """
+    Asynchronous version of get_task().
+
+    Returns:
+        A future of which the result is a task instance or None.
+    """
+    if not task_identifier:
+        return Future(lambda: None)
+    return caching.get_async(Task.key_from_identifier(domain_identifier,
+                                                      task_identifier),
+                             use_cache=use_cache)
+
+
+def get_assignee_names(domain_identifier, tasks=[]):
+    """
+    Returns the names of the assignees of the tasks in a domain, as
+    stored in its AssigneeNames table. The table is read from memcache
+    if possible.
+
+    Assignees of |tasks| that are missing from the table, such as the
+    assignees of tasks that were assigned before the table existed,
+    are looked up. The assignees of Task instances are resolved on the
+    tasks themselves, see prefetch_references(), in the same batch as
+    the other missing assignees. They are not added to the table,
+    which is only changed when tasks are assigned, see
+    register_assignee_names().
+
+    Args:
+        domain_identifier: The domain identifier string
+        tasks: A list of Task or TaskTreeNode instances of the domain,
+            whose assignees must be included.
+
+    Returns:
+        A dictionary of user names, keyed by user identifier.
+    """
+    table = caching.get(
+        AssigneeNames.key_from_domain_identifier(domain_identifier))
+    names = dict(table.names) if table else {}
+    missing = set()
+    for task in tasks:
+        if task:
+            missing.update(id for id in task.derived_assignees
+                           if not id in names)
+    if missing:
+        rows = [task for task in tasks
+                if isinstance(task, Task) and
+                task.assignee_identifier() in missing]
+        future = prefetch_references_async(rows, 'assignee')
+        others = missing - set(task.assignee_identifier() for task in rows)
+        users = caching.get([db.Key.from_path('User', identifier)
+                             for identifier in others])
+        users = [user for user in users + future.get_result().values()
+                 if user]
+        names.update((user.identifier(), user.name) for user in users)
+    return names
+
+
+def register_assignee_names(domain_identifier, users):
+    """
+    Stores the names of |users| in the AssigneeNames table of the
+    domain, if they are not up to date yet. Called before tasks are
+    assigned to the users.
+
+    Args:
+        domain_identifier: The domain identifier string
+        users: A list of User model instances
+    """
+    key = AssigneeNames.key_from_domain_identifier(domain_identifier)
+    table = caching.get(key)
+    if table and all(table.names.get(user.identifier()) == user.name
+                     for user in users):
+        return
+
+    def txn():
+        table = AssigneeNames.get(key)
+        if not table:
+            table = AssigneeNames(key=key)
+        names = dict(table.names)
+        names.update((user.identifier(), user.name) for user in users)
+        if names == table.names:
+            return
+        table.names = names
+        table.revision += 1
+        caching.put(table)
+    db.run_in_transaction(txn)
+
+
+def get_assignee_names_revision(domain_identifier):
+    """
+    Returns the revision of the AssigneeNames table of a domain, which
+    changes whenever the name of an assignee changes. The table is read
+    from memcache if possible.
+    """
+    table = caching.get(
+        AssigneeNames.key_from_domain_identifier(domain_identifier))
+    return table.revision if table else 0
+
+
+def get_ancestors(task, index=None):
+    """Gets all the ancestor tasks of a task.
+
+    The ancestors are fetched with a single batch get, using the
+    hierarchy that is stored in the TaskIndex of the task. If the
+    index is missing or not up to date, the hierarchy is traversed
+    upwards one task at a time instead. This function should be run
+    in a transaction to get consistent results.
+
+    Args:
+        task: An instance of the Task model
+        index: Optional TaskIndex instance of |task|. If not provided,
+            the index will be fetched.
+
+    Returns:
+        A list of Task model instances, ordered from the root task
+        down to the parent task of |task|. The list is empty if
+        |task| is a root task.
+    """
+    if not task.parent_task_key():
+        return []
+    if not index:
+        index = caching.get(TaskIndex.key_from_task_key(task.key()))
+    if index and index.hierarchy:
+        domain_identifier = task.domain_identifier()
+        keys = [Task.key_from_identifier(domain_identifier, identifier)
+                for identifier in index.hierarchy]
+        ancestors = caching.get(keys)
+        # The chain is only valid if every task is the parent of the
+        # next one in the list.
+        parent_key = None
+        for ancestor in ancestors:
+            if not ancestor or ancestor.parent_task_key() != parent_key:
+                break
+            parent_key = ancestor.key()
+        else:
+            if parent_key == task.parent_task_key():
+                return ancestors
+    ancestors = []
+    parent = caching.get(task.parent_task_key())
+    while parent:
+        ancestors.append(parent)
+        parent_key = parent.parent_task_key()
+        parent = caching.get(parent_key) if parent_key else None
+    ancestors.reverse()
+    return ancestors
 
 
 def can_complete_task(task, user):
@@ -317,31 +769,320 @@ def create_task(domain_identifier,
     if assignee and not member_of_domain(domain_identifier, user, assignee):
         raise ValueError("Assignee and user domain do not match")
 
+    # Subtasks are always stored in the entity group of their parent.
+    if parent_task_identifier:
+        group_key = Task.key_from_identifier(domain_identifier,
+                                             parent_task_identifier).parent()
+    else:
+        group_key = _new_root_task_group_key(domain_identifier)
+    if DomainShard.shard_from_key(group_key) is None:
+        key_args = { 'parent': group_key }
+    else:
+        key_args = { 'key': Task.allocate_keys(group_key, 1)[0] }
+
     def txn():
-        task = Task(parent=Domain.key_from_name(domain_identifier),
-                    description=description,
+        task = Task(description=description,
                     user=user,
-                    context=user.default_context_key())
+                    context=user.default_context_key(),
+                    **key_args)
         parent_task = get_task(domain_identifier, parent_task_identifier)
         if parent_task_identifier and not parent_task:
             raise ValueError("Parent task '%s' does not exist" %
                              parent_task_identifier)
         task.parent_task = parent_task
-        task.put()
+        caching.put(task)
         workers.UpdateTaskCompletion.enqueue(domain_identifier,
                                              task.identifier(),
                                              transactional=True)
         workers.UpdateTaskHierarchy.enqueue(domain_identifier,
                                             task.identifier(),
                                             transactional=True)
+        workers.UpdateSearchIndex.enqueue(domain_identifier,
+                                          [task.identifier()],
+                                          transactional=True)
         return task
 
     task = db.run_in_transaction(txn)
+    increment_modification_counter(domain_identifier)
     if assignee:
         assign_task(domain_identifier, task.identifier(), user, user)
     return task
 
 
+def parse_task_outline(outline):
+    """
+    Parses an indented outline into a task tree for import_tasks().
+
+    Each non-empty line of the outline is a task. A line that is
+    indented further than the line above it is a subtask of the task
+    on that line. Leading '-' and '*' list markers are ignored.
+
+    Args:
+        outline: The outline string
+
+    Returns:
+        A list of task tree nodes, see import_tasks().
+    """
+    roots = []
+    stack = []                  # (indentation, node) of the open tasks
+    for line in outline.expandtabs(4).splitlines():
+        description = line.strip()
+        if description[:2] in ('- ', '* '):
+            description = description[2:].strip()
+        if not description:
+            continue
+        indentation = len(line) - len(line.lstrip())
+        node = { 'description': description, 'subtasks': [] }
+        while stack and stack[-1][0] >= indentation:
+            stack.pop()
+        if stack:
+            stack[-1][1]['subtasks'].append(node)
+        else:
+            roots.append(node)
+        stack.append((indentation, node))
+    return roots
+
+
+def import_tasks(domain_identifier,
+                 user,
+                 task_tree,
+                 parent_task_identifier=None):
+    """Creates a complete tree of tasks at once.
+
+    This is much cheaper than calling create_task() for each task. The
+    keys of all tasks are allocated in a single batch, the derived
+    properties of all tasks are computed in memory in a single
+    bottom-up pass, and the Tasks and TaskIndexes are stored with
+    batched puts. No workers are queued for the individual tasks, only
+    the parent task is marked for propagation.
+
+    The tasks are stored outside of a transaction, parents before
+    their subtasks. If the import fails halfway, the tasks that were
+    stored form a valid, but incomplete, task tree. The propagation
+    worker repairs such a tree: before any task is stored, the parent
+    task is marked dirty and the task tree snapshot of the entity
+    group is discarded in a transaction, and new root tasks are
+    stored together with a dirty marker, so they are counted in the
+    domain statistics.
+
+    Args:
+        domain_identifier: The domain identifier of the domain in which
+            the tasks will be created.
+        user: The User model instance of the user that imports the
+            tasks.
+        task_tree: A list of task tree nodes. Each node is a dictionary
+            with a 'description' string and optionally a list of
+            'subtasks' nodes, the 'assignee' user identifier and the
+            boolean 'completed'. Only atomic tasks with an assignee
+            can be completed. See also parse_task_outline().
+        parent_task_identifier: The task identifier of the optional
+            parent task of the root tasks of |task_tree|.
+
+    Returns:
+        A list with the new Task instances, in pre-order.
+
+    Raises:
+        ValueError: The user is not a member of the domain, the parent
+            task does not exist, an assignee is not a member of the
+            domain or the task tree is invalid.
+    """
+    if not member_of_domain(domain_identifier, user):
+        raise ValueError("User '%s' not a member of domain '%s'" %
+                         (user.name, domain_identifier))
+
+    # Flatten the tree in pre-order.
+    nodes = []
+    parents = []
+    stack = [(node, None) for node in reversed(task_tree)]
+    while stack:
+        node, parent = stack.pop()
+        if (not isinstance(node, dict) or
+            not isinstance(node.get('description'), basestring) or
+            not node['description'].strip()):
+            raise ValueError("Invalid task %r" % (node,))
+        if node.get('completed') and (node.get('subtasks') or
+                                      not node.get('assignee')):
+            raise ValueError("Only assigned atomic tasks can be completed")
+        position = len(nodes)
+        nodes.append(node)
+        parents.append(parent)
+        stack.extend((subtask, position)
+                     for subtask in reversed(node.get('subtasks') or []))
+        if len(nodes) > MAX_IMPORT_TASKS:
+            raise ValueError("Too many tasks")
+    if not nodes:
+        return []
+
+    assignee_identifiers = list(set(node['assignee'] for node in nodes
+                                    if node.get('assignee')))
+    assignees = caching.get([db.Key.from_path('User', identifier)
+                             for identifier in assignee_identifiers])
+    if not all(assignees) or not member_of_domain(domain_identifier,
+                                                  user, *assignees):
+        raise ValueError("Assignees must be members of the domain")
+    register_assignee_names(domain_identifier, assignees)
+
+    hierarchy = []
+    level = 0
+    parent_task = get_task(domain_identifier, parent_task_identifier,
+                           use_cache=False)
+    if parent_task_identifier:
+        if not parent_task:
+            raise ValueError("Parent task '%s' does not exist" %
+                             parent_task_identifier)
+        parent_index = TaskIndex.get(
+            TaskIndex.key_from_task_key(parent_task.key()))
+        hierarchy = list(parent_index.hierarchy) if parent_index else []
+        hierarchy.append(parent_task.identifier())
+        level = parent_task.derived_level + 1
+        group_key = parent_task.group_key()
+    else:
+        group_key = _new_root_task_group_key(domain_identifier)
+
+    keys = Task.allocate_keys(group_key, len(nodes))
+    tasks = []
+    indexes = []
+    subtasks = [[] for node in nodes]
+    for position, (node, key, parent) in enumerate(zip(nodes, keys,
+                                                       parents)):
+        if parent is None:
+            parent_key = parent_task.key() if parent_task else None
+            task_hierarchy = hierarchy
+            task_level = level
+        else:
+            subtasks[parent].append(position)
+            parent_key = keys[parent]
+            task_hierarchy = (indexes[parent].hierarchy +
+                              [tasks[parent].identifier()])
+            task_level = tasks[parent].derived_level + 1
+        assignee = node.get('assignee')
+        task = Task(key=key,
+                    description=node['description'].strip(),
+                    user=user,
+                    context=user.default_context_key(),
+                    parent_task=parent_key,
+                    assignee=(db.Key.from_path('User', assignee)
+                              if assignee else None),
+                    completed=bool(node.get('completed')),
+                    derived_level=task_level)
+        tasks.append(task)
+        indexes.append(TaskIndex(parent=key,
+                                 key_name=task.identifier(),
+                                 hierarchy=task_hierarchy))
+    workers.compute_new_task_tree(tasks, indexes, subtasks)
+
+    def mark_txn():
+        if parent_task:
+            workers.UpdateTaskCompletion.enqueue(domain_identifier,
+                                                 parent_task.identifier(),
+                                                 transactional=True)
+        workers.discard_task_tree_snapshot(group_key)
+    db.run_in_transaction(mark_txn)
+
+    entities = []
+    for task, index in zip(tasks, indexes):
+        entities.extend([task, index])
+        if task.root() and workers.COALESCE_PROPAGATION:
+            entities.append(DirtyTask(parent=group_key,
+                                      key_name=task.identifier()))
+    for start in range(0, len(entities), IMPORT_BATCH_SIZE):
+        db.put(entities[start:start + IMPORT_BATCH_SIZE])
+
+    def txn():
+        workers.update_task_tree_snapshot(group_key, tasks=tasks)
+        if parent_task:
+            workers.UpdateTaskCompletion.enqueue(domain_identifier,
+                                                 parent_task.identifier(),
+                                                 transactional=True)
+        else:
+            roots = [task for task in tasks if task.root()]
+            workers.update_domain_statistics(roots)
+            caching.put(roots)
+            # Queues the propagation worker, which consumes the
+            # markers of the root tasks.
+            if workers.COALESCE_PROPAGATION:
+                workers.PropagateTaskCompletion.mark_dirty(
+                    domain_identifier, roots[0].identifier())
+    db.run_in_transaction(txn)
+    increment_modification_counter(domain_identifier)
+    workers.UpdateSearchIndex.enqueue_new_tasks(
+        domain_identifier, [task.identifier() for task in tasks])
+    # The assigned tasks are added to the inboxes. The parent task is
+    # removed from the inbox by the propagation.
+    workers.UpdateInbox.enqueue_new_tasks(
+        domain_identifier,
+        [task.identifier() for task in tasks
+         if task.assignee_key() and task.atomic()])
+    return tasks
+
+
+def _log_task_event(task, user, kind, value):
+    """
+    Appends an event to the log of |task|, and increases the log size
+    of the task. Must be called in the transaction of the mutation,
+    before the task is stored.
+
+    Args:
+        task: An instance of the Task model
+        user: An instance of the User model that made the mutation
+        kind: The kind of event, see TaskLogPage.
+        value: The new value of the changed property.
+
+    Returns:
+        The TaskLogPage with the new event. It must be stored by the
+        caller.
+    """
+    page_number, offset = divmod(task.log_size, TaskLogPage.PAGE_SIZE)
+    page_key = TaskLogPage.key_from_task_key(task.key(), page_number)
+    page = None
+    if offset:
+        page = db.get(page_key)
+    if not page:
+        page = TaskLogPage(key=page_key)
+    page.add_event(datetime.datetime.now(), user.identifier(), kind, value)
+    task.log_size += 1
+    return page
+
+
+def get_task_log(task, page=None):
+    """
+    Returns the events in the log of |task|, from new to old. Without
+    a |page|, the last two pages are fetched in a single batch get, so
+    at least TaskLogPage.PAGE_SIZE of the most recent events are
+    returned.
+
+    Args:
+        task: An instance of the Task model
+        page: The number of the page to return, as returned in a
+            previous call.
+
+    Returns:
+        A tuple (events, previous_page), with a list of event records
+        as described in TaskLogPage, and the number of the page with
+        older events, or None if there are no older events.
+
+    Raises:
+        ValueError: If the page does not exist.
+    """
+    last_page = (task.log_size - 1) // TaskLogPage.PAGE_SIZE
+    if page is None:
+        if not task.log_size:
+            return [], None
+        numbers = range(max(last_page - 1, 0), last_page + 1)
+    elif 0 <= page <= last_page:
+        numbers = [page]
+    else:
+        raise ValueError("Invalid page")
+    pages = db.get([TaskLogPage.key_from_task_key(task.key(), number)
+                    for number in numbers])
+    events = []
+    for log_page in pages:
+        if log_page:
+            events.extend(log_page.events)
+    events.reverse()
+    return events, (numbers[0] - 1 if numbers[0] else None)
+
+
 def assign_task(domain_identifier, task_identifier, user, assignee):
     """Assigns a task to an assignee.
 
@@ -366,20 +1107,25 @@ def assign_task(domain_identifier, task_identifier, user, assignee):
         ValueError: If the assignment operation is invalid, or if the
             task does not exist.
     """
+    register_assignee_names(domain_identifier, [assignee])
+
     def txn():
         task = get_task(domain_identifier, task_identifier)
         if not task:
             raise ValueError("Task does not exist")
         if not can_assign_task(task, user, assignee):
             raise ValueError("Cannot assign")
+        old_assignee_identifier = task.assignee_identifier()
         task.assignee = assignee
-        workers.UpdateTaskCompletion.enqueue(domain_identifier,
-                                             task.identifier(),
-                                             transactional=True)
-        task.put()
+        db.put(_log_task_event(task, user, 'assignee',
+                               assignee.identifier()))
+        workers.update_atomic_task(
+            task, old_assignee_identifier=old_assignee_identifier)
         return task
 
-    return db.run_in_transaction(txn)
+    task = db.run_in_transaction(txn)
+    increment_modification_counter(domain_identifier)
+    return task
 
 
 def set_task_completed(domain_identifier, user, task_identifier, completed):
@@ -408,13 +1154,14 @@ def set_task_completed(domain_identifier, user, task_identifier, completed):
         if not task or not task.atomic() or not can_complete_task(task, user):
             raise ValueError("Invalid task")
         task.completed = completed
-        workers.UpdateTaskCompletion.enqueue(domain_identifier,
-                                             task.identifier(),
-                                             transactional=True)
-        task.put()
+        db.put(_log_task_event(task, user, 'completed', completed))
+        # The user is the assignee of the task.
+        workers.update_atomic_task(task)
         return task
 
-    return db.run_in_transaction(txn)
+    task = db.run_in_transaction(txn)
+    increment_modification_counter(domain_identifier)
+    return task
 
 
 def change_task_description(domain_identifier,
@@ -448,11 +1195,32 @@ def change_task_description(domain_identifier,
         domain = get_domain(task.domain_identifier())
         if not can_edit_task(domain, task, user):
             raise ValueError("User '%s' can not edit task '%s'", (user, task))
+        # The terms of tasks that were indexed before their terms
+        # were recorded are recorded now, so they can be removed.
+        terms_key = TaskSearchTerms.key_from_task_key(task.key())
+        entities = [_log_task_event(task, user, 'description', description)]
+        if not db.get(terms_key):
+            entities.append(TaskSearchTerms(
+                    key=terms_key,
+                    terms=sorted(search.tokenize(task.description))))
         task.description = description
-        task.put()
+        task.version += 1
+        db.put(entities)
+        caching.put(task)
+        workers.refresh_task(task)
+        workers.UpdateSearchIndex.enqueue(domain_identifier,
+                                          [task_identifier],
+                                          transactional=True)
+        # The title is part of the paths of the descendants.
+        workers.UpdateInbox.enqueue(domain_identifier,
+                                    [task_identifier],
+                                    subtree=True,
+                                    transactional=True)
         return task
 
-    return db.run_in_transaction(txn)
+    task = db.run_in_transaction(txn)
+    increment_modification_counter(domain_identifier)
+    return task
 
 
 def change_task_parent(domain_identifier,
@@ -475,13 +1243,20 @@ def change_task_parent(domain_identifier,
         new_parent_identifier: The identifier for the new parent.
             Can be None, in which case the task will end up as a root task.
 
+    The entity group of a task is part of its identifier, so in a
+    sharded domain, a task can only be moved within the entity group
+    of its root task. Tasks keep their identifiers when they are
+    moved. The move task UI therefore only lists the tasks in the
+    entity group of the task, see get_all_direct_subtasks().
+
     Returns:
         An instance of the Task model, which is the task with his
         new parent.
 
     Raises:
-        ValueError: The task does not exist, or the user is not
-        allowed to change the task.
+        ValueError: The task does not exist, the user is not
+        allowed to change the task, or the new parent is stored in
+        another entity group.
     """
     if not member_of_domain(domain_identifier, user):
         raise ValueError("User is not a member of the domain")
@@ -506,7 +1281,12 @@ def change_task_parent(domain_identifier,
                                                  old_parent_identifier,
                                                  transactional=True)
         task.parent_task = new_parent
-        task.put()
+        db.put(_log_task_event(task, user, 'parent', new_parent_identifier))
+        # A task that becomes a root task is counted in the domain
+        # statistics, and a root task that gets a parent is no longer
+        # counted.
+        workers.update_domain_statistics([task])
+        caching.put(task)
         # Both the derived properties must be recomputed, and the new
         # hierarchy of the task that has changed parents.
         workers.UpdateTaskCompletion.enqueue(domain_identifier,
@@ -514,13 +1294,22 @@ def change_task_parent(domain_identifier,
                                              transactional=True)
         workers.UpdateTaskHierarchy.enqueue(domain_identifier,
                                             task_identifier,
-                                            transactional=True)
+                                            transactional=True,
+                                            subtree=True)
         return task
 
-    return db.run_in_transaction(txn)
+    if (new_parent_identifier and
+        Task.key_from_identifier(domain_identifier,
+                                 task_identifier).parent() !=
+        Task.key_from_identifier(domain_identifier,
+                                 new_parent_identifier).parent()):
+        raise ValueError("New parent is in another shard of the domain")
+    task = db.run_in_transaction(txn)
+    increment_modification_counter(domain_identifier)
+    return task
 
 
-def create_domain(domain, domain_title, user):
+def create_domain(domain, domain_title, user, shard_count=0):
     """Creates a new domain, if none already exists with that identifier.
 
     The user will become an admin on the newly created domain, and the
@@ -534,99 +1323,348 @@ def create_domain(domain, domain_title, user):
         domain_title: The string title of the new domain. The string must
             be non-empty.
         user: Instance of the User model that creates the domain.
+        shard_count: The number of DomainShards over which the tasks
+            of the domain are spread. At most MAX_SHARDS. Sharding is
+            only useful for domains with a high write rate.
 
     Returns:
         The newly created Domain instance. |user| will be set as
         admin of the new domain. Returns None if a domain already
-        exists with that identifier, the identifier is not valid or
-        the domain_title is empty.
+        exists with that identifier, the identifier is not valid,
+        the domain_title is empty or the shard_count is invalid.
     """
     # TODO(tijmen): Use multiple entity group transaction here
     domain_title = domain_title.splitlines()[0].strip()
     if (not re.match(VALID_DOMAIN_IDENTIFIER, domain) or
-        not domain_title):
+        not domain_title or
+        not 0 <= shard_count <= MAX_SHARDS):
         return None
     existing = Domain.get_by_key_name(domain)
     if existing:
         return None
     new_domain = Domain(key_name=domain,
                         name=domain_title,
-                        admins=[user.key().name()])
-    new_domain.put()
+                        admins=[user.key().name()],
+                        shard_count=shard_count,
+                        ordered_indexes=True)
+    caching.put(new_domain)
     def txn(user_key):
         txn_user = User.get(user_key)
         if not domain in txn_user.domains:
             txn_user.domains.append(domain)
-            txn_user.put()
+            caching.put(txn_user)
     db.run_in_transaction(txn, user.key())
     return new_domain
 
 
+def _task_sort_key(task, user_identifier=None):
+    """
+    Returns the sort key of a Task or TaskTreeNode in the task lists,
+    which matches the order of the queries of the task lists. If a
+    |user_identifier| is provided, the tasks that are active for that
+    user come first.
+    """
+    return (0 if task.is_active(user_identifier) else 1,
+            TaskIndex.sort_key_for(task.is_completed(), task.time))
+
+
+def _active_tasks_first(tasks, user_identifier):
+    """
+    Sorts a page of tasks in place, such that the tasks that are
+    active for the user come first. The order of the tasks is kept
+    otherwise.
+    """
+    if user_identifier:
+        tasks.sort(key=lambda task: not task.is_active(user_identifier))
+
+
+def _tasks_of_results(results):
+    """
+    Returns the tasks of a list of Task and TaskIndex instances, in
+    the same order. The tasks of the TaskIndexes are fetched in a
+    single batch get. Tasks that no longer exist are left out.
+    """
+    task_keys = [result.parent_key() for result in results
+                 if isinstance(result, TaskIndex)]
+    tasks = dict(zip(task_keys, Task.get(task_keys)))
+    results = [tasks.get(result.parent_key())
+               if isinstance(result, TaskIndex) else result
+               for result in results]
+    return [task for task in results if task]
+
+
+def _active_tasks_query(group_key, user_identifier, level, root_task=None):
+    """
+    Returns the first query of a task list in which the tasks that are
+    active for the user are listed first. The query returns the
+    TaskIndexes of the tasks at |level| that are active for the user,
+    together with the sort key function for _fetch_page().
+    """
+    query = TaskIndex.all().\
+        ancestor(group_key).\
+        filter('active_assignees =', user_identifier).\
+        filter('level =', level)
+    if root_task:
+        query.filter('hierarchy =', root_task.identifier())
+    return query.order('sort_key'), lambda index: (0, index.sort_key)
+
+
+def _ordered_task_indexes(domain_identifier):
+    """
+    Returns true if the TaskIndexes of a domain have the properties
+    that order the task lists, see Domain.ordered_indexes. If not, a
+    worker is requested to backfill them, and the task lists must use
+    unordered queries until it has finished.
+    """
+    domain = get_domain(domain_identifier)
+    if not domain or domain.ordered_indexes:
+        return True
+    workers.request_index_order(domain_identifier)
+    return False
+
+
+def _encode_cursor(positions):
+    """
+    Encodes the positions of the queries of a paged task list into a
+    cursor string. See _fetch_page().
+    """
+    return 'c' + base64.urlsafe_b64encode(json.dumps(positions))
+
+
+def _decode_cursor(cursor, query_count):
+    """
+    Decodes a cursor string that is returned by one of the paged task
+    list functions.
+
+    Args:
+        cursor: The cursor string, or None for the first page.
+        query_count: The number of queries of the task list.
+
+    Returns:
+        A tuple with a list with the position of each query, and the
+        number of merged results that must be skipped. The position
+        of a query is a datastore cursor string, which is empty at
+        the start of the query, or None if the query has no more
+        results.
+
+    Raises:
+        ValueError: The cursor is invalid.
+    """
+    if not cursor:
+        return [''] * query_count, 0
+    try:
+        if cursor[0] == 'o':
+            # Offset cursor, as returned for a task tree snapshot.
+            skip = int(cursor[1:])
+            if skip >= 0:
+                return [''] * query_count, skip
+        elif cursor[0] == 'c':
+            positions = json.loads(base64.urlsafe_b64decode(str(cursor[1:])))
+            if (isinstance(positions, list) and
+                len(positions) == query_count and
+                all(position is None or isinstance(position, basestring)
+                    for position in positions)):
+                return positions, 0
+    except (TypeError, ValueError):
+        pass
+    raise ValueError("Invalid cursor '%s'" % cursor)
+
+
+def is_task_tree_cursor(cursor):
+    """
+    Returns true if |cursor| can be used to continue a task list
+    with get_all_direct_subtasks_from_tree(). The datastore task list
+    functions accept these cursors as well.
+    """
+    return not cursor or cursor[0] == 'o'
+
+
+def _fetch_page(queries, limit, cursor=None):
+    """
+    Fetches a page of results of a task list, which consists of one or
+    more queries per entity group. The results of the queries are
+    merged on their sort keys, so each query must be ordered
+    consistently with its sort key function.
+
+    The position of each query is kept in the returned cursor, as the
+    datastore cursor of its first result that is not in the page. For
+    a single query, this is a plain cursor based page. A query of
+    which only a part of the fetched results is in the page is run
+    again up to that point, to obtain its cursor, so no page is
+    fetched with an offset.
+
+    Args:
+        queries: A list of (query, key) pairs, with a db.Query
+            instance and a function that returns the sort key of a
+            result of the query.
+        limit: The maximum number of results in the page.
+        cursor: The cursor returned for the previous page, or None
+            for the first page.
+
+    Returns:
+        A tuple with a list of at most |limit| results and the cursor
+        of the next page, which is None if there are no more results.
+
+    Raises:
+        ValueError: The cursor is invalid.
+    """
+    positions, skip = _decode_cursor(cursor, len(queries))
+    count = skip + limit
+    # All queries are started before any of the results are read, so
+    # the queries of the entity groups run concurrently.
+    runs = []
+    for (query, key), position in zip(queries, positions):
+        run = None
+        if position is not None:
+            if position:
+                query.with_cursor(position)
+            run = query.run(limit=count, batch_size=count)
+        runs.append(run)
+    fetched = [list(run) if run is not None else [] for run in runs]
+
+    candidates = []
+    for number, ((query, key), results) in enumerate(zip(queries,
+                                                         fetched)):
+        candidates.extend((key(result), number, order, result)
+                          for order, result in enumerate(results))
+    candidates.sort()
+    consumed = [0] * len(queries)
+    for candidate in candidates[:count]:
+        consumed[candidate[1]] += 1
+
+    # The queries that are partly consumed are run again concurrently,
+    # up to their first result that is not in the page.
+    reruns = {}
+    for number, (query, key) in enumerate(queries):
+        if 0 < consumed[number] < len(fetched[number]):
+            reruns[number] = query.run(limit=consumed[number],
+                                       batch_size=consumed[number])
+    next_positions = []
+    for number, ((query, key), position) in enumerate(zip(queries,
+                                                          positions)):
+        results = fetched[number]
+        if position is None:
+            next_positions.append(None)
+        elif consumed[number] == len(results):
+            if len(results) < count:
+                next_positions.append(None)     # No more results
+            else:
+                next_positions.append(query.cursor())
+        elif not consumed[number]:
+            next_positions.append(position)
+        else:
+            list(reruns[number])
+            next_positions.append(query.cursor())
+    next_cursor = None
+    if [position for position in next_positions if position is not None]:
+        next_cursor = _encode_cursor(next_positions)
+    return ([candidate[3] for candidate in candidates[skip:count]],
+            next_cursor)
+
+
 def get_open_tasks(domain_identifier,
                    root_task=None,
-                   limit=50):
+                   limit=50,
+                   cursor=None,
+                   indexes_only=False):
     """
-    Returns all open tasks that are direct subtasks of the
+    Returns a page of the open tasks that are direct subtasks of the
     |root_task|.  If no |root_task| is provided, it will return all
     open tasks in the domain. Open tasks are tasks that are not yet
     completed and not assigned to anyone.
 
+    The tasks are ordered from new to old by the datastore, and the
+    next page can be fetched by passing the returned cursor. Until
+    the TaskIndexes of the domain have been backfilled, see
+    Domain.ordered_indexes, the tasks are not ordered.
+
     Args:
         domain_identifier: The domain identifier string. Must be
             the same domain as the root_task, if provided.
         root_task: An instance of the Task model. Can be None.
-        limit: Approximate maximum number of tasks to return.
+        limit: Maximum number of tasks to return.
+        cursor: The cursor of the page, as returned for the previous
+            page. If None, the first page is returned.
+        indexes_only: If set to True, the TaskIndexes of the tasks
+            are returned instead of the tasks, which are then not
+            fetched.
 
     Returns:
-        A list of Task model instances that are not yet completed
-        and do not have an assignee, which are all direct subtasks
-        of the given |root_task|.
+        A tuple with a list of Task model instances that are not yet
+        completed and do not have an assignee, which are all direct
+        subtasks of the given |root_task|, and the cursor of the next
+        page. The cursor is None if there are no more tasks.
+
+    Raises:
+        ValueError: The limit is not a positive integer, the cursor
+            is invalid, or the root_task does not belong to the
+            given domain.
     """
     if limit <= 0:
         raise ValueError("Invalid limit %d" % limit)
     if root_task and root_task.domain_identifier() != domain_identifier:
         raise ValueError("Domains do not match")
 
-    def txn():
-        level = root_task.hierarchy_level() + 1 if root_task else 0
-        query = TaskIndex.all(keys_only=True).\
-            ancestor(Domain.key_from_name(domain_identifier)).\
+    level = root_task.hierarchy_level() + 1 if root_task else 0
+    ordered = _ordered_task_indexes(domain_identifier)
+    queries = []
+    for group_key in _task_group_keys(domain_identifier, root_task):
+        query = TaskIndex.all().\
+            ancestor(group_key).\
             filter('has_open_tasks =', True).\
             filter('level =', level)
         if root_task:
             query.filter('hierarchy =', root_task.identifier())
-        fetched = query.fetch(limit)
-        tasks = Task.get([key.parent() for key in fetched])
-        return tasks
-
-    tasks = db.run_in_transaction(txn)
-    _sort_tasks(tasks)
-    return tasks
+        if ordered:
+            queries.append((query.order('sort_key'),
+                            lambda index: index.sort_key))
+        else:
+            queries.append((query, lambda index: 0))
+    indexes, next_cursor = _fetch_page(queries, limit, cursor=cursor)
+    if indexes_only:
+        return indexes, next_cursor
+    return _tasks_of_results(indexes), next_cursor
 
 
 def get_assigned_tasks(domain_identifier,
                        user,
                        root_task=None,
-                       limit=50):
+                       limit=50,
+                       cursor=None,
+                       indexes_only=False):
     """
-    Returns a list of all direct subtasks of the given |root_task|, that
+    Returns a page of the direct subtasks of the given |root_task|, that
     are either directly assigned to the given |user|, or is participating
     in (because one of its atomic tasks is assigned to that user).
 
+    The tasks that are active for the user are listed first, and then
+    the tasks are ordered from new to old, by the datastore. The next
+    page can be fetched by passing the returned cursor. Until the
+    TaskIndexes of the domain have been backfilled, see
+    Domain.ordered_indexes, the uncompleted tasks of the user are
+    returned without any order.
+
     Args:
         domain_identifier: The domain identifier string
         user: An instance of the user model.
         root_task: The optional root task, that must be an ancestor
             task of the returned tasks.
         limit: The maximum number of subtasks to return.
+        cursor: The cursor of the page, as returned for the previous
+            page. If None, the first page is returned.
+        indexes_only: If set to True, the TaskIndexes of the tasks
+            are returned instead of the tasks, which are then not
+            fetched.
 
     Returns:
-        A list with all subtasks of the given |root_task| that are
-        assigned to the user.
+        A tuple with a list of the subtasks of the given |root_task|
+        that are assigned to the user, and the cursor of the next
+        page. The cursor is None if there are no more tasks.
 
     Raises:
-        ValueError: The limit is not a positive integer, or the
-            user and root_task do not belong to the given domain.
+        ValueError: The limit is not a positive integer, the cursor
+            is invalid, or the user and root_task do not belong to
+            the given domain.
     """
     if limit <= 0:
         raise ValueError("Invalid limit %d" % limit)
@@ -635,55 +1673,311 @@ def get_assigned_tasks(domain_identifier,
     if root_task and root_task.domain_identifier() != domain_identifier:
         raise ValueError("Root task and domain do not match")
 
-    def txn():
-        level = root_task.hierarchy_level() + 1 if root_task else 0
-        query = TaskIndex.all(keys_only=True).\
-            ancestor(Domain.key_from_name(domain_identifier)).\
-            filter('assignees =', user.identifier()).\
-            filter('level =', level).\
-            filter('completed =', False)
+    user_identifier = user.identifier()
+    level = root_task.hierarchy_level() + 1 if root_task else 0
+    ordered = _ordered_task_indexes(domain_identifier)
+    queries = []
+    for group_key in _task_group_keys(domain_identifier, root_task):
+        if not ordered:
+            query = TaskIndex.all().\
+                ancestor(group_key).\
+                filter('assignees =', user_identifier).\
+                filter('level =', level).\
+                filter('completed =', False)
+            if root_task:
+                query.filter('hierarchy =', root_task.identifier())
+            queries.append((query, lambda index: 0))
+            continue
+        queries.append(_active_tasks_query(group_key, user_identifier,
+                                           level, root_task=root_task))
+        query = TaskIndex.all().\
+            ancestor(group_key).\
+            filter('inactive_assignees =', user_identifier).\
+            filter('level =', level)
         if root_task:
             query.filter('hierarchy =', root_task.identifier())
-        fetched = query.fetch(limit)
-        tasks = Task.get([key.parent() for key in fetched])
-        return tasks
-
-    tasks = db.run_in_transaction(txn)
-    _sort_tasks(tasks, user_identifier=user.identifier())
-    return tasks
+        queries.append((query.order('sort_key'),
+                        lambda index: (1, index.sort_key)))
+    indexes, next_cursor = _fetch_page(queries, limit, cursor=cursor)
+    if indexes_only:
+        return indexes, next_cursor
+    return _tasks_of_results(indexes), next_cursor
 
 
 def get_all_direct_subtasks(domain_identifier,
                             root_task=None,
                             limit=100,
-                            user_identifier=None):
+                            user_identifier=None,
+                            cursor=None,
+                            group_key=None):
     """
-    Returns all direct subtasks of a |root_task| in the given domain.
-    If no |root_task| is specified, then all root tasks of the
-    domain will be returned.
+    Returns a page of the direct subtasks of a |root_task| in the
+    given domain. If no |root_task| is specified, then the root tasks
+    of the domain will be returned.
+
+    This function returns at most |limit| tasks. The next page can be
+    fetched by passing the returned cursor.
 
-    This function returns at most |limit| tasks.
+    The tasks are queried directly, as the TaskIndex of a new task is
+    only created by the workers. The tasks that are active for a user
+    are therefore only listed first within each page.
 
     Args:
         domain_identifier: The domain identifier string
         root_task: An instance of the Task model
         limit: The maximum number of tasks that will be returned
-        user_identifier: Optional user identifier. If provided, the tasks
-            will be sorted on their active state for that user.
+        user_identifier: Optional user identifier. If provided, the
+            tasks that are active for that user are listed first in
+            the page.
+        cursor: The cursor of the page, as returned for the previous
+            page. If None, the first page is returned.
+        group_key: Optional root key of an entity group of the
+            domain. If provided without a |root_task|, only the root
+            tasks in that entity group are returned, such as the
+            possible new parents of a task in a sharded domain. The
+            cursors of such a list can only be used with the same
+            |group_key|.
 
     Returns:
-        A list of at most |limit| task instances of the domain,
-        who are all direct descendants of |root_task|, or are
-        all root task if no specific |root_task| is specified.
-        The tasks are ordered on completion state, and if a |user_identifier|
-        is provided, also on active state.
+        A tuple with a list of at most |limit| task instances of the
+        domain, who are all direct descendants of |root_task|, or are
+        all root task if no specific |root_task| is specified, and the
+        cursor of the next page. The cursor is None if there are no
+        more tasks. The tasks are ordered by the datastore on
+        completion state and time, and then on active state within
+        the page, if a |user_identifier| is provided.
+
+    Raises:
+        ValueError: The cursor is invalid.
     """
-    query = Task.all().\
-        ancestor(Domain.key_from_name(domain_identifier)).\
-        filter('parent_task = ', root_task)
-    tasks = query.fetch(limit)
-    _sort_tasks(tasks, user_identifier=user_identifier)
-    return tasks
+    queries = []
+    for group_key in _task_group_keys(domain_identifier, root_task,
+                                      group_key):
+        query = Task.all().\
+            ancestor(group_key).\
+            filter('parent_task = ', root_task).\
+            order('derived_completed').\
+            order('-time')
+        queries.append((query, _task_sort_key))
+    tasks, next_cursor = _fetch_page(queries, limit, cursor=cursor)
+    _active_tasks_first(tasks, user_identifier)
+    return tasks, next_cursor
+
+
+def get_task_tree(domain_identifier):
+    """
+    Returns the snapshot of the task tree of a domain, if it is up to
+    date. The snapshot is read from memcache if possible. If the
+    domain does not have a snapshot yet, a worker is queued to build
+    one. The snapshots of the entity groups of a sharded domain are
+    merged into a single snapshot.
+
+    The decoded snapshots are kept in the memory of the instance, and
+    are only fetched and decoded again if the snapshot revision of
+    one of the groups has changed. The returned snapshot can be
+    shared between requests, and must not be changed.
+
+    Args:
+        domain_identifier: The domain identifier string
+
+    Returns:
+        A TaskTreeSnapshot instance, or None if the domain does not
+        have a snapshot, or if the snapshot might be out of date
+        because changes in the domain are still being propagated.
+    """
+    if not workers.COALESCE_PROPAGATION:
+        return None
+    group_keys = get_group_keys(domain_identifier)
+    states = caching.get([PropagationState.key_from_group_key(group_key)
+                          for group_key in group_keys])
+    if [state for state in states if state and state.pending]:
+        return None
+    revisions = [state.snapshot_revision if state else 0
+                 for state in states]
+    cache_key = tuple(str(group_key) for group_key in group_keys)
+    cached = _task_trees.get(cache_key)
+    if cached and cached[0] == revisions:
+        return cached[1]
+
+    snapshots = caching.get([TaskTreeSnapshot.key_from_group_key(group_key)
+                             for group_key in group_keys])
+    missing = [group_key
+               for group_key, snapshot in zip(group_keys, snapshots)
+               if not snapshot]
+    for group_key in missing:
+        workers.request_task_tree_snapshot(group_key)
+    if missing:
+        return None
+    if len(snapshots) == 1:
+        snapshot = snapshots[0]
+    else:
+        snapshot = TaskTreeSnapshot.merge(snapshots)
+    # Decode the snapshot before it is shared.
+    snapshot.children()
+    if len(_task_trees) >= TASK_TREE_CACHE_SIZE:
+        _task_trees.clear()
+    _task_trees[cache_key] = (revisions, snapshot)
+    return snapshot
+
+
+def get_all_direct_subtasks_from_tree(task_tree,
+                                      root_task_identifier=None,
+                                      limit=100,
+                                      user_identifier=None,
+                                      cursor=None):
+    """
+    Returns a page of the direct subtasks of a task from a task tree
+    snapshot. This is equivalent to get_all_direct_subtasks(), but
+    does not perform any RPC calls.
+
+    Args:
+        task_tree: A TaskTreeSnapshot instance, as returned by
+            get_task_tree().
+        root_task_identifier: The identifier of the root task. If not
+            provided, all the root tasks of the domain are returned.
+        limit: The maximum number of tasks that will be returned
+        user_identifier: Optional user identifier. If provided, the
+            tasks that are active for that user are listed first in
+            the page.
+        cursor: The cursor of the page, as returned for the previous
+            page. Must be accepted by is_task_tree_cursor().
+
+    Returns:
+        A tuple with a list of at most |limit| TaskTreeNode instances,
+        ordered as in get_all_direct_subtasks(), and the cursor of the
+        next page, or None if there are no more tasks. The cursor can
+        also be passed to get_all_direct_subtasks(), in case the
+        snapshot is not available for the next page.
+
+    Raises:
+        ValueError: The cursor is invalid.
+    """
+    if not is_task_tree_cursor(cursor):
+        raise ValueError("Invalid cursor '%s'" % cursor)
+    skip = _decode_cursor(cursor, 1)[1]
+    tasks = task_tree.children(root_task_identifier)
+    tasks.sort(key=_task_sort_key)
+    next_cursor = None
+    if len(tasks) > skip + limit:
+        next_cursor = 'o%d' % (skip + limit)
+    tasks = tasks[skip:skip + limit]
+    _active_tasks_first(tasks, user_identifier)
+    return tasks, next_cursor
+
+
+def get_subtree(domain_identifier,
+                root_task=None,
+                depth=None,
+                user_identifier=None):
+    """
+    Returns all the tasks in the subtree of |root_task|, optionally
+    limited to a number of levels below the root task.
+
+    The subtasks are found with a keys-only query on the hierarchy of
+    the TaskIndexes, and fetched in a single batch get, from memcache
+    if possible. New tasks are only returned after their TaskIndex is
+    created by the workers.
+
+    Args:
+        domain_identifier: The domain identifier string
+        root_task: An instance of the Task model. If not provided, the
+            tasks of the entire domain are returned.
+        depth: The maximum number of levels below the root task, or
+            None for the entire subtree. A depth of 1 only returns
+            the direct subtasks.
+        user_identifier: Optional user identifier. If provided, the
+            tasks that are active for that user are listed first among
+            their siblings.
+
+    Returns:
+        A list of Task model instances in pre-order, with the
+        subtasks of each task in the order of the task lists. The
+        root task itself is not included.
+
+    Raises:
+        ValueError: The depth is not a positive integer, the root task
+            does not belong to the domain, or the subtree has more
+            than MAX_SUBTREE_TASKS tasks.
+    """
+    if depth is not None and depth <= 0:
+        raise ValueError("Invalid depth %d" % depth)
+    if root_task and root_task.domain_identifier() != domain_identifier:
+        raise ValueError("Domains do not match")
+
+    level = root_task.hierarchy_level() + 1 if root_task else 0
+    keys = []
+    for group_key in _task_group_keys(domain_identifier, root_task):
+        query = TaskIndex.all(keys_only=True).ancestor(group_key)
+        if root_task:
+            query.filter('hierarchy =', root_task.identifier())
+        if depth is not None:
+            query.filter('level <', level + depth)
+        keys.extend(query.fetch(MAX_SUBTREE_TASKS + 1 - len(keys)))
+        if len(keys) > MAX_SUBTREE_TASKS:
+            raise ValueError("The subtree has more than %d tasks" %
+                             MAX_SUBTREE_TASKS)
+    tasks = [task for task in caching.get([key.parent() for key in keys])
+             if task]
+    tasks.sort(key=lambda task: _task_sort_key(task, user_identifier))
+    return _group_tasks(tasks, min_task_level=level)
+
+
+def search_tasks(domain_identifier, query, user_identifier=None,
+                 limit=MAX_SEARCH_RESULTS):
+    """
+    Returns the tasks of which the description contains all the words
+    in |query|, grouped by their hierarchy.
+
+    The candidates are found by intersecting the posting lists of the
+    terms in the search index, see search.py. As the index is updated
+    by a worker, recent changes of the descriptions may not be found
+    yet. The candidates are verified against their current
+    description, so tasks that no longer match are never returned.
+
+    Args:
+        domain_identifier: The domain identifier string
+        query: The search query string
+        user_identifier: Optional user identifier. If provided, the
+            matching tasks that are active for that user are listed
+            first among their siblings.
+        limit: The maximum number of matching tasks. If more tasks
+            match, the tasks that were added to the search index
+            most recently are returned, see search.find_candidates().
+
+    Returns:
+        A list of Task model instances, ordered such that supertasks
+        are before their subtasks. The ancestors of the matching
+        tasks are included, so the matches are shown in their
+        hierarchy.
+
+    Raises:
+        ValueError: All words of the query are too common to search
+            for.
+    """
+    terms = search.tokenize(query)
+    if not terms:
+        return []
+    candidates = search.find_candidates(domain_identifier, terms)
+    if candidates is None:
+        raise ValueError("The query is too common")
+
+    matches = []
+    for start in range(0, len(candidates), limit):
+        keys = [Task.key_from_identifier(domain_identifier, identifier)
+                for identifier in candidates[start:start + limit]]
+        matches.extend(task for task in caching.get(keys)
+                       if task and search.matches(terms, task.description))
+        if len(matches) >= limit:
+            break
+    matches = matches[:limit]
+    matches.sort(key=lambda task: _task_sort_key(task, user_identifier))
+
+    index = dict((task.identifier(), task) for task in matches)
+    _fetch_missing_ancestors(index, domain_identifier, 0)
+    matched = set(task.identifier() for task in matches)
+    ancestors = [task for identifier, task in index.iteritems()
+                 if not identifier in matched]
+    return _group_tasks(matches + ancestors)
 
 
 @db.transactional
@@ -693,10 +1987,13 @@ def _check_for_cycle(task, new_parent):
     in a cycle. This function must be run as part of a transaction
     to get consistent results.
 
+    The ancestors of |new_parent| are fetched in a single batch get,
+    after which the check is a set membership test.
+
     Args:
         task: An instance of the Task model
         new_parent: An instance of the Task model, or None, in which
-            case the function will always return True.
+            case the function will always return False.
 
     Returns:
         False if the assignment is allowed. True if the assignment would
@@ -706,42 +2003,15 @@ def _check_for_cycle(task, new_parent):
         ValueError: If used outside of a transaction or the tasks
             are not in the same domain.
     """
+    if not new_parent:
+        return False
     if not task.domain_identifier() == new_parent.domain_identifier():
         raise ValueError("Tasks must be in the same domain")
-    visited = set([task.identifier()])
-    while new_parent:
-        if new_parent.identifier() in visited:
-            return True
-        visited.add(new_parent.identifier())
-        parent_identifier = new_parent.parent_task_identifier()
-        if parent_identifier:
-            new_parent = get_task(task.domain_identifier(), parent_identifier)
-        else:
-            new_parent = None
-    return False
-
-
-def _sort_tasks(tasks, user_identifier=None):
-    """
-    Sorts the list of Task instances, in place, on their completion
-    state,and finally on time, with the newer tasks first. If
-    |user_identifier| is provided, the tasks will be sorted on their
-    active state after being sorted on completion.
-
-    Args:
-        tasks: A list of Task model instances
-        user_identifier: Optional user identifier string
-
-    Returns:
-        Nothing. The list is sorted in place.
-    """
-    def task_cmp(t1, t2):
-        return (cmp(t1.is_completed(), t2.is_completed())
-                or -cmp(t1.is_active(user_identifier),
-                        t2.is_active(user_identifier))
-                or -cmp(t1.time, t2.time))
-
-    tasks.sort(cmp=task_cmp)
+    if task.key() == new_parent.key():
+        return True
+    ancestor_keys = set(ancestor.key()
+                        for ancestor in get_ancestors(new_parent))
+    return task.key() in ancestor_keys
 
 
 def _group_tasks(tasks,
@@ -758,8 +2028,14 @@ def _group_tasks(tasks,
 
     If complete_hierarchy is set to true, then tasks are fetched from
     the datastore are made to fill in the blanks, all the way up the
-    hierarchy. The function must also be run in the same transaction
-    as where the input tasks are fetched to get consistent results.
+    hierarchy. The missing ancestors are fetched in a single batch
+    get, see _fetch_missing_ancestors(). The function must also be
+    run in the same transaction as where the input tasks are fetched
+    to get consistent results.
+
+    The running time is linear in the number of tasks, and the
+    hierarchy is traversed without recursion, so deep hierarchies
+    and thousands of tasks are supported.
 
     Args:
         tasks: A list of Task model instances
@@ -791,57 +2067,94 @@ def _group_tasks(tasks,
                          "complete_hierarchy is set to True")
 
     index = dict([(task.identifier(), task) for task in tasks])
-    trees = {}                  # Index of all tree nodes, by task
-    # The output of the algorithm, all the tree root nodes
+    if complete_hierarchy:
+        _fetch_missing_ancestors(index, domain, min_task_level)
+
+    # Build the forest of tasks that are returned, as lists of child
+    # identifiers. The tree nodes of a task and of its ancestors that
+    # are not in the forest yet are created top-down, when the task
+    # is encountered in the input. Every task is visited a constant
+    # number of times.
+    children = {}
     roots = []
-
-    class _Tree(object):
-        """Very basic n-tree node"""
-        def __init__(self, value, parent=None):
-            self.value = value
-            self.parent = parent
-            if self.parent:
-                self.parent.children.append(self)
-            self.children = []
-
-        def pre_order(self, output):
-            output.append(self.value)
-            for child in self.children:
-                child.pre_order(output)
-
-        def post_order(self, output):
-            for child in self.children:
-                child.post_order(output)
-            output.append(self.value)
-
-    def fetch_tree(task_identifier):
-        if not task_identifier:
-            return None
-
-        task = index.get(task_identifier)
-        if not task and complete_hierarchy:
-            task = get_task(domain, task_identifier)
-            if task:
-                index[task_identifier] = task
-        if not task or task.hierarchy_level() < min_task_level:
-            return None
-
-        tree = trees.get(task)
-        if not tree:
-            parent_tree = fetch_tree(task.parent_task_identifier())
-            tree = _Tree(task, parent=parent_tree)
-            if not parent_tree:
-                roots.append(tree)
-        trees[task] = tree
-        return tree
-
+    placed = set()
     for task in tasks:
-        fetch_tree(task.identifier())
-    output = []
-    for root in roots:
-        if not inverted:
-            root.pre_order(output)
+        chain = []
+        identifier = task.identifier()
+        while (identifier in index and not identifier in placed and
+               index[identifier].hierarchy_level() >= min_task_level):
+            placed.add(identifier)
+            chain.append(identifier)
+            identifier = index[identifier].parent_task_identifier()
+        # The chain ends at a task that is already in the forest, or
+        # its top task becomes a root. A parent that is in the chain
+        # itself is a cycle in the hierarchy.
+        if identifier in placed and not identifier in chain:
+            siblings = children.setdefault(identifier, [])
         else:
-            root.post_order(output)
+            siblings = roots
+        for identifier in reversed(chain):
+            siblings.append(identifier)
+            siblings = children.setdefault(identifier, [])
+
+    # Traverse the forest without recursion. For the post-order, the
+    # forest is traversed in pre-order with the children in reversed
+    # order, and the result is reversed.
+    output = []
+    if not inverted:
+        stack = list(reversed(roots))
+        while stack:
+            identifier = stack.pop()
+            output.append(index[identifier])
+            stack.extend(reversed(children[identifier]))
+    else:
+        stack = list(roots)
+        while stack:
+            identifier = stack.pop()
+            output.append(index[identifier])
+            stack.extend(children[identifier])
+        output.reverse()
     return output
 
+
+def _fetch_missing_ancestors(index, domain_identifier, min_task_level):
+    """
+    Adds the ancestors of the tasks in |index| that are missing from
+    it, down from |min_task_level|. The ancestors are fetched in a
+    single batch get, using the hierarchies in the TaskIndexes of the
+    tasks with a missing parent. Only if an index is missing or not up
+    to date, more batches are needed, one for each level.
+
+    Args:
+        index: A dictionary of Task model instances by identifier,
+            which is updated in place.
+        domain_identifier: The domain identifier string
+        min_task_level: The minimum level of the fetched ancestors.
+    """
+    def missing_parents():
+        return set(task.parent_task_identifier()
+                   for task in index.itervalues()
+                   if task.parent_task_identifier() and
+                   not task.parent_task_identifier() in index and
+                   task.hierarchy_level() > min_task_level)
+
+    identifiers = missing_parents()
+    orphans = [task for task in index.itervalues()
+               if task.parent_task_identifier() in identifiers]
+    task_indexes = caching.get([TaskIndex.key_from_task_key(task.key())
+                                for task in orphans])
+    for task_index in task_indexes:
+        if task_index:
+            identifiers.update(
+                identifier
+                for level, identifier in enumerate(task_index.hierarchy)
+                if level >= min_task_level and not identifier in index)
+    tried = set()
+    while identifiers:
+        tried.update(identifiers)
+        keys = [Task.key_from_identifier(domain_identifier, identifier)
+                for identifier in identifiers]
+        for task in caching.get(keys):
+            if task:
+                index[task.identifier()] = task
+        identifiers = missing_parents() - tried
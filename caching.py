@@ -0,0 +1,203 @@
+#  Copyright 2011 Tijmen Roberti
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+A memcache read-through cache for datastore entities, used for the
+Task, TaskIndex, Domain, User, SearchTerm, Inbox and DomainStatistics
+models.
+
+Entities are stored in memcache as encoded protocol buffers, under a
+key that contains CACHE_VERSION. Every write path must invalidate the
+entities it changes, either by using put() from this module or by
+calling invalidate().
+
+Inside a transaction the cache is always bypassed, so transactions
+keep their strongly consistent view on the datastore.
+
+Entities can also be fetched asynchronously with get_async(), so
+independent lookups can be made concurrently.
+"""
+import logging
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+# Version of the cache entries. Increasing the version invalidates
+# all cached entities, which is required after a change in the
+# models.
+CACHE_VERSION = 3
+# Number of seconds an entity is kept in the cache.
+CACHE_TIME = 3600
+# Number of seconds an invalidated key cannot be added to the cache
+# again. This prevents a reader from caching a value it read just
+# before the write was committed.
+LOCK_TIME = 10
+# Set to False to disable the cache completely.
+ENABLED = True
+
+
+def _cache_key(key):
+    """Returns the memcache key of the entity with the datastore |key|."""
+    return 'entity:%d:%s' % (CACHE_VERSION, key)
+
+
+def _encode(entity):
+    return db.model_to_protobuf(entity).Encode()
+
+
+def _decode(value):
+    return db.model_from_protobuf(entity_pb.EntityProto(value))
+
+
+def get(keys, use_cache=True):
+    """
+    Fetches the entities with the given keys, from memcache if
+    possible. Entities that are not in memcache are fetched from the
+    datastore in a single batch get, and added to memcache.
+
+    The cache is bypassed if called inside a transaction.
+
+    Args:
+        keys: A db.Key instance or a list of db.Key instances.
+        use_cache: If set to False, the cache is bypassed.
+
+    Returns:
+        A model instance or None if |keys| is a single key, otherwise
+        a list with a model instance or None for each key.
+    """
+    if not ENABLED or not use_cache or db.is_in_transaction():
+        return db.get(keys)
+    multiple = isinstance(keys, (list, tuple))
+    if not multiple:
+        keys = [keys]
+    if not keys:
+        return []
+
+    cached = memcache.get_multi([_cache_key(key) for key in keys])
+    results = _complete(keys, cached)
+    return results if multiple else results[0]
+
+
+def _complete(keys, cached):
+    """
+    Returns a list with the entity for each key, decoded from the
+    |cached| dictionary as returned by memcache. The entities that are
+    not cached are fetched from the datastore in a single batch get,
+    and added to memcache.
+    """
+    results = []
+    missing = []
+    for key in keys:
+        value = cached.get(_cache_key(key))
+        entity = None
+        if value is not None:
+            try:
+                entity = _decode(value)
+            except Exception:
+                logging.warning("Could not decode cached entity %s", key)
+        if entity is None:
+            missing.append(key)
+        results.append(entity)
+
+    if missing:
+        fetched = dict(zip(missing, db.get(missing)))
+        memcache.add_multi(dict((_cache_key(key), _encode(entity))
+                                for key, entity in fetched.iteritems()
+                                if entity),
+                           time=CACHE_TIME)
+        results = [entity if entity is not None else fetched[key]
+                   for key, entity in zip(keys, results)]
+    return results
+
+
+class _GetFuture(object):
+    """
+    The future returned by get_async(). The memcache lookup is started
+    when the future is created, and the entities that are not in
+    memcache are fetched from the datastore when the result is
+    requested.
+    """
+    def __init__(self, keys, multiple):
+        self._keys = keys
+        self._multiple = multiple
+        self._rpc = None
+        self._results = []
+        if keys:
+            self._rpc = memcache.Client().get_multi_async(
+                [_cache_key(key) for key in keys])
+
+    def get_result(self):
+        """
+        Waits for the lookup to complete and returns the entities, as
+        get().
+        """
+        if self._rpc:
+            self._results = _complete(self._keys, self._rpc.get_result())
+            self._rpc = None
+        return self._results if self._multiple else self._results[0]
+
+
+def get_async(keys, use_cache=True):
+    """
+    Starts fetching the entities with the given keys, from memcache if
+    possible, without waiting for the result.
+
+    Args:
+        keys: A db.Key instance or a list of db.Key instances.
+        use_cache: If set to False, the cache is bypassed.
+
+    Returns:
+        A future with a get_result() method, that returns the same
+        result as get().
+    """
+    if not ENABLED or not use_cache or db.is_in_transaction():
+        return db.get_async(keys)
+    multiple = isinstance(keys, (list, tuple))
+    return _GetFuture(keys if multiple else [keys], multiple)
+
+
+def invalidate(keys):
+    """
+    Removes the entities with the given keys from the cache.
+
+    This function can be called inside a transaction, before it is
+    committed, as the invalidated keys cannot be added to the cache
+    for LOCK_TIME seconds.
+
+    Args:
+        keys: A db.Key instance or a list of db.Key instances.
+    """
+    if not ENABLED:
+        return
+    if not isinstance(keys, (list, tuple)):
+        keys = [keys]
+    if keys:
+        memcache.delete_multi([_cache_key(key) for key in keys],
+                              seconds=LOCK_TIME)
+
+
+def put(models):
+    """
+    Stores the model instances in the datastore and invalidates them
+    in the cache.
+
+    Args:
+        models: A model instance or a list of model instances.
+
+    Returns:
+        The key or list of keys of the stored instances, as db.put().
+    """
+    keys = db.put(models)
+    invalidate(keys)
+    return keys
@@ -0,0 +1,395 @@
+#  Copyright 2011 Tijmen Roberti
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+A JSON api over the functions in api.py, served under /api/v1/.
+
+All urls are relative to /api/v1/domains/<domain>:
+  GET  /tasks              A page of a task list. Parameters: view
+                           (all, open or yours), task (the parent task,
+                           optional), limit and cursor.
+  POST /tasks              Creates a task. Parameters: description,
+                           parent (optional), assign_to_self (optional).
+  GET  /statistics         The number of tasks in the domain, see
+                           api.get_domain_statistics().
+  GET  /tasks/<task>       A single task.
+  GET  /tasks/<task>/subtree  All the tasks in the subtree of the task,
+                           in pre-order. Parameters: depth (optional).
+  GET  /tasks/<task>/log   The events in the log of the task, from new
+                           to old. Parameters: page (optional), see
+                           api.get_task_log().
+  POST /tasks/<task>/completed    Parameter: completed (true or false).
+  POST /tasks/<task>/assignee     Parameter: assignee (user identifier).
+  POST /tasks/<task>/description  Parameter: description.
+  POST /tasks/<task>/parent       Parameter: parent (empty for none).
+
+All requests that return tasks accept a |fields| parameter with a
+comma separated list of the fields of each task, see TASK_FIELDS. If
+all requested fields can be read from the TaskIndex, the task lists
+are built without fetching the tasks themselves.
+
+Errors are returned as an object with an 'error' field.
+"""
+import json
+import webapp2
+import api
+
+# Default and maximum number of tasks in a page of a task list.
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def _task_time(task):
+    return task.time.isoformat() if task.time else None
+
+
+# The fields of a task in the responses. Each field maps to a function
+# that returns the value of the field for a Task or TaskTreeNode and
+# the user making the request.
+TASK_FIELDS = {
+    'id': lambda task, user: task.identifier(),
+    'title': lambda task, user: task.title(),
+    'description': lambda task, user: task.description,
+    'parent_task': lambda task, user: task.parent_task_identifier(),
+    'user': lambda task, user: task.user_identifier(),
+    'assignee': lambda task, user: task.assignee_identifier(),
+    'time': lambda task, user: _task_time(task),
+    'completed': lambda task, user: task.completed,
+    'atomic': lambda task, user: task.atomic(),
+    'derived_completed': lambda task, user: task.is_completed(),
+    'derived_has_open_tasks': lambda task, user: task.has_open_tasks(),
+    'derived_size': lambda task, user: task.derived_size,
+    'derived_atomic_task_count': lambda task, user: task.atomic_task_count(),
+    'derived_level': lambda task, user: task.hierarchy_level(),
+    'derived_assignees': lambda task, user: task.derived_assignees.keys(),
+    'active': lambda task, user: task.is_active(user.identifier()),
+    'summary': lambda task, user: task.personalized_summary(
+        user.identifier()),
+    }
+
+# The fields that can be read from the TaskIndex of a task, as
+# functions of the index and the user making the request.
+INDEX_FIELDS = {
+    'id': lambda index, user: index.key().name(),
+    'parent_task': lambda index, user: (index.hierarchy[-1]
+                                        if index.hierarchy else None),
+    'atomic': lambda index, user: index.atomic,
+    'derived_completed': lambda index, user: index.completed,
+    'derived_has_open_tasks': lambda index, user: index.has_open_tasks,
+    'derived_level': lambda index, user: index.level,
+    'derived_assignees': lambda index, user: index.assignees,
+    'active': lambda index, user: (user.identifier()
+                                   in index.active_assignees),
+    }
+
+# The fields that are not stored in the task tree snapshot.
+SNAPSHOT_MISSING_FIELDS = set(['description', 'user', 'completed'])
+
+DEFAULT_FIELDS = ['id', 'title', 'parent_task', 'assignee',
+                  'derived_completed', 'atomic']
+
+
+class JsonHandler(webapp2.RequestHandler):
+    """
+    Base class of the handlers of the JSON api. Validates the user
+    and parses the requested fields.
+    """
+    def write_json(self, value):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(value, separators=(',', ':')))
+
+    def fail(self, status, message):
+        """Writes an error response with the given status code."""
+        self.response.set_status(status)
+        self.write_json({ 'error': message })
+
+    def get_user(self, domain_identifier):
+        """
+        Returns the logged in user if it is a member of the domain.
+        Otherwise writes an error response and returns None.
+        """
+        user = api.get_and_validate_user(domain_identifier)
+        if not user:
+            self.fail(403, "Not a member of domain '%s'" % domain_identifier)
+        return user
+
+    def get_fields(self):
+        """
+        Returns the list of task fields requested through the |fields|
+        parameter. Writes an error response and returns None if a
+        field is unknown.
+        """
+        fields = self.request.get('fields')
+        if not fields:
+            return DEFAULT_FIELDS
+        fields = [field.strip() for field in fields.split(',')]
+        unknown = [field for field in fields if not field in TASK_FIELDS]
+        if unknown:
+            self.fail(400, "Unknown fields: %s" % ', '.join(unknown))
+            return None
+        return fields
+
+    def get_task(self, domain_identifier, task_identifier):
+        """
+        Returns the task with the given identifier. Writes an error
+        response and returns None if the task does not exist.
+        """
+        task = api.get_task(domain_identifier, task_identifier)
+        if not task:
+            self.fail(404, "Task '%s' does not exist" % task_identifier)
+        return task
+
+
+def _task_values(task, user, fields):
+    """Returns a dictionary with the requested |fields| of |task|."""
+    return dict((field, TASK_FIELDS[field](task, user)) for field in fields)
+
+
+def _index_values(index, user, fields):
+    """
+    Returns a dictionary with the requested |fields| of the task of a
+    TaskIndex. All fields must be in INDEX_FIELDS.
+    """
+    return dict((field, INDEX_FIELDS[field](index, user)) for field in fields)
+
+
+class TaskList(JsonHandler):
+    """
+    Returns a page of a task list, or creates a new task.
+    """
+    def get(self, domain_identifier):
+        user = self.get_user(domain_identifier)
+        if not user:
+            return
+        fields = self.get_fields()
+        if not fields:
+            return
+        view = self.request.get('view', 'all')
+        task_identifier = self.request.get('task') or None
+        cursor = self.request.get('cursor') or None
+        try:
+            limit = int(self.request.get('limit', PAGE_SIZE))
+        except ValueError:
+            self.fail(400, "Invalid limit")
+            return
+        limit = min(limit, MAX_PAGE_SIZE)
+
+        task = None
+        if task_identifier:
+            task = self.get_task(domain_identifier, task_identifier)
+            if not task:
+                return
+        indexes_only = all(field in INDEX_FIELDS for field in fields)
+        try:
+            if view == 'yours':
+                results, next_cursor = api.get_assigned_tasks(
+                    domain_identifier,
+                    user,
+                    root_task=task,
+                    limit=limit,
+                    cursor=cursor,
+                    indexes_only=indexes_only)
+            elif view == 'open':
+                results, next_cursor = api.get_open_tasks(
+                    domain_identifier,
+                    root_task=task,
+                    limit=limit,
+                    cursor=cursor,
+                    indexes_only=indexes_only)
+            elif view == 'all':
+                indexes_only = False
+                task_tree = None
+                if (not SNAPSHOT_MISSING_FIELDS.intersection(fields) and
+                    (not cursor or api.is_task_tree_cursor(cursor))):
+                    task_tree = api.get_task_tree(domain_identifier)
+                if task_tree:
+                    results, next_cursor = \
+                        api.get_all_direct_subtasks_from_tree(
+                            task_tree,
+                            root_task_identifier=task_identifier,
+                            limit=limit,
+                            user_identifier=user.identifier(),
+                            cursor=cursor)
+                else:
+                    results, next_cursor = api.get_all_direct_subtasks(
+                        domain_identifier,
+                        root_task=task,
+                        limit=limit,
+                        user_identifier=user.identifier(),
+                        cursor=cursor)
+            else:
+                self.fail(400, "Unknown view '%s'" % view)
+                return
+        except ValueError, error:
+            self.fail(400, str(error))
+            return
+
+        values = _index_values if indexes_only else _task_values
+        self.write_json({
+                'tasks': [values(result, user, fields) for result in results],
+                'cursor': next_cursor })
+
+    def post(self, domain_identifier):
+        user = self.get_user(domain_identifier)
+        if not user:
+            return
+        fields = self.get_fields()
+        if not fields:
+            return
+        try:
+            task = api.create_task(
+                domain_identifier,
+                user,
+                self.request.get('description'),
+                assignee=user if self.request.get('assign_to_self') else None,
+                parent_task_identifier=self.request.get('parent') or None)
+        except ValueError, error:
+            self.fail(400, str(error))
+            return
+        self.response.set_status(201)
+        self.write_json(_task_values(task, user, fields))
+
+
+class TaskDetail(JsonHandler):
+    """
+    Returns a single task.
+    """
+    def get(self, domain_identifier, task_identifier):
+        user = self.get_user(domain_identifier)
+        if not user:
+            return
+        fields = self.get_fields()
+        if not fields:
+            return
+        task = self.get_task(domain_identifier, task_identifier)
+        if task:
+            self.write_json(_task_values(task, user, fields))
+
+
+class TaskSubtree(JsonHandler):
+    """
+    Returns all the tasks in the subtree of a task, in pre-order.
+    """
+    def get(self, domain_identifier, task_identifier):
+        user = self.get_user(domain_identifier)
+        if not user:
+            return
+        fields = self.get_fields()
+        if not fields:
+            return
+        task = self.get_task(domain_identifier, task_identifier)
+        if not task:
+            return
+        try:
+            depth = self.request.get('depth')
+            tasks = api.get_subtree(domain_identifier,
+                                    root_task=task,
+                                    depth=int(depth) if depth else None,
+                                    user_identifier=user.identifier())
+        except ValueError, error:
+            self.fail(400, str(error))
+            return
+        self.write_json({ 'tasks': [_task_values(subtask, user, fields)
+                                    for subtask in tasks] })
+
+
+class TaskLog(JsonHandler):
+    """
+    Returns the events in the log of the mutations of a task.
+    """
+    def get(self, domain_identifier, task_identifier):
+        if not self.get_user(domain_identifier):
+            return
+        task = self.get_task(domain_identifier, task_identifier)
+        if not task:
+            return
+        try:
+            page = self.request.get('page')
+            events, previous_page = api.get_task_log(
+                task, page=int(page) if page else None)
+        except ValueError, error:
+            self.fail(400, str(error))
+            return
+        self.write_json({ 'events': events, 'page': previous_page })
+
+
+class DomainStatistics(JsonHandler):
+    """
+    Returns the statistics of all the tasks of the domain.
+    """
+    def get(self, domain_identifier):
+        if not self.get_user(domain_identifier):
+            return
+        domain = api.get_domain(domain_identifier)
+        self.write_json(api.get_domain_statistics([domain])[0])
+
+
+class TaskMutation(JsonHandler):
+    """
+    Changes a single property of a task, and returns the changed task.
+    """
+    def post(self, domain_identifier, task_identifier, property):
+        user = self.get_user(domain_identifier)
+        if not user:
+            return
+        fields = self.get_fields()
+        if not fields:
+            return
+        request = self.request
+        try:
+            if property == 'completed':
+                task = api.set_task_completed(
+                    domain_identifier,
+                    user,
+                    task_identifier,
+                    request.get('completed') == 'true')
+            elif property == 'assignee':
+                assignee = api.get_user(request.get('assignee'))
+                if not assignee:
+                    self.fail(400, "Unknown assignee")
+                    return
+                task = api.assign_task(domain_identifier,
+                                       task_identifier,
+                                       user,
+                                       assignee)
+            elif property == 'description':
+                task = api.change_task_description(
+                    domain_identifier,
+                    task_identifier,
+                    request.get('description'),
+                    user)
+            else:               # property == 'parent'
+                task = api.change_task_parent(
+                    domain_identifier,
+                    user,
+                    task_identifier,
+                    request.get('parent') or None)
+        except ValueError, error:
+            self.fail(400, str(error))
+            return
+        self.write_json(_task_values(task, user, fields))
+
+
+_DOMAIN_URL = '/api/v1/domains/(%s)' % api.VALID_DOMAIN_IDENTIFIER
+_TASK_URL = '%s/tasks/([a-z0-9-]{1,100})' % _DOMAIN_URL
+
+application = webapp2.WSGIApplication([
+        (_DOMAIN_URL + '/statistics/?', DomainStatistics),
+        (_DOMAIN_URL + '/tasks/?', TaskList),
+        (_TASK_URL + '/(completed|assignee|description|parent)/?',
+         TaskMutation),
+        (_TASK_URL + '/subtree/?', TaskSubtree),
+        (_TASK_URL + '/log/?', TaskLog),
+        (_TASK_URL + '/?', TaskDetail),
+        ])
@@ -13,13 +13,29 @@
 #  limitations under the License.
 
 import os
+import json
+import hashlib
 import logging
+import datetime
 import webapp2
 from webapp2_extras import jinja2
 from google.appengine.ext import db
+from google.appengine.api import memcache
 from appengine_utilities.sessions import Session
+from mapreduce.lib.graphy.backends import google_chart_api
 from model import Task, Context, Domain, User
+from model import prefetch_references_async
 import api
+import caching
+
+# Number of tasks in a page of a task list. Further pages are loaded
+# on demand through GetSubTasks.
+PAGE_SIZE = 100
+# Number of seconds a rendered task row is kept in memcache.
+ROW_CACHE_TIME = 3600
+# Maximum number of points of a line in a burndown chart, which keeps
+# the url of the chart short enough.
+MAX_CHART_POINTS = 200
 
 
 def add_message(session, message):
@@ -50,7 +66,7 @@ def get_and_delete_messages(session):
     return messages
 
 
-def _task_template_values(tasks, user, level=0):
+def _task_template_values(tasks, user, names, level=0):
     """
     Returns a list of dictionaries containing the template values for
     each task.
@@ -58,6 +74,8 @@ def _task_template_values(tasks, user, level=0):
     Args:
         tasks: A list of Task model instance
         user: A User model instance
+        names: A dictionary with the names of the assignees of the
+            tasks, as returned by api.get_assignee_names().
 
     Returns a list of dictionaries for each task, in the same order.
     """
@@ -68,7 +86,7 @@ def _task_template_values(tasks, user, level=0):
               'completed': task.is_completed(),
               'is_assigned': task.assignee_key() != None,
               'can_assign_to_self': api.can_assign_to_self(task, user),
-              'assignee_description': task.assignee_description(),
+              'assignee_description': task.assignee_description(names),
               'can_complete': api.can_complete_task(task, user),
               'summary': task.personalized_summary(user_identifier),
               'remaining': task.subtasks_remaining(user_identifier),
@@ -78,6 +96,73 @@ def _task_template_values(tasks, user, level=0):
             for task in tasks]
 
 
+def _task_row_cache_key(task, user, view, level, filename, names_revision):
+    """
+    Returns the memcache key of the row of |task| rendered with the
+    template |filename| for |user|, or None if the row cannot be
+    cached because the version of the task is not known.
+
+    The version of the task is increased on every change that affects
+    the row, and the |names_revision| of the AssigneeNames table of
+    the domain on every change of the name of an assignee, so rows
+    never have to be invalidated.
+    """
+    if task.version is None:
+        return None
+    return 'row:%d:%s:%s:%d:%d:%s:%s:%d:%s' % (caching.CACHE_VERSION,
+                                               task.domain_identifier(),
+                                               task.identifier(),
+                                               task.version,
+                                               names_revision,
+                                               user.identifier(),
+                                               view,
+                                               min(level, 3),
+                                               filename)
+
+
+def _progress_chart_url(samples, width=600, height=300):
+    """
+    Returns the url of a burndown chart of progress samples, rendered
+    by the Google Chart API through graphy. The chart shows the number
+    of atomic tasks and the number of remaining atomic tasks over
+    time, with the last known counts at equally spaced points.
+
+    Args:
+        samples: A non-empty list of (hour, completed, atomic) tuples,
+            as returned by api.get_progress_samples().
+        width: The width of the chart in pixels
+        height: The height of the chart in pixels
+    """
+    first = samples[0][0]
+    last = samples[-1][0]
+    step = (last - first) // MAX_CHART_POINTS + 1
+    hours = range(first, last + 1, step)
+    if hours[-1] != last:
+        hours.append(last)
+    totals = []
+    remaining = []
+    position = 0
+    completed = atomic = 0
+    for hour in hours:
+        while position < len(samples) and samples[position][0] <= hour:
+            sample_hour, completed, atomic = samples[position]
+            position += 1
+        totals.append(atomic)
+        remaining.append(atomic - completed)
+
+    chart = google_chart_api.LineChart()
+    chart.AddLine(totals, label='All tasks', color='999999')
+    chart.AddLine(remaining, label='Remaining tasks', color='0066cc')
+    chart.left.min = 0
+    chart.left.max = max(max(totals), 1)
+    chart.left.labels = ['0', str(chart.left.max)]
+    chart.bottom.labels = [
+        datetime.datetime.utcfromtimestamp(hour * 3600).strftime(
+            '%Y-%m-%d %H:00')
+        for hour in [first, last]]
+    return chart.display.Url(width, height)
+
+
 class BaseHandler(webapp2.RequestHandler):
     @webapp2.cached_property
     def jinja2(self):
@@ -99,6 +184,95 @@ class BaseHandler(webapp2.RequestHandler):
                 filename,
                 **template_args))
 
+    def not_modified(self, domain_identifier, user, view):
+        """
+        Sets the ETag of the response, which is derived from the
+        modification counter of the domain, the user and the view
+        mode. Must be called before any data of the response is read.
+
+        Args:
+            domain_identifier: The domain identifier string
+            user: A User model instance
+            view: The view mode of the response
+
+        Returns:
+            True if the client already has the current version of the
+            response, in which case the status is set to 304 Not
+            Modified and nothing else must be written.
+        """
+        counter = api.get_modification_counter(domain_identifier)
+        if counter is None:
+            return False
+        etag = hashlib.sha1('%s:%d:%s:%s' % (
+                os.environ.get('CURRENT_VERSION_ID', ''),
+                counter,
+                user.identifier(),
+                view)).hexdigest()
+        self.response.headers['ETag'] = '"%s"' % etag
+        self.response.headers['Cache-Control'] = 'private, no-cache'
+        tags = [tag.strip().replace('W/', '', 1).strip('"') for tag
+                in self.request.headers.get('If-None-Match', '').split(',')]
+        if etag in tags:
+            self.response.set_status(304)
+            return True
+        return False
+
+    def render_task_rows(self, filename, tasks, user, domain_identifier,
+                         view, level=0, levels=None):
+        """
+        Renders a row for each task with the template |filename|. The
+        rows are read from memcache if possible, and only the missing
+        rows are rendered and added to memcache.
+
+        Args:
+            filename: filename of the row template
+            tasks: A list of Task or TaskTreeNode instances
+            user: A User model instance
+            domain_identifier: The domain identifier string
+            view: The view mode of the task list
+            level: The level of the tasks in the interface
+            levels: Optional list with the level of each task in the
+                interface, which overrides |level|.
+
+        Returns:
+            A list of strings with the rendered rows, in the same
+            order as the tasks.
+        """
+        if levels is None:
+            levels = [level] * len(tasks)
+        cached = {}
+        names_revision = api.get_assignee_names_revision(domain_identifier)
+        keys = [_task_row_cache_key(task, user, view, level, filename,
+                                    names_revision)
+                for task, level in zip(tasks, levels)]
+        if caching.ENABLED:
+            cached = memcache.get_multi([key for key in keys if key])
+        missing = [(task, level)
+                   for task, level, key in zip(tasks, levels, keys)
+                   if not key in cached]
+        rendered = {}
+        if missing:
+            names = api.get_assignee_names(domain_identifier,
+                                           [task for task, level in missing])
+            for task, level in missing:
+                values = _task_template_values([task], user, names,
+                                               level=level)[0]
+                rendered[values['id']] = self.jinja2.render_template(
+                    filename,
+                    task=values,
+                    view_mode=view,
+                    domain_identifier=domain_identifier,
+                    user_identifier=user.identifier())
+            if caching.ENABLED:
+                memcache.set_multi(
+                    dict((key, rendered[task.identifier()])
+                         for task, key in zip(tasks, keys)
+                         if key and not key in cached),
+                    time=ROW_CACHE_TIME)
+        return [cached[key] if key in cached
+                else rendered[task.identifier()]
+                for task, key in zip(tasks, keys)]
+
 class Landing(BaseHandler):
     """
     The main landing page. Shows the users domains and links to them.
@@ -106,13 +280,22 @@ class Landing(BaseHandler):
     def get(self):
         user = api.get_logged_in_user()
         domains = api.get_all_domains_for_user(user)
+        statistics = api.get_domain_statistics(domains)
+        inbox, inbox_truncated = api.get_inbox(user)
         session = Session(writer='cookie',
                           wsgiref_headers=self.response.headers)
         template_values = {
             'username' : user.name,
             'domains' : [{ 'identifier': domain.identifier(),
-                           'name': domain.name }
-                         for domain in domains],
+                           'name': domain.name,
+                           'atomic': domain_statistics['atomic'],
+                           'completed': domain_statistics['completed'] }
+                         for domain, domain_statistics
+                         in zip(domains, statistics)],
+            'domain_names': dict((domain.identifier(), domain.name)
+                                 for domain in domains),
+            'inbox': inbox,
+            'inbox_truncated': inbox_truncated,
             'messages': get_and_delete_messages(session),
             }
         self.render_template('landing.html', **template_values)
@@ -127,52 +310,77 @@ class TaskDetail(BaseHandler):
     """
     def get(self, *args):
         domain_identifier = args[0]
-        user = api.get_and_validate_user(domain_identifier)
+        task_identifier = args[1] if len(args) > 1 else None
+        # The independent lookups are made concurrently.
+        user_future = api.get_and_validate_user_async(domain_identifier)
+        task_future = api.get_task_async(domain_identifier, task_identifier)
+        domain_future = api.get_domain_async(domain_identifier)
+        user = user_future.get_result()
         if not user:
             self.abort(404)
-
-        task_identifier = args[1] if len(args) > 1 else None
-        if task_identifier:
-            task = api.get_task(domain_identifier, task_identifier)
-            if not task:
-                self.abort(404)
-        else:
-            task = None         # No task specified
         view = self.request.get('view', 'all')
         session = Session(writer='cookie',
                           wsgiref_headers=self.response.headers)
+        # Pages with messages are always rendered, as the messages
+        # are only shown once.
+        if (not 'messages' in session and
+            self.not_modified(domain_identifier, user, view)):
+            return
 
-        domain = api.get_domain(domain_identifier)
+        task = task_future.get_result() # None if no task is specified
+        if task_identifier and not task:
+            self.abort(404)
+        # The creator and the parent task are fetched in a single
+        # batch, while the subtasks are queried.
+        references_future = prefetch_references_async([task], 'user',
+                                                      'parent_task')
+
+        domain = domain_future.get_result()
+        # Further pages are fetched through GetSubTasks.
         if view == 'yours':
-            subtasks = api.get_assigned_tasks(domain_identifier,
-                                              user,
-                                              root_task=task,
-                                              limit=500)
+            subtasks, next_cursor = api.get_assigned_tasks(domain_identifier,
+                                                           user,
+                                                           root_task=task,
+                                                           limit=PAGE_SIZE)
             no_tasks_description = "No tasks are assigned to you."
         elif view == 'open':
-            subtasks = api.get_open_tasks(domain_identifier,
-                                          root_task=task,
-                                          limit=500)
+            subtasks, next_cursor = api.get_open_tasks(domain_identifier,
+                                                       root_task=task,
+                                                       limit=PAGE_SIZE)
             no_tasks_description = "No open tasks for this task."
         else:                   # view == 'all' or None
             view = 'all'
             user_id = user.identifier()
-            subtasks = api.get_all_direct_subtasks(domain_identifier,
-                                                   root_task=task,
-                                                   limit=500,
-                                                   user_identifier=user_id)
+            task_tree = api.get_task_tree(domain_identifier)
+            if task_tree:
+                subtasks, next_cursor = api.get_all_direct_subtasks_from_tree(
+                    task_tree,
+                    root_task_identifier=task_identifier,
+                    limit=PAGE_SIZE,
+                    user_identifier=user_id)
+            else:
+                subtasks, next_cursor = api.get_all_direct_subtasks(
+                    domain_identifier,
+                    root_task=task,
+                    limit=PAGE_SIZE,
+                    user_identifier=user_id)
             no_tasks_description = "No subtasks for this task."
 
-        parent_task = task.parent_task if task else None
+        referenced = references_future.get_result()
+        parent_task = None
+        if task and task.parent_task_key():
+            parent_task = referenced.get(task.parent_task_key())
         parent_identifier = parent_task.identifier() if parent_task else ""
         parent_title = parent_task.title() if parent_task else ""
 
+        names = api.get_assignee_names(domain_identifier, [task])
         if task:
+            creator = referenced.get(task.user_key())
             task_values = {
                 'task_title' : task.title(),
                 'task_description': task.description_body(),
-                'task_assignee': task.assignee_description(),
-                'task_creator': task.user_name(),
+                'task_assignee': task.assignee_description(names),
+                'task_creator': creator.name if creator else "",
                 'task_identifier': task.identifier(),
                 'task_has_subtasks': not task.atomic(),
                 'task_can_assign_to_self': api.can_assign_to_self(task, user),
@@ -190,12 +398,21 @@ class TaskDetail(BaseHandler):
             'user_name': user.name,
             'user_identifier': user.identifier(),
             'messages': get_and_delete_messages(session),
-            'subtasks': _task_template_values(subtasks, user),
+            'subtask_rows': self.render_task_rows('task-row.html',
+                                                  subtasks,
+                                                  user,
+                                                  domain_identifier,
+                                                  view),
             'task_identifier': task_identifier, # None if no task is selected
             'parent_identifier': parent_identifier,
             'parent_title': parent_title,
             'no_tasks_description': no_tasks_description,
             'base_url': base_url,
+            'next_cursor': next_cursor,
+            'more_task': task_identifier or "",
+            'more_level': -1,
+            'progress_url': (base_url + '/progress'
+                             if not task or task.root() else None),
             }
         template_values.update(task_values)
         self.render_template('taskdetail.html', **template_values)
@@ -215,6 +432,12 @@ class GetSubTasks(BaseHandler):
            rendering.
         radio: If true, shows radio buttons instead of checkboxes next
            to tasks. Used in the move UI.
+        cursor: Optional cursor of the page of subtasks, as returned
+           with the previous page.
+        group: Optional string encoded key of the entity group of
+           the root tasks, if no task is given. Used in the move UI,
+           which only lists the tasks in the entity group of the
+           moved task.
     """
     def get(self):
         try:
@@ -223,44 +446,244 @@ class GetSubTasks(BaseHandler):
             view = self.request.get('view')
             level = int(self.request.get('level', 0))
             show_radio_buttons = bool(self.request.get('radio', False))
-        except (ValueError,TypeError):
+            cursor = self.request.get('cursor') or None
+            group_key = None
+            if self.request.get('group'):
+                group_key = db.Key(self.request.get('group'))
+                if (Domain.identifier_from_group_key(group_key) !=
+                    domain_identifier):
+                    raise ValueError("Group of another domain")
+        except (ValueError, TypeError, db.BadKeyError):
             self.error(400)
             return
-        user = api.get_and_validate_user(domain_identifier)
+        # The independent lookups are made concurrently. The task is
+        # not needed if the subtasks are served from the snapshot.
+        use_task_tree = (view not in ('yours', 'open') and
+                         api.is_task_tree_cursor(cursor))
+        user_future = api.get_and_validate_user_async(domain_identifier)
+        domain_future = api.get_domain_async(domain_identifier)
+        task_future = None
+        if not use_task_tree:
+            task_future = api.get_task_async(domain_identifier,
+                                             task_identifier)
+        user = user_future.get_result()
         if not user:
             self.error(403)
             return
+        if self.not_modified(domain_identifier, user, view):
+            return
 
-        domain = api.get_domain(domain_identifier)
-        task = api.get_task(domain_identifier, task_identifier)
-        if view == 'yours':
-            tasks = api.get_assigned_tasks(domain_identifier,
-                                           user,
-                                           root_task=task,
-                                           limit=200)
-        elif view == 'open':
-            tasks = api.get_open_tasks(domain_identifier,
-                                       root_task=task,
-                                       limit=200)
-        else:                   # view == 'all' or None
-            view = 'all'
-            user_id = user.identifier()
-            tasks = api.get_all_direct_subtasks(domain_identifier,
-                                                root_task=task,
-                                                limit=200,
-                                                user_identifier=user_id)
+        domain = domain_future.get_result()
+        task_tree = None
+        if use_task_tree:
+            task_tree = api.get_task_tree(domain_identifier)
+        try:
+            if task_tree:
+                # The subtasks are served from the snapshot, without
+                # fetching the task itself.
+                view = 'all'
+                tasks, next_cursor = api.get_all_direct_subtasks_from_tree(
+                    task_tree,
+                    root_task_identifier=task_identifier or None,
+                    limit=PAGE_SIZE,
+                    user_identifier=user.identifier(),
+                    cursor=cursor)
+            else:
+                if task_future:
+                    task = task_future.get_result()
+                else:
+                    task = api.get_task(domain_identifier, task_identifier)
+                if view == 'yours':
+                    tasks, next_cursor = api.get_assigned_tasks(
+                        domain_identifier,
+                        user,
+                        root_task=task,
+                        limit=PAGE_SIZE,
+                        cursor=cursor)
+                elif view == 'open':
+                    tasks, next_cursor = api.get_open_tasks(
+                        domain_identifier,
+                        root_task=task,
+                        limit=PAGE_SIZE,
+                        cursor=cursor)
+                else:                   # view == 'all' or None
+                    view = 'all'
+                    tasks, next_cursor = api.get_all_direct_subtasks(
+                        domain_identifier,
+                        root_task=task,
+                        limit=PAGE_SIZE,
+                        user_identifier=user.identifier(),
+                        cursor=cursor,
+                        group_key=group_key)
+        except ValueError:      # Invalid cursor
+            self.error(400)
+            return
+        if show_radio_buttons:
+            row_template = 'task-row-radio.html'
+        else:
+            row_template = 'task-row.html'
         template_values = {
             'domain_name': domain.name,
             'domain_identifier': domain_identifier,
             'user_name': user.name,
             'user_identifier': user.identifier(),
-            'tasks': _task_template_values(tasks, user, level=level+1),
+            'task_rows': self.render_task_rows(row_template,
+                                               tasks,
+                                               user,
+                                               domain_identifier,
+                                               view,
+                                               level=level+1),
             'view_mode': view,
             'show_radio_buttons': show_radio_buttons,
+            'next_cursor': next_cursor,
+            'more_task': task_identifier,
+            'more_level': level,
+            }
+        self.render_template('get-subtasks.html', **template_values)
+
+
+class GetSubTree(BaseHandler):
+    """
+    Handler for AJAX-requests to retrieve the entire subtree of a
+    task in a single request. The returned output are html rows used
+    in the task tables, in pre-order, so the subtree is shown fully
+    expanded.
+
+    The handler takes the following GET parameters:
+        domain: The domain identifier string
+        task: The root task identifier string
+        level: The level of the root task in the interface.
+        depth: Optional maximum number of levels below the root task.
+    """
+    def get(self):
+        try:
+            domain_identifier = self.request.get('domain')
+            task_identifier = self.request.get('task')
+            level = int(self.request.get('level', 0))
+            depth = self.request.get('depth')
+            depth = int(depth) if depth else None
+        except (ValueError,TypeError):
+            self.error(400)
+            return
+        user = api.get_and_validate_user(domain_identifier)
+        if not user:
+            self.error(403)
+            return
+        if self.not_modified(domain_identifier, user, 'subtree'):
+            return
+
+        task = api.get_task(domain_identifier, task_identifier)
+        if not task:
+            self.error(404)
+            return
+        try:
+            tasks = api.get_subtree(domain_identifier,
+                                    root_task=task,
+                                    depth=depth,
+                                    user_identifier=user.identifier())
+        except ValueError:
+            self.error(400)
+            return
+        # The level of each task relative to the root task.
+        root_level = task.hierarchy_level()
+        levels = [level + subtask.hierarchy_level() - root_level
+                  for subtask in tasks]
+        template_values = {
+            'task_rows': self.render_task_rows('task-row.html',
+                                               tasks,
+                                               user,
+                                               domain_identifier,
+                                               'all',
+                                               levels=levels),
+            'next_cursor': None,
             }
         self.render_template('get-subtasks.html', **template_values)
 
 
+class SearchTasks(BaseHandler):
+    """
+    Shows the tasks of a domain of which the description contains all
+    the words of a search query. The matching tasks are shown in their
+    hierarchy, together with their ancestors.
+
+    The handler takes the GET parameter q, the search query.
+    """
+    def get(self, domain_identifier):
+        user_future = api.get_and_validate_user_async(domain_identifier)
+        domain_future = api.get_domain_async(domain_identifier)
+        user = user_future.get_result()
+        if not user:
+            self.abort(404)
+        query = self.request.get('q').strip()
+        if self.not_modified(domain_identifier, user,
+                             'search:' + query.encode('utf-8')):
+            return
+
+        domain = domain_future.get_result()
+        no_tasks_description = "No tasks match '%s'." % query
+        try:
+            tasks = api.search_tasks(domain_identifier,
+                                     query,
+                                     user_identifier=user.identifier())
+        except ValueError:
+            tasks = []
+            no_tasks_description = ("The words in '%s' are too common to "
+                                    "search for." % query)
+        template_values = {
+            'domain_name': domain.name,
+            'domain_identifier': domain_identifier,
+            'view_mode': 'all',
+            'user_name': user.name,
+            'user_identifier': user.identifier(),
+            'query': query,
+            'task_rows': self.render_task_rows(
+                'task-row.html',
+                tasks,
+                user,
+                domain_identifier,
+                'all',
+                levels=[task.hierarchy_level() for task in tasks]),
+            'no_tasks_description': no_tasks_description,
+            }
+        self.render_template('search.html', **template_values)
+
+
+class TaskProgress(BaseHandler):
+    """
+    Shows the burndown chart of a root task, or of all the tasks of a
+    domain if no task is specified, from the hourly progress samples
+    that are recorded by the workers.
+    """
+    def get(self, domain_identifier, task_identifier=None):
+        user_future = api.get_and_validate_user_async(domain_identifier)
+        task_future = api.get_task_async(domain_identifier, task_identifier)
+        domain_future = api.get_domain_async(domain_identifier)
+        user = user_future.get_result()
+        if not user:
+            self.abort(404)
+        if self.not_modified(domain_identifier, user,
+                             'progress:%s' % (task_identifier or '')):
+            return
+        task = task_future.get_result()
+        if task_identifier and (not task or not task.root()):
+            self.abort(404)
+
+        domain = domain_future.get_result()
+        samples = api.get_progress_samples(domain, root_task=task)
+        template_values = {
+            'domain_name': domain.name,
+            'domain_identifier': domain_identifier,
+            'user_name': user.name,
+            'user_identifier': user.identifier(),
+            'task_identifier': task_identifier,
+            'task_title': task.title() if task else None,
+            'chart_url': _progress_chart_url(samples) if samples else None,
+            'completed': samples[-1][1] if samples else 0,
+            'atomic': samples[-1][2] if samples else 0,
+            }
+        self.render_template('progress.html', **template_values)
+
+
 class TaskEditView(BaseHandler):
     """
     Handler to show the edit task gui. It shows an editable
@@ -285,12 +708,15 @@ class TaskEditView(BaseHandler):
             return
 
         # Tasks that are used to create the navigation tasks for
-        # moving the task.
+        # moving the task. A task can only be moved within its entity
+        # group, see api.change_task_parent().
         user_id = user.identifier()
-        tasks = api.get_all_direct_subtasks(domain_identifier,
-                                            root_task=None,
-                                            limit=200,
-                                            user_identifier=user_id)
+        tasks, next_cursor = api.get_all_direct_subtasks(
+            domain_identifier,
+            root_task=None,
+            limit=PAGE_SIZE,
+            user_identifier=user_id,
+            group_key=task.group_key())
 
         template_values = {
             'domain_name': domain.name,
@@ -301,9 +727,17 @@ class TaskEditView(BaseHandler):
             'task_title' : task.title(),
             'task_description': task.description,
             'task_identifier': task.identifier(),
-            'tasks': _task_template_values(tasks, user),
+            'task_rows': self.render_task_rows('task-row-radio.html',
+                                               tasks,
+                                               user,
+                                               domain_identifier,
+                                               'all'),
             'show_radio_buttons': True,
+            'move_group': str(task.group_key()),
             'view_mode': 'all',
+            'next_cursor': next_cursor,
+            'more_task': "",
+            'more_level': -1,
             }
         self.render_template('edittask.html', **template_values)
 
@@ -346,6 +780,50 @@ class CreateTask(BaseHandler):
             self.redirect('/d/%s/' % domain)
 
 
+class ImportTasks(BaseHandler):
+    """
+    Handler for POST requests to import a tree of tasks at once. The
+    tasks are given either as an indented 'outline', with one task per
+    line, or as a JSON encoded 'tree', see api.import_tasks().
+    """
+    def post(self):
+        try:
+            domain = self.request.get('domain')
+            parent_identifier = self.request.get('parent', "")
+            tree = self.request.get('tree')
+            if tree:
+                task_tree = json.loads(tree)
+            else:
+                task_tree = api.parse_task_outline(self.request.get('outline'))
+            if not task_tree or not isinstance(task_tree, list):
+                raise ValueError("No tasks to import")
+        except (TypeError, ValueError):
+            self.error(400)
+            return
+        user = api.get_and_validate_user(domain)
+        if not user:
+            self.error(401)
+            return
+        self.session = Session(writer='cookie',
+                               wsgiref_headers=self.response.headers)
+        if not parent_identifier:
+            parent_identifier = None
+        try:
+            tasks = api.import_tasks(domain,
+                                     user,
+                                     task_tree,
+                                     parent_task_identifier=parent_identifier)
+        except ValueError, error:
+            self.error(400)
+            self.response.out.write("Error while importing tasks: %s" % error)
+            return
+        add_message(self.session, "Imported %d tasks" % len(tasks))
+        if parent_identifier:
+            self.redirect('/d/%s/task/%s' % (domain, parent_identifier))
+        else:
+            self.redirect('/d/%s/' % domain)
+
+
 class EditTask(BaseHandler):
     """
     Handler for POST requests to edit a task.
@@ -420,7 +898,7 @@ class CompleteTask(BaseHandler):
     def post(self):
         try:
             domain = self.request.get('domain')
-            task_id = int(self.request.get('id'))
+            task_id = self.request.get('id')
             completed = self.request.get('completed')
             completed = True if completed == 'true' else False
         except (TypeError, ValueError):
@@ -442,7 +920,7 @@ class AssignTask(BaseHandler):
     def post(self):
         try:
             domain = self.request.get('domain')
-            task_id = int(self.request.get('id'))
+            task_id = self.request.get('id')
             assignee = self.request.get('assignee')
         except (TypeError, ValueError):
             self.error(403)
@@ -452,12 +930,16 @@ class AssignTask(BaseHandler):
         if not user:
             self.error(403)
             return
-        assignee = User.get_by_key_name(assignee)
+        assignee = api.get_user(assignee)
         if not assignee:
             self.error(403)
             logging.error("No assignee")
             return
-        task = api.assign_task(domain, task_id, user, assignee)
+        try:
+            task = api.assign_task(domain, task_id, user, assignee)
+        except ValueError:
+            self.error(403)
+            return
         session = Session(writer='cookie',
                           wsgiref_headers=self.response.headers)
         add_message(session, "Task '%s' assigned to '%s'" %
@@ -472,11 +954,13 @@ class CreateDomain(BaseHandler):
         try:
             domain_id = self.request.get('domain')
             title = self.request.get('title')
+            shard_count = int(self.request.get('shards', 0))
         except (TypeError, ValueError):
             self.error(403)
             return
         user = api.get_logged_in_user()
-        domain = api.create_domain(domain_id, title, user)
+        domain = api.create_domain(domain_id, title, user,
+                                   shard_count=shard_count)
         if not domain:
             self.response.out.write("Could not create domain")
             return
@@ -494,6 +978,9 @@ _DOMAIN_URL = '/d/(%s)/?' % _VALID_DOMAIN_KEY_NAME
 
 _TASK_URL = '%s/task/(%s)/?' % (_DOMAIN_URL, _VALID_TASK_KEY_NAME)
 _TASK_EDIT_URL = "%s/edit/?" % (_TASK_URL,)
+_SEARCH_URL = '/d/(%s)/search/?' % _VALID_DOMAIN_KEY_NAME
+_DOMAIN_PROGRESS_URL = '/d/(%s)/progress/?' % _VALID_DOMAIN_KEY_NAME
+_TASK_PROGRESS_URL = "%s/progress/?" % (_TASK_URL,)
 
 from templatetags import templatefilters
 config = {
@@ -505,12 +992,17 @@ config = {
     }
 
 application = webapp2.WSGIApplication([('/create-task', CreateTask),
+                                       ('/import-tasks', ImportTasks),
                                        ('/set-task-completed', CompleteTask),
                                        ('/assign-task', AssignTask),
                                        ('/edit-task', EditTask),
                                        ('/move-task', MoveTask),
                                        ('/create-domain', CreateDomain),
                                        ('/get-subtasks', GetSubTasks),
+                                       ('/get-subtree', GetSubTree),
+                                       (_SEARCH_URL, SearchTasks),
+                                       (_DOMAIN_PROGRESS_URL, TaskProgress),
+                                       (_TASK_PROGRESS_URL, TaskProgress),
                                        (_TASK_EDIT_URL, TaskEditView),
                                        (_TASK_URL, TaskDetail),
                                        (_DOMAIN_URL, TaskDetail),
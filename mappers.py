@@ -15,12 +15,18 @@
 Mappers, currently only used for schema migration etc.
 """
 import logging
-from mapreduce import operation as op, context
+from mapreduce import context
 from google.appengine.ext import db
 
-from model import Domain, Task, User, TaskIndex
+from model import Domain, Task, User, TaskIndex, DirtyTask
+from model import DomainStatistics
 import workers
 import api
+import caching
+
+# Number of entities that are fetched in a single batch while the
+# tasks of a domain are rebuilt.
+REBUILD_BATCH_SIZE = 1000
 
 
 def rebuild_hierarchy(task):
@@ -28,19 +34,23 @@ def rebuild_hierarchy(task):
     Rebuilds all derived properties and hierarchies. This includes the
     TaskIndexes. This operation will only create tasks, which will do
     the actual work.
+
+    As all derived properties are recomputed from the atomic tasks
+    upwards, this also reconciles the counters that are otherwise
+    maintained through deltas by the propagation worker.
     """
     if task.root():
         workers.UpdateTaskHierarchy.enqueue(task.domain_identifier(),
                                             task.identifier())
 
-    domain_key = Domain.key_from_name(task.domain_identifier())
+    group_key = task.group_key()
     task_key = task.key()
-    logging.info("Domain_key %s" % domain_key)
+    logging.info("Group_key %s" % group_key)
     def txn():
         # Actual test in the datastore to see if the task is atomic,
         # as it is a computed property.
         query = Task.all().\
-            ancestor(domain_key).\
+            ancestor(group_key).\
             filter('parent_task =', task_key)
         subtask = query.get()
         if not subtask:         # atomic
@@ -49,7 +59,142 @@ def rebuild_hierarchy(task):
     db.run_in_transaction(txn)
 
 
+def rebuild_domain(domain):
+    """
+    Rebuilds all derived properties and TaskIndexes of the tasks of
+    |domain| in a single pass. Unlike rebuild_hierarchy(), this does
+    not queue any workers for the individual tasks.
+
+    The tasks of all entity groups of the domain are streamed once,
+    the hierarchy is built in memory, and the derived properties of
+    all tasks are computed bottom-up by compute_new_task_tree(). The
+    tasks and their new TaskIndexes are written with the batched puts
+    of a MutationPool. Pending dirty markers are turned into full
+    recomputes, as their deltas are included in the rebuild. The
+    DomainStatistics shards are recounted from the root tasks.
+
+    The domain should not be changed while it is rebuilt, and all its
+    tasks must fit in memory.
+    """
+    domain_identifier = domain.identifier()
+    group_keys = domain.group_keys()
+    tasks = []
+    for group_key in group_keys:
+        tasks.extend(Task.all().
+                     ancestor(group_key).
+                     run(batch_size=REBUILD_BATCH_SIZE))
+
+    keys = set(task.key() for task in tasks)
+    children = {}
+    roots = []
+    for task in tasks:
+        parent_key = task.parent_task_key()
+        if parent_key in keys:
+            children.setdefault(parent_key, []).append(task)
+        else:
+            if parent_key:
+                logging.warning("Parent of task '%s/%s' does not exist",
+                                domain_identifier, task.identifier())
+            roots.append(task)
+
+    # Order the tasks in pre-order, and compute their hierarchies.
+    ordered = []
+    indexes = []
+    subtasks = []
+    stack = [(task, None) for task in roots]
+    while stack:
+        task, parent = stack.pop()
+        position = len(ordered)
+        if parent is None:
+            hierarchy = []
+        else:
+            subtasks[parent].append(position)
+            hierarchy = (indexes[parent].hierarchy +
+                         [ordered[parent].identifier()])
+        task.derived_level = len(hierarchy)
+        ordered.append(task)
+        indexes.append(TaskIndex(parent=task,
+                                 key_name=task.identifier(),
+                                 hierarchy=hierarchy))
+        subtasks.append([])
+        stack.extend((subtask, position)
+                     for subtask in children.get(task.key(), []))
+    if len(ordered) < len(tasks):
+        logging.error("%d tasks of domain '%s' are part of a cycle",
+                      len(tasks) - len(ordered), domain_identifier)
+    workers.compute_new_task_tree(ordered, indexes, subtasks)
+
+    shards = dict((group_key, DomainStatistics(
+                key=DomainStatistics.key_from_group_key(group_key)))
+                  for group_key in group_keys)
+    for task in ordered:
+        task.counted_statistics = workers.statistics_of_task(task)
+        if task.counted_statistics:
+            workers.add_statistics(shards[task.group_key()],
+                                   task.counted_statistics)
+
+    pool = context.MutationPool()
+    for shard in shards.itervalues():
+        pool.put(shard)
+    for task, index in zip(ordered, indexes):
+        pool.put(task)
+        pool.put(index)
+    for group_key in group_keys:
+        for marker in DirtyTask.all().ancestor(group_key):
+            marker.full = True
+            marker.delta = None
+            pool.put(marker)
+    pool.flush()
+    written = ([task.key() for task in ordered] +
+               [index.key() for index in indexes] +
+               [shard.key() for shard in shards.itervalues()])
+    for start in range(0, len(written), REBUILD_BATCH_SIZE):
+        caching.invalidate(written[start:start + REBUILD_BATCH_SIZE])
+
+    for group_key in group_keys:
+        db.run_in_transaction(workers.update_task_tree_snapshot,
+                              group_key,
+                              tasks=[task for task in ordered
+                                     if task.group_key() == group_key])
+    api.increment_modification_counter(domain_identifier)
+
+
+def index_task(task):
+    """
+    Adds the task to the search index, for tasks that were created
+    before the index existed. The index is updated by a worker.
+    """
+    workers.UpdateSearchIndex.enqueue(task.domain_identifier(),
+                                      [task.identifier()])
+
+
+def update_inbox(task):
+    """
+    Adds the task to the inbox of its assignee, for tasks that were
+    assigned before the inboxes existed. The inbox is updated by a
+    worker.
+    """
+    if task.assignee_key():
+        workers.UpdateInbox.enqueue(task.domain_identifier(),
+                                    [task.identifier()])
+
+
+def register_assignee_name(task):
+    """
+    Adds the name of the assignee of the task to the AssigneeNames
+    table of its domain, for tasks that were assigned before the
+    table existed.
+    """
+    assignee = task.assignee_key()
+    if assignee:
+        user = caching.get(assignee)
+        if user:
+            api.register_assignee_names(task.domain_identifier(), [user])
+
+
 def migrate_user(user):
     if not 'sps' in user.domains:
         user.domains.append('sps')
-    yield op.db.Put(user)
+    # Users are read through the cache, so they are not written with
+    # the mutation pool, which would leave stale cached copies.
+    caching.put(user)
@@ -16,9 +16,17 @@
 Model classes used in the planner.
 """
 import copy
+import calendar
+import datetime
 from google.appengine.ext import db
 import json
 import aetycoon
+import caching
+
+# Maximum number of shards of a domain. Pages of all tasks query and
+# fetch from every entity group of a domain.
+MAX_SHARDS = 16
+
 
 class Domain(db.Model):
     """
@@ -26,12 +34,25 @@ class Domain(db.Model):
     and Contexes for transaction support. Not really used in any other
     way at the moment, although the name could be used as some sort of
     title.
+
+    A domain can optionally be sharded, in which case new root tasks
+    and their subtasks are stored in the entity group of one of the
+    DomainShards of the domain, instead of the entity group of the
+    domain itself. See DomainShard.
     """
     name = db.StringProperty(required=True)
     # The key names of all users that have 'admin' rights in this
     # domain. The user who creates a domain becomes its admin by
     # default, others have to be added later
     admins = db.ListProperty(str, default=[])
+    # The number of shards of this domain. If zero, all tasks are
+    # stored in the entity group of the domain.
+    shard_count = db.IntegerProperty(default=0, indexed=False)
+    # Whether the TaskIndexes of all tasks of this domain have the
+    # properties that order the task lists, see TaskIndex.sort_key.
+    # Set by the workers.OrderTaskIndexes worker for domains that
+    # were created before these properties existed.
+    ordered_indexes = db.BooleanProperty(default=False, indexed=False)
 
     @staticmethod
     def key_from_name(domain_identifier):
@@ -44,10 +65,78 @@ class Domain(db.Model):
         """
         return db.Key.from_path('Domain', domain_identifier)
 
+    @staticmethod
+    def identifier_from_group_key(group_key):
+        """
+        Returns the identifier of the domain of the entity group with
+        the given root key, which is either the key of a Domain or of
+        a DomainShard.
+        """
+        if group_key.kind() == 'DomainShard':
+            return group_key.name().rsplit(':', 1)[0]
+        return group_key.name()
+
     def identifier(self):
         """Returns a string identifier for this domain."""
         return self.key().name()
 
+    def group_keys(self):
+        """
+        Returns a list with the root keys of all the entity groups in
+        which the tasks of this domain are stored. The first key is
+        always the key of the domain itself.
+        """
+        return [self.key()] + [DomainShard.key_from_shard(self.identifier(),
+                                                          shard)
+                               for shard in range(self.shard_count or 0)]
+
+
+class DomainShard(db.Model):
+    """
+    The root of an additional entity group of a sharded domain. As
+    the entity group of a Domain limits the writes to about 1/sec,
+    sharded domains spread their tasks over multiple entity groups.
+
+    Each task hierarchy is stored entirely in a single entity group,
+    which is selected when its root task is created. All the
+    operations on a hierarchy can therefore still use single group
+    transactions and strongly consistent ancestor queries. A task can
+    therefore not be moved to a parent task in another entity group,
+    which also keeps the identifiers of tasks stable. The move task
+    UI only offers the tasks in the entity group of the moved task as
+    new parents, see api.change_task_parent().
+
+    The tasks in a shard use key names of the form '<shard>-<id>', so
+    the shard can be derived from the task identifier.
+
+    DomainShard entities are never stored, only their keys are used.
+    The key_name of a shard is '<domain identifier>:<shard>'.
+    """
+    @staticmethod
+    def key_from_shard(domain_identifier, shard):
+        """
+        Returns the datastore key of a shard of the domain.
+
+        Args:
+            domain_identifier: The domain identifier string
+            shard: The number of the shard
+
+        Returns:
+            An instance of db.Key pointing to a DomainShard entity.
+        """
+        return db.Key.from_path('DomainShard',
+                                '%s:%d' % (domain_identifier, shard))
+
+    @staticmethod
+    def shard_from_key(group_key):
+        """
+        Returns the shard number of the entity group with the given
+        root key, or None if it is the entity group of a Domain.
+        """
+        if group_key.kind() != 'DomainShard':
+            return None
+        return int(group_key.name().rsplit(':', 1)[1])
+
 
 class Context(db.Model):
     """
@@ -106,6 +195,8 @@ class JsonProperty(db.TextProperty):
 
     def get_value_for_datastore(self, model_instance):
         result = super(JsonProperty, self).get_value_for_datastore(model_instance)
+        if result is None:
+            return None
         result = json.dumps(result)
         return db.Text(result)
 
@@ -124,7 +215,170 @@ class JsonProperty(db.TextProperty):
         return copy.copy(self.default)
 
 
-class Task(db.Model):
+class DerivedTaskProperties(object):
+    """
+    Mixin with all the functions of a task that only depend on its
+    derived properties. It is shared by the Task model and the
+    TaskTreeNode class, which is read from a TaskTreeSnapshot.
+
+    Classes that use this mixin must provide the derived_* attributes
+    of the Task model, and the parent_task_key() and
+    assignee_identifier() functions.
+    """
+    def assignee_description(self, names):
+        """
+        Returns a string describing the assignees of this task. If
+        this task has no assignees, then this function returns the
+        empty string.
+
+        Args:
+            names: A dictionary with the names of the assignees, keyed
+                by user identifier. See AssigneeNames.
+        """
+        # Sort on assignees with the most assigned tasks
+        sorted_assignees = sorted(self.derived_assignees.itervalues(),
+                                  key=lambda x: -x.get('all', 0))
+        sorted_names = [names.get(assignee['id'], '<Missing>')
+                        for assignee in sorted_assignees]
+        if len(sorted_names) > 3:
+            return '%s, %s and %d others' % (sorted_names[0],
+                                             sorted_names[1],
+                                             len(sorted_names) - 2)
+        else:
+            return ', '.join(sorted_names)
+
+    def summary(self):
+        """
+        Returns a short summary of the task of the form "X tasks (Y
+        completed)", where X is the number of atomic tasks of this
+        task, and Y the number of atomic tasks that have been
+        completed. If this tasks is an atomic task itself, the empty
+        string is returned.
+        """
+        if self.atomic():
+            return ""
+        count = self.atomic_task_count()
+        summary = "1 task" if count == 1 else "%d tasks" % count
+        # Only decode the assignees if the counter is not available.
+        completed = self.completed_task_count()
+        if completed is None:
+            completed = sum(r['completed'] for r
+                            in self.derived_assignees.itervalues())
+        summary += " (%d completed)" % completed
+        return summary
+
+    def subtasks_remaining(self, user_identifier):
+        """
+        Returns the number of atomic subtasks of this task, that the
+        user with the given |user_identifier| has left to complete.
+        """
+        if self.atomic():
+            return 0
+        record = self.derived_assignees.get(user_identifier)
+        remaining = 0
+        if record:
+            all = record.get('all', 0)
+            completed = record.get('completed', 0)
+            remaining = all - completed
+        return remaining
+
+
+    def personalized_summary(self, user_identifier):
+        """
+        Returns a short string summary of the task with respect to a
+        particular user. The string displays the remaining number of
+        atomic tasks the user has yet to complete. If no tasks are
+        left for the user to complete, the empty string is returned.
+
+        In case of an atomic tasks, the empty string is always
+        returned.
+        """
+        if self.atomic():
+            return ""
+
+        record = self.derived_assignees.get(user_identifier)
+        remaining = 0
+        if record:
+            all = record.get('all', 0)
+            completed = record.get('completed', 0)
+            remaining = all - completed
+        if remaining > 0:
+            if remaining == 1:
+                return "1 task left"
+            else:
+                return "%d tasks left" % (remaining,)
+        return ""
+
+
+    def is_active(self, user_identifier):
+        """
+        Returns true if this task is active for the given user. A task
+        is active iff it has one or more atomic tasks that have not
+        yet been completed by the user.
+        """
+        if self.is_completed():
+            # completed tasks cannot be active.
+            return False
+        record = self.derived_assignees.get(user_identifier)
+        if not record:
+            return False
+        return (record.get('all') - record.get('completed')) > 0
+
+    def is_completed(self):
+        """
+        Returns true iff this task is completed.
+        """
+        return self.derived_completed
+
+    def atomic(self):
+        """Returns true if this task is an atomic task"""
+        return self.derived_size == 1
+
+    def root(self):
+        """Returns true if this task has no parent task"""
+        return not self.parent_task_key()
+
+    def open(self):
+        """Returns true if this task is an open task."""
+        return (self.atomic() and
+                not self.is_completed() and
+                not self.assignee_identifier())
+
+    def hierarchy_level(self):
+        """Returns the level of this task in the task hierarchy."""
+        return self.derived_level
+
+    def number_of_subtasks(self):
+        """The total number of subtasks of this task."""
+        return self.derived_size - 1
+
+    def has_open_tasks(self):
+        """
+        Returns true if this task contains one or more open tasks, or
+        is an open tasks itself.
+        """
+        return self.derived_has_open_tasks
+
+    def atomic_task_count(self):
+        """Returns the total number of atomic tasks in this task hierarchy."""
+        return self.derived_atomic_task_count
+
+    def completed_task_count(self):
+        """
+        Returns the number of completed atomic tasks in this task
+        hierarchy, or None if it has not been computed yet.
+        """
+        return self.derived_completed_task_count
+
+    def open_task_count(self):
+        """
+        Returns the number of open atomic tasks in this task
+        hierarchy, or None if it has not been computed yet.
+        """
+        return self.derived_open_task_count
+
+
+class Task(DerivedTaskProperties, db.Model):
     """
     A record for every task. Tasks can form a hierarchy. Tasks have
     single description. The title of a task is defined as the first
@@ -141,7 +395,11 @@ class Task(db.Model):
     dominated.
 
     Tasks do not have a specific keyname, but use the auto-generated
-    numeric ids.
+    numeric ids. Tasks in sharded domains can also be stored in the
+    entity group of a DomainShard, in which case they use a key name
+    with the shard number as prefix, see DomainShard. A task in a
+    sharded domain can only be moved to a parent task in the same
+    entity group, so it stays in the task tree of its root task.
 
     Some properties are replicated in the TaskIndex model. Each
     Task has a corresponding TaskIndex, which is used to perform
@@ -187,6 +445,10 @@ class Task(db.Model):
     # the user. To get the value of the completed status in the
     # hierarchy, check the derived_completed field.
     completed = db.BooleanProperty(default=False, indexed=False)
+    # Counter that is increased each time a property of the task that
+    # is shown in the task lists changes. It is part of the key of
+    # the cached rows of the task, see main.py.
+    version = db.IntegerProperty(default=0, indexed=False)
     #
     # TODO(tijmen): Add statuses/messages
     #
@@ -207,24 +469,138 @@ class Task(db.Model):
     # has level 0, for all other tasks it is defined as the level as
     # its parent plus one.
     derived_level = db.IntegerProperty(default=0)
-    # A dictionary of assignees of this (composite) task.  The
-    # assignees of this list form the union of all the assignees of
-    # the atomic subtasks of this task.
-    #
-    # The keys of each entry is the assignee identifier, which is also
-    # stored as value in the record.
+    # The assignees of this (composite) task, which form the union of
+    # all the assignees of the atomic subtasks of this task. They are
+    # stored as parallel arrays, with for each assignee its
+    # identifier, the number of atomic subtasks completed by the
+    # assignee and the total number of atomic subtasks assigned to the
+    # assignee. The names of the assignees are not stored in the
+    # task, but once per domain in AssigneeNames.
     #
-    # Each assignee consists of a record with the following fields:
-    #  id: a string with the identifier of the assignee
-    #  completed: an integer describing the number of atomic subtasks
-    #     completed by this assignee.
-    #  all: an integer describing the total number of atomic subtasks
-    #     assigned to this assignee.
-    derived_assignees = JsonProperty(default={})
+    # Use the derived_assignees attribute to read or replace them.
+    derived_assignee_ids = db.StringListProperty(indexed=False)
+    derived_assignee_completed = db.ListProperty(int, indexed=False)
+    derived_assignee_all = db.ListProperty(int, indexed=False)
+    # The assignees in the JSON encoding that was used before the
+    # arrays above. It is only read for tasks that have not been
+    # updated since, and removed by the next update.
+    legacy_derived_assignees = JsonProperty(default=None,
+                                            name='derived_assignees')
     # Whether or not the task has one or more open tasks. If this
     # task is an open atomic task, then this value is also True.
     derived_has_open_tasks = db.BooleanProperty(default=False)
+    # Number of completed atomic tasks in this hierarchy, and the
+    # number of open atomic tasks in this hierarchy. These counters
+    # allow changes of atomic tasks to be propagated upwards as
+    # deltas. They are None for tasks whose derived properties have
+    # not been recomputed since the counters were introduced.
+    derived_completed_task_count = db.IntegerProperty(indexed=False)
+    derived_open_task_count = db.IntegerProperty(indexed=False)
+    # The contribution of a root task to the DomainStatistics of its
+    # entity group, as it was last counted. None for tasks that are
+    # not root tasks. See workers.update_domain_statistics().
+    counted_statistics = JsonProperty(default=None)
+    # Number of events in the log of the task, which is stored in
+    # TaskLogPage entities. The last page holds the events from
+    # index (log_size - 1) // TaskLogPage.PAGE_SIZE on.
+    log_size = db.IntegerProperty(default=0, indexed=False)
+
+
+    def _get_derived_assignees(self):
+        """
+        Returns a dictionary of the assignees of this task, keyed by
+        assignee identifier. Each assignee is a record with the
+        following fields:
+         id: a string with the identifier of the assignee
+         completed: an integer describing the number of atomic subtasks
+            completed by this assignee.
+         all: an integer describing the total number of atomic subtasks
+            assigned to this assignee.
+
+        The dictionary is only built on first access, so loading a
+        task does not pay for it. It must not be modified in place,
+        assign a new dictionary instead.
+        """
+        if getattr(self, '_derived_assignees', None) is None:
+            if self.legacy_derived_assignees and not self.derived_assignee_ids:
+                records = [(id, record['completed'], record['all'])
+                           for id, record
+                           in self.legacy_derived_assignees.iteritems()]
+            else:
+                records = zip(self.derived_assignee_ids,
+                              self.derived_assignee_completed,
+                              self.derived_assignee_all)
+            self._derived_assignees = dict(
+                (id, { 'id': id, 'completed': completed, 'all': all })
+                for id, completed, all in records)
+        return self._derived_assignees
+
+    def _set_derived_assignees(self, assignees):
+        """
+        Replaces the assignees of this task by the records in the
+        dictionary |assignees|, see _get_derived_assignees().
+        """
+        records = sorted(assignees.itervalues(), key=lambda r: r['id'])
+        self.derived_assignee_ids = [r['id'] for r in records]
+        self.derived_assignee_completed = [r['completed'] for r in records]
+        self.derived_assignee_all = [r['all'] for r in records]
+        self.legacy_derived_assignees = None
+        self._derived_assignees = None
+
+    derived_assignees = property(_get_derived_assignees,
+                                 _set_derived_assignees)
+
+    @staticmethod
+    def key_from_identifier(domain_identifier, task_identifier):
+        """
+        Returns the datastore key of the task with the given
+        identifier in the domain. It is not checked if the entity
+        actually exists.
 
+        Args:
+            domain_identifier: The domain identifier string
+            task_identifier: The task identifier, as an int or string.
+
+        Returns:
+            An instance of db.Key pointing to a Task entity.
+        """
+        domain_key = Domain.key_from_name(domain_identifier)
+        try:
+            return db.Key.from_path('Task', int(task_identifier),
+                                    parent=domain_key)
+        except ValueError:
+            shard = task_identifier.split('-', 1)[0]
+            if '-' in task_identifier and shard.isdigit():
+                shard_key = DomainShard.key_from_shard(domain_identifier,
+                                                       int(shard))
+                return db.Key.from_path('Task', task_identifier,
+                                        parent=shard_key)
+            return db.Key.from_path('Task', task_identifier,
+                                    parent=domain_key)
+
+    @staticmethod
+    def allocate_keys(group_key, count):
+        """
+        Allocates the keys for new tasks in an entity group.
+
+        Args:
+            group_key: The key of the Domain or DomainShard that is the
+                root of the entity group.
+            count: The number of keys to allocate.
+
+        Returns:
+            A list of |count| db.Key instances.
+        """
+        start, end = db.allocate_ids(db.Key.from_path('Task', 1,
+                                                      parent=group_key),
+                                     count)
+        shard = DomainShard.shard_from_key(group_key)
+        if shard is None:
+            return [db.Key.from_path('Task', id, parent=group_key)
+                    for id in range(start, end + 1)]
+        return [db.Key.from_path('Task', '%d-%d' % (shard, id),
+                                 parent=group_key)
+                for id in range(start, end + 1)]
 
     def identifier(self):
         """Returns a string with the task identifier"""
@@ -251,7 +627,14 @@ class Task(db.Model):
 
     def domain_key(self):
         """
-        Returns the key of the domain parent entity of this task.
+        Returns the key of the domain of this task.
+        """
+        return Domain.key_from_name(self.domain_identifier())
+
+    def group_key(self):
+        """
+        Returns the key of the root entity of the entity group of this
+        task, which is either its Domain or a DomainShard.
         """
         return self.parent_key()
 
@@ -259,7 +642,7 @@ class Task(db.Model):
         """
         Returns the domain identifier of the domain of this task.
         """
-        return self.parent_key().name()
+        return Domain.identifier_from_group_key(self.parent_key())
 
     def title(self):
         """
@@ -312,165 +695,748 @@ class Task(db.Model):
         key = self.assignee_key()
         return key.name() if key else None
 
-    def assignee_description(self):
+    def __str__(self):
+        return "%s/%s" % (self.domain_identifier(), self.identifier())
+
+
+class TaskIndex(db.Model):
+    """
+    The TaskIndex stores the entire task identifier hierarchy of each
+    task, which is the parent entity of the index. These indices help
+    with certain task hierarchy queries.
+
+    Additionally, it stores all the assignees to that task. This
+    can also be used for a query.
+
+    The key_name of each TaskIndex is set to the identifier of the
+    Task that is the index of.
+    """
+    # An ordered list of all the parent identifiers of the task.
+    # Empty if the task has no parents.
+    hierarchy = db.StringListProperty(required=True, default=[])
+    # The level in the hierarchy of this index. Equivalent to the
+    # number of items in the hierarchy list.
+    level = aetycoon.LengthProperty(hierarchy)
+    # An list of identifiers of all users that are participating in
+    # this task, because they are assigned to an atomic subtask.
+    assignees = db.StringListProperty(default=[])
+    # The size of the assignees list
+    assignee_count = aetycoon.LengthProperty(assignees)
+    # Whether the associated task is completed.
+    completed = db.BooleanProperty(default=False)
+    # Whether the associated task is an atomic task.
+    atomic = db.BooleanProperty(default=False)
+    # Mirrors the |derived_has_open_tasks| property of the Task.
+    has_open_tasks = db.BooleanProperty(default=False)
+    # The order of the task in the task lists: uncompleted tasks
+    # before completed tasks, and then from new to old. Computed
+    # with sort_key_for().
+    sort_key = db.StringProperty()
+    # An list of identifiers of the assignees for whom the task is
+    # active, see Task.is_active(). Used to list the active tasks of
+    # a user first.
+    active_assignees = db.StringListProperty(default=[])
+    # An list of identifiers of the assignees of an uncompleted task
+    # for whom the task is not active. Together with active_assignees
+    # these are the assignees of an uncompleted task.
+    inactive_assignees = db.StringListProperty(default=[])
+
+    # Number of digits of the time, in microseconds, in the sort_key.
+    SORT_KEY_TIME_DIGITS = 16
+    SORT_KEY_EPOCH = datetime.datetime(1970, 1, 1)
+
+    @staticmethod
+    def sort_key_for(completed, time):
         """
-        Returns a string describing the assignees of this task. If
-        this task has no assignees, then this function returns the
-        empty string.
+        Returns the sort_key of a task. The keys of uncompleted tasks
+        sort before those of completed tasks, and newer tasks sort
+        before older tasks.
+
+        Args:
+            completed: Whether the task is completed.
+            time: The creation time of the task, or None.
+
+        Returns:
+            A string with the sort key.
         """
-        # Sort on assignees with the most assigned tasks
-        sorted_assignees = sorted(self.derived_assignees.itervalues(),
-                                  key=lambda x: -x.get('all', 0))
-        if len(sorted_assignees) > 3:
-            return '%s, %s and %d others' % (sorted_assignees[0]['name'],
-                                             sorted_assignees[1]['name'],
-                                             len(sorted_assignees) - 2)
-        else:
-            return ', '.join(assignee['name'] for assignee in sorted_assignees)
+        microseconds = 0
+        if time:
+            delta = time - TaskIndex.SORT_KEY_EPOCH
+            microseconds = ((delta.days * 86400 + delta.seconds) * 10**6 +
+                            delta.microseconds)
+        return '%d%0*d' % (int(bool(completed)),
+                           TaskIndex.SORT_KEY_TIME_DIGITS,
+                           10**TaskIndex.SORT_KEY_TIME_DIGITS - 1 - microseconds)
 
-    def summary(self):
+    @staticmethod
+    def key_from_task_key(task_key):
         """
-        Returns a short summary of the task of the form "X tasks (Y
-        completed)", where X is the number of atomic tasks of this
-        task, and Y the number of atomic tasks that have been
-        completed. If this tasks is an atomic task itself, the empty
-        string is returned.
+        Returns the datastore key of the TaskIndex of the task with
+        the given key. It is not checked if the entity actually
+        exists.
+
+        Args:
+            task_key: An instance of db.Key pointing to a Task entity.
+
+        Returns:
+            An instance of db.Key pointing to a TaskIndex entity.
         """
-        if self.atomic():
-            return ""
-        count = self.atomic_task_count()
-        summary = "1 task" if count == 1 else "%d tasks" % count
-        completed = sum(r['completed'] for r
-                        in self.derived_assignees.itervalues())
-        summary += " (%d completed)" % completed
-        return summary
+        return db.Key.from_path('TaskIndex', str(task_key.id_or_name()),
+                                parent=task_key)
 
-    def subtasks_remaining(self, user_identifier):
+
+class DirtyTask(db.Model):
+    """
+    Marks a task of which the derived properties must be updated
+    by the propagation worker.
+
+    Dirty markers are stored in the entity group of the task, so they
+    are written in the same transaction as the mutation that caused
+    them. The key_name of each marker is the identifier of the
+    dirty task, so multiple mutations of the same task result in a
+    single marker.
+
+    A marker either requests a full recompute of the task and all its
+    ancestors, or carries a delta that must be applied to all the
+    ancestors of the task.
+    """
+    # Time of the last mutation that marked the task as dirty.
+    time = db.DateTimeProperty(auto_now=True)
+    # Time of the first mutation that marked the task as dirty. Used
+    # to measure the propagation lag.
+    created = db.DateTimeProperty(auto_now_add=True, indexed=False)
+    # Whether the derived properties of the task and its ancestors
+    # must be recomputed from their subtasks.
+    full = db.BooleanProperty(default=True, indexed=False)
+    # The change of the derived properties of the task, that has
+    # not yet been applied to its ancestors. Only used if |full| is
+    # False. A record with the following fields:
+    #  completed: change in the number of completed atomic tasks
+    #  open: change in the number of open atomic tasks
+    #  assignees: a dictionary of assignee records, keyed by assignee
+    #     identifier, with the fields id, completed and all
+    #     as in Task.derived_assignees, containing the changes.
+    delta = JsonProperty(default=None)
+
+
+class AssigneeNames(db.Model):
+    """
+    The table with the names of the assignees of the tasks in a
+    domain. The derived assignees of tasks only contain the user
+    identifiers, the names are resolved through this table. Each
+    domain has at most one instance, which is a child of the Domain
+    entity with the key_name AssigneeNames.KEY_NAME.
+    """
+    KEY_NAME = 'assignees'
+
+    # A dictionary of user names, keyed by user identifier.
+    names = JsonProperty(default={})
+    # Increased whenever a name is added or changed. Cached task rows
+    # that show the names of assignees are keyed by this revision.
+    revision = db.IntegerProperty(default=0, indexed=False)
+
+    @staticmethod
+    def key_from_domain_identifier(domain_identifier):
         """
-        Returns the number of atomic subtasks of this task, that the
-        user with the given |user_identifier| has left to complete.
+        Returns the datastore key of the AssigneeNames of the domain
+        with the given identifier.
         """
-        if self.atomic():
-            return 0
-        record = self.derived_assignees.get(user_identifier)
-        remaining = 0
-        if record:
-            all = record.get('all', 0)
-            completed = record.get('completed', 0)
-            remaining = all - completed
-        return remaining
+        return db.Key.from_path('AssigneeNames',
+                                AssigneeNames.KEY_NAME,
+                                parent=Domain.key_from_name(domain_identifier))
 
 
-    def personalized_summary(self, user_identifier):
+class Inbox(db.Model):
+    """
+    The materialized list of the uncompleted atomic tasks that are
+    assigned to a user, in all domains. Each user has at most one
+    instance, which is a child of the User entity with the key_name
+    Inbox.KEY_NAME. The inbox is maintained by the UpdateInbox
+    worker, so it can lag behind the tasks.
+    """
+    KEY_NAME = 'inbox'
+    # Maximum number of tasks in an inbox, which must fit in a single
+    # entity.
+    MAX_TASKS = 1000
+
+    # A list of task records, ordered by domain and then as the task
+    # lists. Each record has the following fields:
+    #  domain: the domain identifier
+    #  id: the task identifier
+    #  title: the title of the task
+    #  path: a list of records with the id and title of each
+    #     ancestor of the task, starting at the root task.
+    #  sort_key: the TaskIndex.sort_key of the task.
+    tasks = JsonProperty(default=[])
+    # Set if tasks have been left out because there were more than
+    # MAX_TASKS tasks.
+    truncated = db.BooleanProperty(default=False, indexed=False)
+
+    @staticmethod
+    def key_from_user_identifier(user_identifier):
         """
-        Returns a short string summary of the task with respect to a
-        particular user. The string displays the remaining number of
-        atomic tasks the user has yet to complete. If no tasks are
-        left for the user to complete, the empty string is returned.
+        Returns the datastore key of the Inbox of the user with the
+        given identifier.
+        """
+        return db.Key.from_path('User', user_identifier,
+                                'Inbox', Inbox.KEY_NAME)
 
-        In case of an atomic tasks, the empty string is always
-        returned.
+
+class SearchTerm(db.Model):
+    """
+    The posting list of a term in the search index of a domain, see
+    search.py. The key_name of each SearchTerm is the domain
+    identifier and the term, separated by a colon.
+    """
+    # The identifiers of the tasks that contain the term in their
+    # description, from old to new. Can contain identifiers of tasks
+    # that no longer exist.
+    tasks = db.StringListProperty(default=[], indexed=False)
+    # Set if the term is contained in more than search.MAX_POSTINGS
+    # tasks. The tasks are then no longer stored, and the term is
+    # not used to select the results of a query.
+    overflow = db.BooleanProperty(default=False, indexed=False)
+
+    @staticmethod
+    def key_from_term(domain_identifier, term):
         """
-        if self.atomic():
-            return ""
+        Returns the datastore key of the SearchTerm of |term| in the
+        domain with the given identifier. It is not checked if the
+        entity actually exists.
+        """
+        return db.Key.from_path('SearchTerm',
+                                '%s:%s' % (domain_identifier, term))
 
-        record = self.derived_assignees.get(user_identifier)
-        remaining = 0
-        if record:
-            all = record.get('all', 0)
-            completed = record.get('completed', 0)
-            remaining = all - completed
-        if remaining > 0:
-            if remaining == 1:
-                return "1 task left"
+
+class TaskSearchTerms(db.Model):
+    """
+    The terms under which a task is stored in the search index, see
+    search.py. Each task has at most one instance, which is a child
+    of the task with the key_name TaskSearchTerms.KEY_NAME. Used to
+    remove the task from the posting lists of the terms that are no
+    longer in its description.
+    """
+    KEY_NAME = 'terms'
+
+    # The terms under which the task is, or might be, indexed.
+    terms = db.StringListProperty(default=[], indexed=False)
+
+    @staticmethod
+    def key_from_task_key(task_key):
+        """
+        Returns the datastore key of the TaskSearchTerms of the task
+        with the given key.
+        """
+        return db.Key.from_path('TaskSearchTerms',
+                                TaskSearchTerms.KEY_NAME,
+                                parent=task_key)
+
+
+class PropagationState(db.Model):
+    """
+    Bookkeeping of the propagation worker of an entity group of a
+    domain. Each group has at most one instance, which is a child of
+    the Domain or DomainShard entity with the key_name
+    PropagationState.KEY_NAME.
+    """
+    KEY_NAME = 'propagation'
+
+    # Whether a propagation worker has been queued that has not yet
+    # started processing the dirty markers of the entity group.
+    pending = db.BooleanProperty(default=False, indexed=False)
+    # Time of the last change of |pending|.
+    time = db.DateTimeProperty(auto_now=True, indexed=False)
+    # Increased in every transaction that changes the TaskTreeSnapshot
+    # of the entity group, or the tasks of a group without a snapshot.
+    # Used to cache decoded snapshots, and to detect changes while a
+    # new snapshot is built.
+    snapshot_revision = db.IntegerProperty(default=0, indexed=False)
+
+    @staticmethod
+    def key_from_group_key(group_key):
+        """
+        Returns the datastore key of the PropagationState of the
+        entity group with the given root key.
+        """
+        return db.Key.from_path('PropagationState',
+                                PropagationState.KEY_NAME,
+                                parent=group_key)
+
+
+class DomainStatistics(db.Model):
+    """
+    Counters of all the tasks of a domain. The counters are sharded
+    over the entity groups of the domain: each group has at most one
+    instance, which is a child of the Domain or DomainShard entity
+    with the key_name DomainStatistics.KEY_NAME. A shard counts the
+    task hierarchies of the root tasks in its entity group, and is
+    updated in the same transaction as these root tasks.
+    """
+    KEY_NAME = 'statistics'
+
+    # Total number of tasks.
+    total = db.IntegerProperty(default=0, indexed=False)
+    # Number of atomic tasks.
+    atomic = db.IntegerProperty(default=0, indexed=False)
+    # Number of completed atomic tasks.
+    completed = db.IntegerProperty(default=0, indexed=False)
+    # Number of open atomic tasks, which are neither completed nor
+    # assigned.
+    open = db.IntegerProperty(default=0, indexed=False)
+    # A dictionary with a record for each assignee, keyed by assignee
+    # identifier, with the number of atomic tasks assigned to the
+    # assignee in the field 'all', and the number of those tasks that
+    # are completed in the field 'completed'.
+    assignees = JsonProperty(default={})
+
+    @staticmethod
+    def key_from_group_key(group_key):
+        """
+        Returns the datastore key of the DomainStatistics shard of the
+        entity group with the given root key.
+        """
+        return db.Key.from_path('DomainStatistics',
+                                DomainStatistics.KEY_NAME,
+                                parent=group_key)
+
+
+class ProgressSeries(db.Model):
+    """
+    Hourly samples of the number of completed and of all atomic tasks
+    of a root task, or of all the root tasks of an entity group, used
+    for burndown charts. The series of a root task is a child of the
+    task, the series of an entity group is a child of the Domain or
+    DomainShard entity. Both have the key_name ProgressSeries.KEY_NAME.
+
+    The samples are recorded by workers.update_domain_statistics(), in
+    the same transaction as the counts change.
+    """
+    KEY_NAME = 'progress'
+    # Maximum number of samples in a series. The oldest samples are
+    # dropped first.
+    MAX_SAMPLES = 24 * 180
+
+    # The hour of each sample, in hours since the epoch. Only the last
+    # sample in each hour is kept.
+    hours = db.ListProperty(int, indexed=False)
+    # The number of completed atomic tasks at the time of each sample.
+    completed = db.ListProperty(int, indexed=False)
+    # The number of atomic tasks at the time of each sample.
+    atomic = db.ListProperty(int, indexed=False)
+
+    def add_sample(self, time, completed, atomic):
+        """
+        Records the counts at |time|. A sample in the same hour as the
+        last sample replaces it.
+
+        Returns:
+            True if the series has changed.
+        """
+        hour = calendar.timegm(time.utctimetuple()) // 3600
+        if self.hours and self.hours[-1] >= hour:
+            if (self.completed[-1], self.atomic[-1]) == (completed, atomic):
+                return False
+            self.completed[-1] = completed
+            self.atomic[-1] = atomic
+            return True
+        self.hours.append(hour)
+        self.completed.append(completed)
+        self.atomic.append(atomic)
+        if len(self.hours) > self.MAX_SAMPLES:
+            self.hours = self.hours[-self.MAX_SAMPLES:]
+            self.completed = self.completed[-self.MAX_SAMPLES:]
+            self.atomic = self.atomic[-self.MAX_SAMPLES:]
+        return True
+
+    def samples(self):
+        """
+        Returns a list of (hour, completed, atomic) tuples, with the
+        hour in hours since the epoch.
+        """
+        return zip(self.hours, self.completed, self.atomic)
+
+    @staticmethod
+    def key_from_parent_key(parent_key):
+        """
+        Returns the datastore key of the ProgressSeries of the root
+        task or entity group root with the given key.
+        """
+        return db.Key.from_path('ProgressSeries',
+                                ProgressSeries.KEY_NAME,
+                                parent=parent_key)
+
+
+class TaskLogPage(db.Model):
+    """
+    A page of the append-only log of the mutations of a task, such as
+    assignee changes and completion. The events are packed into pages
+    of PAGE_SIZE events, so the recent history of a task can be
+    fetched with a single batch get, regardless of the number of
+    changes. The pages are children of the task, with the key_name
+    'page<number>', and the events are appended in the same
+    transaction as the mutation they record, see api.py.
+    """
+    # Number of events in a page.
+    PAGE_SIZE = 100
+    # Maximum length of a string value in an event. Longer values,
+    # such as long descriptions, are truncated.
+    MAX_VALUE_LENGTH = 1000
+
+    # The events in the page, from old to new. Each event is a record
+    # with the following fields:
+    #  time: the time of the mutation, in seconds since the epoch
+    #  user: the identifier of the user that made the mutation
+    #  kind: 'assignee', 'completed', 'description' or 'parent'
+    #  value: the new value of the changed property, which is a user
+    #    identifier, a boolean, a string and a task identifier or None
+    #    respectively.
+    events = JsonProperty(default=[])
+
+    def add_event(self, time, user_identifier, kind, value):
+        """
+        Appends an event to the page. The page must not be full.
+        """
+        if isinstance(value, basestring):
+            value = value[:self.MAX_VALUE_LENGTH]
+        self.events = self.events + [{
+                'time': calendar.timegm(time.utctimetuple()),
+                'user': user_identifier,
+                'kind': kind,
+                'value': value }]
+
+    def number(self):
+        """Returns the number of this page in the log of its task."""
+        return int(self.key().name()[len('page'):])
+
+    @staticmethod
+    def key_from_task_key(task_key, page):
+        """
+        Returns the datastore key of the page with number |page| of
+        the log of the task with the given key.
+        """
+        return db.Key.from_path('TaskLogPage', 'page%d' % page,
+                                parent=task_key)
+
+
+class TaskTreeSnapshot(db.Model):
+    """
+    A compact snapshot of the entire task tree of a domain, used to
+    serve the 'all' view without querying the datastore. Each entity
+    group of a domain has at most one instance, which is a child of
+    the Domain or DomainShard entity with the key_name
+    TaskTreeSnapshot.KEY_NAME. The snapshots of the groups of a
+    sharded domain can be combined with merge().
+
+    The snapshot is maintained by the propagation worker, which
+    updates the records of all the tasks it touches in the same
+    transaction. It is only up to date if no propagation is pending
+    for the entity group. The records are changed in the decoded
+    data, which must be encoded with encode() before the snapshot is
+    stored.
+
+    The data is stored as compressed JSON, with the following field:
+     tasks: a dictionary of task records, keyed by task identifier.
+        Each record is a list with the fields listed in the RECORD_*
+        constants below.
+    """
+    KEY_NAME = 'tasktree'
+
+    RECORD_PARENT = 0
+    RECORD_TITLE = 1
+    RECORD_TIME = 2
+    RECORD_COMPLETED = 3
+    RECORD_SIZE = 4
+    RECORD_ATOMIC_TASK_COUNT = 5
+    RECORD_HAS_OPEN_TASKS = 6
+    RECORD_ASSIGNEE = 7
+    # A dictionary with a [completed, all] pair for each assignee,
+    # keyed by assignee identifier.
+    RECORD_ASSIGNEES = 8
+    # Missing in records that were stored before the field was added.
+    RECORD_VERSION = 9
+
+    data = aetycoon.CompressedBlobProperty(default=None)
+
+    @staticmethod
+    def key_from_group_key(group_key):
+        """
+        Returns the datastore key of the TaskTreeSnapshot of the
+        entity group with the given root key.
+        """
+        return db.Key.from_path('TaskTreeSnapshot',
+                                TaskTreeSnapshot.KEY_NAME,
+                                parent=group_key)
+
+    @staticmethod
+    def merge(snapshots):
+        """
+        Returns a new snapshot that contains the tasks of all the
+        given snapshots of the entity groups of a single domain. The
+        returned snapshot must not be stored.
+        """
+        domain_key = Domain.key_from_name(snapshots[0].domain_identifier())
+        merged = TaskTreeSnapshot(parent=domain_key,
+                                  key_name=TaskTreeSnapshot.KEY_NAME)
+        data = merged._decoded()
+        for snapshot in snapshots:
+            data['tasks'].update(snapshot._decoded()['tasks'])
+        return merged
+
+    def domain_identifier(self):
+        """Returns the identifier of the domain of the snapshot."""
+        return Domain.identifier_from_group_key(self.parent_key())
+
+    def _decoded(self):
+        """Returns the decoded data. The data is decoded only once."""
+        if not hasattr(self, '_decoded_data'):
+            if self.data:
+                self._decoded_data = json.loads(self.data)
             else:
-                return "%d tasks left" % (remaining,)
-        return ""
+                self._decoded_data = { 'tasks': {} }
+            self._children = None
+            self._modified = False
+        return self._decoded_data
 
+    def _modify(self):
+        """Returns the decoded data, which is about to be changed."""
+        data = self._decoded()
+        self._children = None
+        self._modified = True
+        return data
 
-    def is_active(self, user_identifier):
+    def encode(self):
         """
-        Returns true if this task is active for the given user. A task
-        is active iff it has one or more atomic tasks that have not
-        yet been completed by the user.
+        Encodes the decoded data into the data property, if it has
+        been changed since it was last encoded.
         """
-        if self.is_completed():
-            # completed tasks cannot be active.
-            return False
-        record = self.derived_assignees.get(user_identifier)
-        if not record:
-            return False
-        return (record.get('all') - record.get('completed')) > 0
+        data = self._decoded()
+        if self._modified:
+            self.data = json.dumps(data, separators=(',', ':'))
+            self._modified = False
 
-    def is_completed(self):
+    def update_tasks(self, tasks):
         """
-        Returns true iff this task is completed.
+        Updates the records of the given tasks in the snapshot.
+
+        Args:
+            tasks: A list of Task model instances
         """
-        return self.derived_completed
+        data = self._modify()
+        for task in tasks:
+            assignees = dict((id, [record['completed'], record['all']])
+                             for id, record
+                             in task.derived_assignees.iteritems())
+            data['tasks'][task.identifier()] = [
+                task.parent_task_identifier(),
+                task.title(),
+                calendar.timegm(task.time.utctimetuple()) if task.time else 0,
+                int(task.is_completed()),
+                task.derived_size,
+                task.atomic_task_count(),
+                int(task.has_open_tasks()),
+                task.assignee_identifier(),
+                assignees,
+                task.version
+                ]
 
-    def atomic(self):
-        """Returns true if this task is an atomic task"""
-        return self.derived_size == 1
+    def remove_tasks(self, task_identifiers):
+        """
+        Removes the records of the tasks with the given identifiers
+        from the snapshot.
+        """
+        data = self._modify()
+        for identifier in task_identifiers:
+            data['tasks'].pop(identifier, None)
 
-    def root(self):
-        """Returns true if this task has no parent task"""
-        return not self.parent_task_key()
+    def task_count(self):
+        """Returns the number of tasks in the snapshot."""
+        return len(self._decoded()['tasks'])
 
-    def open(self):
-        """Returns true if this task is an open task."""
-        return (self.atomic() and
-                not self.is_completed() and
-                not self.assignee_identifier())
+    def get_task(self, task_identifier):
+        """
+        Returns a TaskTreeNode for the task with the given identifier,
+        or None if the task is not in the snapshot.
+        """
+        if task_identifier is None:
+            return None
+        data = self._decoded()
+        record = data['tasks'].get(str(task_identifier))
+        if record is None:
+            return None
+        return TaskTreeNode(self, str(task_identifier), record)
 
-    def hierarchy_level(self):
-        """Returns the level of this task in the task hierarchy."""
-        return self.derived_level
+    def children(self, task_identifier=None):
+        """
+        Returns a list of TaskTreeNode instances of all direct subtasks
+        of the task with the given identifier. If no identifier is
+        given, all root tasks are returned. The list is not sorted.
+        """
+        data = self._decoded()
+        if self._children is None:
+            self._children = {}
+            for identifier, record in data['tasks'].iteritems():
+                parent = record[TaskTreeSnapshot.RECORD_PARENT]
+                self._children.setdefault(parent, []).append(identifier)
+        return [TaskTreeNode(self, identifier, data['tasks'][identifier])
+                for identifier in self._children.get(task_identifier, [])]
 
-    def number_of_subtasks(self):
-        """The total number of subtasks of this task."""
-        return self.derived_size - 1
+    def level(self, task_identifier):
+        """
+        Returns the level of the task with the given identifier in
+        the hierarchy.
+        """
+        tasks = self._decoded()['tasks']
+        level = -1
+        visited = set()
+        while task_identifier in tasks and not task_identifier in visited:
+            visited.add(task_identifier)
+            level += 1
+            task_identifier = tasks[task_identifier][
+                TaskTreeSnapshot.RECORD_PARENT]
+        return level
 
-    def has_open_tasks(self):
+
+class TaskTreeNode(DerivedTaskProperties):
+    """
+    A read-only task read from a TaskTreeSnapshot. It supports the
+    same functions as the Task model that do not require the
+    description, user or context of the task.
+    """
+    def __init__(self, snapshot, task_identifier, record):
+        self._snapshot = snapshot
+        self._identifier = task_identifier
+        self._parent_identifier = record[TaskTreeSnapshot.RECORD_PARENT]
+        self._title = record[TaskTreeSnapshot.RECORD_TITLE]
+        self._assignee_identifier = record[TaskTreeSnapshot.RECORD_ASSIGNEE]
+        self.time = datetime.datetime.utcfromtimestamp(
+            record[TaskTreeSnapshot.RECORD_TIME])
+        self.derived_completed = bool(
+            record[TaskTreeSnapshot.RECORD_COMPLETED])
+        self.derived_size = record[TaskTreeSnapshot.RECORD_SIZE]
+        self.derived_atomic_task_count = record[
+            TaskTreeSnapshot.RECORD_ATOMIC_TASK_COUNT]
+        self.derived_has_open_tasks = bool(
+            record[TaskTreeSnapshot.RECORD_HAS_OPEN_TASKS])
+        self.derived_assignees = dict(
+            (id, { 'id': id,
+                   'completed': completed,
+                   'all': all })
+            for id, (completed, all)
+            in record[TaskTreeSnapshot.RECORD_ASSIGNEES].iteritems())
+        self.derived_completed_task_count = sum(
+            r['completed'] for r in self.derived_assignees.itervalues())
+        self.derived_open_task_count = None
+        self.version = None
+        if len(record) > TaskTreeSnapshot.RECORD_VERSION:
+            self.version = record[TaskTreeSnapshot.RECORD_VERSION]
+
+    @property
+    def derived_level(self):
+        return self._snapshot.level(self._identifier)
+
+    def identifier(self):
+        """Returns a string with the task identifier"""
+        return self._identifier
+
+    def domain_identifier(self):
+        """Returns the domain identifier of the domain of this task."""
+        return self._snapshot.domain_identifier()
+
+    def parent_task_identifier(self):
         """
-        Returns true if this task contains one or more open tasks, or
-        is an open tasks itself.
+        Returns a string identifier of the parent task of this
+        task, or None if the task has no parent task.
         """
-        return self.derived_has_open_tasks
+        return self._parent_identifier
 
-    def atomic_task_count(self):
-        """Returns the total number of atomic tasks in this task hierarchy."""
-        return self.derived_atomic_task_count
+    def parent_task_key(self):
+        """Returns the key of the parent task, or None."""
+        if not self._parent_identifier:
+            return None
+        return Task.key_from_identifier(self.domain_identifier(),
+                                        self._parent_identifier)
+
+    def title(self):
+        """Returns the title of the task."""
+        return self._title
+
+    def assignee_identifier(self):
+        """
+        Returns the identifier of the assignee of this task, or None
+        in case there is no assignee.
+        """
+        return self._assignee_identifier
+
+    def assignee_key(self):
+        """Returns the key of the assignee of this task, or None."""
+        if not self._assignee_identifier:
+            return None
+        return db.Key.from_path('User', self._assignee_identifier)
 
     def __str__(self):
         return "%s/%s" % (self.domain_identifier(), self.identifier())
 
 
-class TaskIndex(db.Model):
+def prefetch_references(entities, *names):
     """
-    The TaskIndex stores the entire task identifier hierarchy of each
-    task, which is the parent entity of the index. These indices help
-    with certain task hierarchy queries.
+    Resolves the reference properties with the given names of a list
+    of entities in a single batch get, so that dereferencing them
+    afterwards does not access the datastore. The referenced entities
+    are read from memcache if possible.
 
-    Additionally, it stores all the assignees to that task. This
-    can also be used for a query.
+    Entities that are None or not a db.Model instance, such as
+    TaskTreeNodes, are ignored, as are references that are None or
+    point to an entity that does not exist.
 
-    The key_name of each TaskIndex is set to the identifier of the
-    Task that is the index of.
+    Args:
+        entities: A list of model instances.
+        *names: The names of the reference properties to resolve.
+
+    Returns:
+        A dictionary with the referenced entities, keyed by their key.
+        The value is None for references to entities that do not
+        exist.
     """
-    # An ordered list of all the parent identifiers of the task.
-    # Empty if the task has no parents.
-    hierarchy = db.StringListProperty(required=True, default=[])
-    # The level in the hierarchy of this index. Equivalent to the
-    # number of items in the hierarchy list.
-    level = aetycoon.LengthProperty(hierarchy)
-    # An list of identifiers of all users that are participating in
-    # this task, because they are assigned to an atomic subtask.
-    assignees = db.StringListProperty(default=[])
-    # The size of the assignees list
-    assignee_count = aetycoon.LengthProperty(assignees)
-    # Whether the associated task is completed.
-    completed = db.BooleanProperty(default=False)
-    # Whether the associated task is an atomic task.
-    atomic = db.BooleanProperty(default=False)
-    # Mirrors the |derived_has_open_tasks| property of the Task.
-    has_open_tasks = db.BooleanProperty(default=False)
+    return prefetch_references_async(entities, *names).get_result()
+
+
+def prefetch_references_async(entities, *names):
+    """
+    Asynchronous version of prefetch_references(). The batch get is
+    started right away, and the references are resolved when
+    get_result() is called on the returned future.
+    """
+    references = []
+    for entity in entities:
+        if not isinstance(entity, db.Model):
+            continue
+        for name in names:
+            key = getattr(type(entity), name).get_value_for_datastore(entity)
+            if key is not None:
+                references.append((entity, name, key))
+    keys = list(set(key for entity, name, key in references))
+    return _ReferencesFuture(references, keys,
+                             caching.get_async(keys) if keys else None)
+
+
+class _ReferencesFuture(object):
+    """The result of prefetch_references_async()."""
+    def __init__(self, references, keys, future):
+        self._references = references
+        self._keys = keys
+        self._future = future
+        self._referenced = {}
+
+    def get_result(self):
+        """
+        Waits for the batch get, resolves the references, and returns
+        the dictionary of referenced entities.
+        """
+        if self._future:
+            self._referenced = dict(zip(self._keys,
+                                        self._future.get_result()))
+            self._future = None
+            for entity, name, key in self._references:
+                if self._referenced[key]:
+                    setattr(entity, name, self._referenced[key])
+        return self._referenced
@@ -0,0 +1,208 @@
+#  Copyright 2011 Tijmen Roberti
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+A full-text index on the descriptions of the tasks.
+
+The index is an inverted index, with a SearchTerm entity for each
+term of each domain that holds the posting list of the term: the
+identifiers of the tasks that contain the term. A query is answered
+by intersecting the posting lists of its terms.
+
+New tasks are appended to the posting lists, so the lists run from
+old to new. The tasks that are added in the same update are appended
+in the order of their numeric ids, see _creation_order().
+
+The posting lists are written by the UpdateSearchIndex worker, which
+runs in its own queue. The posting lists that change are found with
+batched gets, and each of them is updated in its own transaction, so
+concurrent workers do not lose each other's updates. The terms under
+which a task is indexed are recorded in its TaskSearchTerms, so they
+can be removed after the description changes.
+
+The index is not updated in the same transaction as the tasks, so it
+can lag behind the descriptions. The results of a query must be
+verified against the current descriptions of the tasks, see
+matches().
+"""
+import re
+from google.appengine.ext import db
+from model import SearchTerm
+import caching
+
+# Maximum number of tasks in a posting list. Terms that are contained
+# in more tasks are too common to narrow down a query.
+MAX_POSTINGS = 20000
+# Maximum length of a term. Longer words are truncated.
+MAX_TERM_LENGTH = 100
+# Number of SearchTerms that are fetched or stored in a single batch.
+BATCH_SIZE = 200
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+STOP_WORDS = frozenset([
+        'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from',
+        'in', 'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to',
+        'with'])
+
+
+def tokenize(text):
+    """
+    Returns the set of search terms in |text|. The terms are the
+    lowercased words in the text, except for the STOP_WORDS.
+
+    Args:
+        text: A string, or None.
+
+    Returns:
+        A set of strings.
+    """
+    if not text:
+        return set()
+    return set(word[:MAX_TERM_LENGTH] for word in _WORD.findall(text.lower())
+               if not word in STOP_WORDS)
+
+
+def matches(terms, text):
+    """
+    Returns True if |text| contains all the search |terms|.
+    """
+    return terms <= tokenize(text)
+
+
+def _creation_order(identifier):
+    """
+    Returns a sort key for a task identifier, which orders the tasks
+    by their numeric id. The ids are allocated in increasing order in
+    each entity group, so this approximates the order in which the
+    tasks were created. Identifiers of tasks in a DomainShard, such
+    as '3-17', are ordered by their id before their shard number.
+    Identifiers that are not numeric are ordered last.
+    """
+    shard, _, id = identifier.rpartition('-')
+    if id.isdigit() and (not shard or shard.isdigit()):
+        return (0, int(id), int(shard or 0))
+    return (1, identifier)
+
+
+def _changed_posting_list(key, entity, added, removed):
+    """
+    Returns the SearchTerm with the given key, after the tasks in
+    |added| have been added to its posting list and the tasks in
+    |removed| have been removed from it, or None if the posting list
+    does not change. The posting list of the returned SearchTerm is
+    empty if the SearchTerm must be deleted.
+
+    Args:
+        key: The key of the SearchTerm
+        entity: The stored SearchTerm, or None. It is updated in place.
+        added: A set of task identifiers, which are appended in
+            the order of _creation_order().
+        removed: A set of task identifiers
+    """
+    if not entity:
+        if not added:
+            return None
+        entity = SearchTerm(key=key)
+    if entity.overflow:
+        return None
+    removed = removed - added
+    tasks = [identifier for identifier in entity.tasks
+             if not identifier in removed]
+    tasks.extend(sorted(added - set(entity.tasks), key=_creation_order))
+    if tasks == entity.tasks:
+        return None
+    if len(tasks) > MAX_POSTINGS:
+        entity.overflow = True
+        tasks = []
+    entity.tasks = tasks
+    return entity
+
+
+def _update_posting_list(key, added, removed):
+    """
+    Updates a posting list, see _changed_posting_list(). Must be run
+    in a transaction.
+    """
+    entity = _changed_posting_list(key, db.get(key), added, removed)
+    if not entity:
+        return
+    if entity.tasks or entity.overflow:
+        caching.put(entity)
+    elif entity.is_saved():
+        db.delete(key)
+        caching.invalidate(key)
+
+
+def update_postings(domain_identifier, added, removed):
+    """
+    Adds and removes tasks from the posting lists of the terms of a
+    domain. Posting lists that become empty are deleted.
+
+    The posting lists are read in batches, and only the lists that
+    change are updated, each in its own transaction. This function is
+    idempotent.
+
+    Args:
+        domain_identifier: The domain identifier string
+        added: A dictionary with the set of task identifiers that must
+            be added to the posting list of each term.
+        removed: A dictionary with the set of task identifiers that
+            must be removed from the posting list of each term.
+    """
+    terms = sorted(set(added) | set(removed))
+    for start in range(0, len(terms), BATCH_SIZE):
+        keys = [SearchTerm.key_from_term(domain_identifier, term)
+                for term in terms[start:start + BATCH_SIZE]]
+        for key, term, entity in zip(keys, terms[start:], db.get(keys)):
+            new_tasks = added.get(term, set())
+            old_tasks = removed.get(term, set())
+            if _changed_posting_list(key, entity, new_tasks, old_tasks):
+                db.run_in_transaction(_update_posting_list, key,
+                                      new_tasks, old_tasks)
+
+
+def find_candidates(domain_identifier, terms):
+    """
+    Returns the identifiers of the tasks that are in the posting lists
+    of all |terms|, from new to old in the order in which they were
+    added to the posting lists. The posting lists are fetched in
+    a single batch, and intersected starting with the shortest list.
+
+    Terms of which the posting list has overflowed do not narrow down
+    the result. The candidates must be verified with matches().
+
+    Args:
+        domain_identifier: The domain identifier string
+        terms: A non-empty set of terms, as returned by tokenize().
+
+    Returns:
+        A list of task identifiers, or None if all terms are too
+        common to select candidates.
+    """
+    entities = caching.get([SearchTerm.key_from_term(domain_identifier, term)
+                            for term in terms])
+    if not all(entities):
+        return []
+    postings = sorted((entity.tasks for entity in entities
+                       if not entity.overflow), key=len)
+    if not postings:
+        return None
+    candidates = set(postings[0])
+    for tasks in postings[1:]:
+        candidates.intersection_update(tasks)
+        if not candidates:
+            return []
+    return [identifier for identifier in reversed(postings[0])
+            if identifier in candidates]
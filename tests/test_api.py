@@ -0,0 +1,421 @@
+#  Copyright 2011 Tijmen Roberti
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Tests of the functions in api.py.
+"""
+import unittest
+from google.appengine.ext import db
+from model import DirtyTask, Task, TaskLogPage, TaskTreeSnapshot, User
+from tests.testcase import TestCase
+import api
+import workers
+
+
+class PagedItem(db.Model):
+    """An entity of the task lists in the paging tests."""
+    number = db.IntegerProperty()
+    even = db.BooleanProperty()
+
+
+class ParseTaskOutlineTest(unittest.TestCase):
+    def test_flat_outline(self):
+        self.assertEqual([{ 'description': 'First', 'subtasks': [] },
+                          { 'description': 'Second', 'subtasks': [] }],
+                         api.parse_task_outline("First\nSecond\n"))
+
+    def test_nested_outline(self):
+        outline = ("Root\n"
+                   "  Child\n"
+                   "    Grandchild\n"
+                   "  Sibling\n"
+                   "Other root\n")
+        self.assertEqual(
+            [{ 'description': 'Root',
+               'subtasks': [
+                        { 'description': 'Child',
+                          'subtasks': [{ 'description': 'Grandchild',
+                                         'subtasks': [] }] },
+                        { 'description': 'Sibling', 'subtasks': [] }] },
+             { 'description': 'Other root', 'subtasks': [] }],
+            api.parse_task_outline(outline))
+
+    def test_list_markers_and_empty_lines(self):
+        outline = ("- Root\n"
+                   "\n"
+                   "    *   Child\n"
+                   "-Not a marker\n")
+        self.assertEqual(
+            [{ 'description': 'Root',
+               'subtasks': [{ 'description': 'Child', 'subtasks': [] }] },
+             { 'description': '-Not a marker', 'subtasks': [] }],
+            api.parse_task_outline(outline))
+
+    def test_tabs_are_four_spaces(self):
+        outline = "Root\n\tTabbed\n    Spaced\n"
+        roots = api.parse_task_outline(outline)
+        self.assertEqual(['Tabbed', 'Spaced'],
+                         [node['description']
+                          for node in roots[0]['subtasks']])
+
+    def test_dedent_to_intermediate_level(self):
+        # A line that is indented less than its predecessor, but
+        # further than an earlier task, is a subtask of that task.
+        outline = ("Root\n"
+                   "      Deep\n"
+                   "   Middle\n")
+        roots = api.parse_task_outline(outline)
+        self.assertEqual(['Deep', 'Middle'],
+                         [node['description']
+                          for node in roots[0]['subtasks']])
+
+    def test_empty_outline(self):
+        self.assertEqual([], api.parse_task_outline(""))
+        self.assertEqual([], api.parse_task_outline("\n  \n\t\n"))
+
+
+class CursorTest(unittest.TestCase):
+    def test_first_page(self):
+        self.assertEqual((['', ''], 0), api._decode_cursor(None, 2))
+        self.assertEqual(([''], 0), api._decode_cursor('', 1))
+
+    def test_positions_round_trip(self):
+        positions = ['abc', None, '']
+        cursor = api._encode_cursor(positions)
+        self.assertFalse(api.is_task_tree_cursor(cursor))
+        self.assertEqual((positions, 0), api._decode_cursor(cursor, 3))
+
+    def test_offset_cursor(self):
+        self.assertTrue(api.is_task_tree_cursor('o25'))
+        self.assertTrue(api.is_task_tree_cursor(None))
+        self.assertEqual((['', ''], 25), api._decode_cursor('o25', 2))
+
+    def test_invalid_cursors(self):
+        for cursor in ['x1', 'o', 'o-1', 'oab', 'c!!', 'cYWJj',
+                       api._encode_cursor({ 'a': 1 }),
+                       api._encode_cursor(['abc']),
+                       api._encode_cursor([[None, 0], [None, 0]]),
+                       api._encode_cursor([1, None])]:
+            self.assertRaises(ValueError, api._decode_cursor, cursor, 2)
+
+
+class FetchPageTest(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        db.put([PagedItem(number=number, even=(number % 2 == 0))
+                for number in range(7)])
+
+    def query(self, even=None):
+        query = PagedItem.all()
+        if even is not None:
+            query.filter('even =', even)
+        return query.order('number')
+
+    def numbers(self, items):
+        return [item.number for item in items]
+
+    def fetch_all(self, queries, limit):
+        """
+        Returns the pages of the task list of |queries|, and the
+        cursors that are returned for each page.
+        """
+        pages, cursors = [], []
+        cursor = None
+        while True:
+            items, cursor = api._fetch_page(queries(), limit, cursor)
+            pages.append(self.numbers(items))
+            cursors.append(cursor)
+            if not cursor:
+                return pages, cursors
+
+    def by_number(self, item):
+        return item.number
+
+    def test_single_query(self):
+        pages, cursors = self.fetch_all(
+            lambda: [(self.query(), self.by_number)], 3)
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]], pages)
+        # A single query continues from its datastore cursor.
+        for cursor in cursors[:-1]:
+            positions, skip = api._decode_cursor(cursor, 1)
+            self.assertTrue(positions[0])
+            self.assertEqual(0, skip)
+
+    def test_exact_last_page(self):
+        items, cursor = api._fetch_page([(self.query(), self.by_number)], 7)
+        self.assertEqual(range(7), self.numbers(items))
+        items, cursor = api._fetch_page([(self.query(), self.by_number)], 7,
+                                        cursor)
+        self.assertEqual([], items)
+        self.assertEqual(None, cursor)
+
+    def test_merged_queries(self):
+        queries = lambda: [(self.query(even=True), self.by_number),
+                           (self.query(even=False), self.by_number)]
+        pages, cursors = self.fetch_all(queries, 3)
+        self.assertEqual([[0, 1, 2], [3, 4, 5], [6]], pages)
+        # Both queries are partly consumed by the first page, and
+        # continue from a cursor at their first result that is not in
+        # the page.
+        positions, skip = api._decode_cursor(cursors[0], 2)
+        self.assertEqual(0, skip)
+        self.assertTrue(all(positions))
+        self.assertNotEqual(positions[0], positions[1])
+        # After the second page, the odd query has no more results.
+        positions, skip = api._decode_cursor(cursors[1], 2)
+        self.assertTrue(positions[0])
+        self.assertEqual(None, positions[1])
+
+    def test_unconsumed_query_keeps_its_position(self):
+        def queries():
+            low = PagedItem.all().filter('number <', 4).order('number')
+            high = PagedItem.all().filter('number >=', 4).order('number')
+            return [(low, self.by_number), (high, self.by_number)]
+        items, cursor = api._fetch_page(queries(), 3)
+        self.assertEqual([0, 1, 2], self.numbers(items))
+        positions, skip = api._decode_cursor(cursor, 2)
+        self.assertTrue(positions[0])
+        self.assertEqual('', positions[1])
+        items, cursor = api._fetch_page(queries(), 3, cursor)
+        self.assertEqual([3, 4, 5], self.numbers(items))
+        positions, skip = api._decode_cursor(cursor, 2)
+        self.assertEqual(None, positions[0])
+        self.assertTrue(positions[1])
+        items, cursor = api._fetch_page(queries(), 3, cursor)
+        self.assertEqual([6], self.numbers(items))
+        self.assertEqual(None, cursor)
+
+    def test_offset_cursor(self):
+        queries = lambda: [(self.query(even=True), self.by_number),
+                           (self.query(even=False), self.by_number)]
+        items, cursor = api._fetch_page(queries(), 3, 'o2')
+        self.assertEqual([2, 3, 4], self.numbers(items))
+        # The skipped results are consumed, and the next page
+        # continues from datastore cursors.
+        positions, skip = api._decode_cursor(cursor, 2)
+        self.assertEqual(0, skip)
+        self.assertTrue(all(positions))
+        items, cursor = api._fetch_page(queries(), 3, cursor)
+        self.assertEqual([5, 6], self.numbers(items))
+        self.assertEqual(None, cursor)
+
+    def test_invalid_cursor(self):
+        self.assertRaises(ValueError, api._fetch_page,
+                          [(self.query(), self.by_number)], 3,
+                          api._encode_cursor(['', '']))
+
+
+class AssigneeNamesTest(TestCase):
+    def test_revision(self):
+        self.assertEqual(0, api.get_assignee_names_revision(self.DOMAIN))
+        bob = User(key_name='bob', name='Bob')
+        api.register_assignee_names(self.DOMAIN, [bob])
+        self.assertEqual({ 'bob': 'Bob' }, api.get_assignee_names(self.DOMAIN))
+        self.assertEqual(1, api.get_assignee_names_revision(self.DOMAIN))
+        # Registering the same name does not change the revision.
+        api.register_assignee_names(self.DOMAIN, [bob])
+        self.assertEqual(1, api.get_assignee_names_revision(self.DOMAIN))
+        bob.name = 'Robert'
+        api.register_assignee_names(self.DOMAIN, [bob])
+        self.assertEqual({ 'bob': 'Robert' },
+                         api.get_assignee_names(self.DOMAIN))
+        self.assertEqual(2, api.get_assignee_names_revision(self.DOMAIN))
+
+
+class GroupTasksTest(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        # root
+        #  +- a
+        #  +- b
+        #      +- c
+        self.root = self.new_task(1)
+        self.a = self.new_task(2, parent=self.root, derived_level=1)
+        self.b = self.new_task(3, parent=self.root, derived_level=1)
+        self.c = self.new_task(4, parent=self.b, derived_level=2)
+
+    def identifiers(self, tasks):
+        return [task.identifier() for task in tasks]
+
+    def test_supertasks_first(self):
+        tasks = api._group_tasks([self.c, self.a, self.root, self.b])
+        self.assertEqual(['1', '3', '4', '2'], self.identifiers(tasks))
+
+    def test_inverted(self):
+        tasks = api._group_tasks([self.c, self.a, self.root, self.b],
+                                 inverted=True)
+        self.assertEqual(['4', '3', '2', '1'], self.identifiers(tasks))
+
+    def test_original_order_is_kept(self):
+        tasks = api._group_tasks([self.root, self.a, self.b, self.c])
+        self.assertEqual(['1', '2', '3', '4'], self.identifiers(tasks))
+
+    def test_missing_parents(self):
+        # Tasks of which the parent is not listed are roots.
+        tasks = api._group_tasks([self.c, self.a])
+        self.assertEqual(['4', '2'], self.identifiers(tasks))
+
+    def test_min_task_level(self):
+        tasks = api._group_tasks([self.c, self.a, self.root, self.b],
+                                 min_task_level=1)
+        self.assertEqual(['3', '4', '2'], self.identifiers(tasks))
+
+    def test_deep_hierarchy(self):
+        # Deeper than the recursion limit.
+        tasks = [self.new_task(100)]
+        for level in range(1, 5000):
+            tasks.append(self.new_task(100 + level, parent=tasks[-1],
+                                       derived_level=level))
+        grouped = api._group_tasks(list(reversed(tasks)))
+        self.assertEqual(self.identifiers(tasks), self.identifiers(grouped))
+        grouped = api._group_tasks(tasks, inverted=True)
+        self.assertEqual(self.identifiers(reversed(tasks)),
+                         self.identifiers(grouped))
+
+    def test_complete_hierarchy_arguments(self):
+        self.assertRaises(ValueError, api._group_tasks, [self.c],
+                          complete_hierarchy=True)
+        self.assertRaises(ValueError, api._group_tasks, [self.c],
+                          complete_hierarchy=True, domain=self.DOMAIN)
+
+
+class TaskLogTest(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.user = User(key_name='alice', name='Alice')
+        self.task = self.new_task(1)
+
+    def log(self, count):
+        """Appends |count| description events to the log of the task."""
+        for number in range(count):
+            page = api._log_task_event(self.task, self.user, 'description',
+                                       'v%d' % self.task.log_size)
+            page.put()
+
+    def values(self, events):
+        return [event['value'] for event in events]
+
+    def test_empty_log(self):
+        self.assertEqual(([], None), api.get_task_log(self.task))
+        self.assertRaises(ValueError, api.get_task_log, self.task, 0)
+
+    def test_events_are_packed_in_pages(self):
+        self.log(TaskLogPage.PAGE_SIZE + 1)
+        self.assertEqual(TaskLogPage.PAGE_SIZE + 1, self.task.log_size)
+        pages = db.get([TaskLogPage.key_from_task_key(self.task.key(),
+                                                      number)
+                        for number in range(3)])
+        self.assertEqual(TaskLogPage.PAGE_SIZE, len(pages[0].events))
+        self.assertEqual(['v%d' % TaskLogPage.PAGE_SIZE],
+                         self.values(pages[1].events))
+        self.assertEqual(None, pages[2])
+
+    def test_last_pages(self):
+        self.log(5)
+        events, previous_page = api.get_task_log(self.task)
+        self.assertEqual(['v4', 'v3', 'v2', 'v1', 'v0'], self.values(events))
+        self.assertEqual('alice', events[0]['user'])
+        self.assertEqual('description', events[0]['kind'])
+        self.assertEqual(None, previous_page)
+
+    def test_older_pages(self):
+        size = TaskLogPage.PAGE_SIZE
+        self.log(2 * size + size // 2)
+        # The last two pages are returned first.
+        events, previous_page = api.get_task_log(self.task)
+        self.assertEqual(['v%d' % number
+                          for number in reversed(range(size,
+                                                       self.task.log_size))],
+                         self.values(events))
+        self.assertEqual(0, previous_page)
+        events, previous_page = api.get_task_log(self.task, previous_page)
+        self.assertEqual(['v%d' % number for number in reversed(range(size))],
+                         self.values(events))
+        self.assertEqual(None, previous_page)
+        events, previous_page = api.get_task_log(self.task, 2)
+        self.assertEqual(size // 2, len(events))
+        self.assertEqual(1, previous_page)
+
+    def test_invalid_pages(self):
+        self.log(3)
+        self.assertRaises(ValueError, api.get_task_log, self.task, 1)
+        self.assertRaises(ValueError, api.get_task_log, self.task, -1)
+
+
+class ImportTasksTest(TestCase):
+    TREE = [{ 'description': 'First',
+              'subtasks': [{ 'description': 'Subtask' }] },
+            { 'description': 'Second' }]
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.user = self.create_domain()
+        self.parent = api.create_task(self.DOMAIN, self.user, 'Parent')
+        self.group_key = self.parent.group_key()
+        workers._build_task_tree_snapshot(self.group_key)
+        db.delete(DirtyTask.all(keys_only=True).ancestor(self.group_key))
+
+    def markers(self):
+        return dict((marker.key().name(), marker) for marker
+                    in DirtyTask.all().ancestor(self.group_key))
+
+    def snapshot(self):
+        return db.get(TaskTreeSnapshot.key_from_group_key(self.group_key))
+
+    def test_parent_is_marked_dirty(self):
+        self.assertTrue(self.snapshot())
+        tasks = api.import_tasks(self.DOMAIN, self.user, self.TREE,
+                                 self.parent.identifier())
+        self.assertEqual(3, len(tasks))
+        markers = self.markers()
+        self.assertEqual([self.parent.identifier()], markers.keys())
+        self.assertTrue(markers[self.parent.identifier()].full)
+        # The snapshot is built again by the propagation worker.
+        self.assertEqual(None, self.snapshot())
+
+    def test_root_tasks_are_marked_dirty(self):
+        tasks = api.import_tasks(self.DOMAIN, self.user, self.TREE)
+        roots = [task.identifier() for task in tasks if task.root()]
+        self.assertEqual(2, len(roots))
+        self.assertEqual(sorted(roots), sorted(self.markers().keys()))
+
+    def test_failed_import_is_repaired(self):
+        # The transaction after the tasks are stored fails.
+        def fail(*args, **kwds):
+            raise db.TransactionFailedError()
+        update_task_tree_snapshot = workers.update_task_tree_snapshot
+        workers.update_task_tree_snapshot = fail
+        try:
+            self.assertRaises(db.TransactionFailedError, api.import_tasks,
+                              self.DOMAIN, self.user, self.TREE,
+                              self.parent.identifier())
+        finally:
+            workers.update_task_tree_snapshot = update_task_tree_snapshot
+        self.assertEqual(4, Task.all().ancestor(self.group_key).count())
+        self.assertTrue(self.markers()[self.parent.identifier()].full)
+        self.assertEqual(None, self.snapshot())
+        # The next propagation run recomputes the parent, and the
+        # snapshot is built from all the stored tasks.
+        db.run_in_transaction(workers._propagate_dirty_tasks,
+                              self.group_key)
+        workers._build_task_tree_snapshot(self.group_key)
+        parent = api.get_task(self.DOMAIN, self.parent.identifier(),
+                              use_cache=False)
+        self.assertEqual(4, parent.derived_size)
+        self.assertEqual(2, parent.atomic_task_count())
+        self.assertEqual(4, self.snapshot().task_count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#  Copyright 2011 Tijmen Roberti
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Tests of the request handlers in main.py.
+"""
+import unittest
+import webapp2
+from model import Domain
+from tests.testcase import TestCase
+import api
+import main
+
+
+class TaskHandlerTest(TestCase):
+    """
+    Tests the handlers that change a task, with a task in a sharded
+    domain, which has a string identifier.
+    """
+    def setUp(self):
+        TestCase.setUp(self)
+        user = self.create_domain(shard_count=2)
+        self.task_identifier = api.create_task(self.DOMAIN, user,
+                                               'Sharded task').identifier()
+
+    def post(self, url, **params):
+        request = webapp2.Request.blank(
+            url, POST=params, headers=[('Referer', '/d/%s/' % self.DOMAIN)])
+        return request.get_response(main.application)
+
+    def task(self):
+        return api.get_task(self.DOMAIN, self.task_identifier,
+                            use_cache=False)
+
+    def test_sharded_identifier(self):
+        self.assertTrue('-' in self.task_identifier)
+
+    def test_assign_task(self):
+        response = self.post('/assign-task', domain=self.DOMAIN,
+                             id=self.task_identifier, assignee='alice')
+        self.assertEqual(302, response.status_int)
+        self.assertEqual('alice', self.task().assignee_identifier())
+
+    def test_complete_task(self):
+        self.post('/assign-task', domain=self.DOMAIN,
+                  id=self.task_identifier, assignee='alice')
+        response = self.post('/set-task-completed', domain=self.DOMAIN,
+                             id=self.task_identifier, completed='true')
+        self.assertEqual(200, response.status_int)
+        self.assertTrue(self.task().completed)
+
+    def test_missing_task(self):
+        response = self.post('/assign-task', domain=self.DOMAIN,
+                             id='1-999999', assignee='alice')
+        self.assertEqual(403, response.status_int)
+        response = self.post('/set-task-completed', domain=self.DOMAIN,
+                             id='1-999999', completed='true')
+        self.assertEqual(403, response.status_int)
+
+    def test_move_candidates_are_in_the_same_group(self):
+        user = api.get_user('alice', use_cache=False)
+        for number in range(6):
+            api.create_task(self.DOMAIN, user, 'Root %d' % number)
+        group_key = self.task().group_key()
+        tasks, cursor = api.get_all_direct_subtasks(self.DOMAIN,
+                                                    group_key=group_key)
+        self.assertTrue(self.task_identifier in
+                        [task.identifier() for task in tasks])
+        self.assertTrue(all(task.group_key() == group_key
+                            for task in tasks))
+
+    def test_group_of_another_domain(self):
+        request = webapp2.Request.blank(
+            '/get-subtasks?domain=%s&view=all&radio=1&group=%s' % (
+                self.DOMAIN, Domain.key_from_name('other-domain')))
+        response = request.get_response(main.application)
+        self.assertEqual(400, response.status_int)
+
+
+if __name__ == '__main__':
+    unittest.main()
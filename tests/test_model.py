@@ -0,0 +1,96 @@
+#  Copyright 2011 Tijmen Roberti
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Tests of the models in model.py.
+"""
+import datetime
+import calendar
+import unittest
+from google.appengine.ext import db
+from model import ProgressSeries, TaskLogPage
+
+HOUR = datetime.timedelta(hours=1)
+
+
+class ProgressSeriesTest(unittest.TestCase):
+    def setUp(self):
+        self.series = ProgressSeries()
+        self.time = datetime.datetime(2012, 3, 4, 10, 15)
+        # Hours since the epoch of self.time
+        self.hour = 369682
+
+    def test_first_sample(self):
+        self.assertTrue(self.series.add_sample(self.time, 1, 3))
+        self.assertEqual([(self.hour, 1, 3)], self.series.samples())
+
+    def test_same_hour(self):
+        self.series.add_sample(self.time, 1, 3)
+        later = self.time + datetime.timedelta(minutes=40)
+        self.assertFalse(self.series.add_sample(later, 1, 3))
+        self.assertTrue(self.series.add_sample(later, 2, 4))
+        self.assertEqual([(self.hour, 2, 4)], self.series.samples())
+
+    def test_next_hours(self):
+        self.series.add_sample(self.time, 1, 3)
+        self.assertTrue(self.series.add_sample(self.time + HOUR, 1, 3))
+        self.assertTrue(self.series.add_sample(self.time + 5 * HOUR, 2, 3))
+        self.assertEqual([(self.hour, 1, 3), (self.hour + 1, 1, 3),
+                          (self.hour + 5, 2, 3)],
+                         self.series.samples())
+
+    def test_earlier_time_replaces_last_sample(self):
+        self.series.add_sample(self.time, 1, 3)
+        self.assertTrue(self.series.add_sample(self.time - 2 * HOUR, 0, 3))
+        self.assertEqual([(self.hour, 0, 3)], self.series.samples())
+
+    def test_oldest_samples_are_dropped(self):
+        self.series.MAX_SAMPLES = 3
+        for hours in range(5):
+            self.series.add_sample(self.time + hours * HOUR, hours, 10)
+        self.assertEqual([(self.hour + 2, 2, 10), (self.hour + 3, 3, 10),
+                          (self.hour + 4, 4, 10)],
+                         self.series.samples())
+
+
+class TaskLogPageTest(unittest.TestCase):
+    def setUp(self):
+        task_key = db.Key.from_path('Domain', 'test-domain', 'Task', 1)
+        self.page = TaskLogPage(key=TaskLogPage.key_from_task_key(task_key,
+                                                                  3))
+        self.time = datetime.datetime(2012, 3, 4, 10, 15)
+
+    def test_number(self):
+        self.assertEqual('page3', self.page.key().name())
+        self.assertEqual(3, self.page.number())
+
+    def test_add_event(self):
+        self.page.add_event(self.time, 'alice', 'assignee', 'bob')
+        self.page.add_event(self.time, 'bob', 'completed', True)
+        self.assertEqual(
+            [{ 'time': calendar.timegm(self.time.utctimetuple()),
+               'user': 'alice', 'kind': 'assignee', 'value': 'bob' },
+             { 'time': calendar.timegm(self.time.utctimetuple()),
+               'user': 'bob', 'kind': 'completed', 'value': True }],
+            self.page.events)
+        self.assertEqual([], TaskLogPage().events)
+
+    def test_long_values_are_truncated(self):
+        description = 'x' * (TaskLogPage.MAX_VALUE_LENGTH + 1)
+        self.page.add_event(self.time, 'alice', 'description', description)
+        self.assertEqual(description[:-1], self.page.events[0]['value'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#  Copyright 2011 Tijmen Roberti
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Tests of the full-text index in search.py.
+"""
+import unittest
+from google.appengine.ext import db
+from model import SearchTerm
+from tests.testcase import TestCase
+import search
+
+
+class TokenizeTest(unittest.TestCase):
+    def test_words(self):
+        self.assertEqual(set(['fix', 'login', 'page', '2']),
+                         search.tokenize("Fix the login-page (2)."))
+
+    def test_stop_words_and_duplicates(self):
+        self.assertEqual(set(['build', 'product']),
+                         search.tokenize("Build a product and a PRODUCT"))
+
+    def test_unicode(self):
+        self.assertEqual(set([u'caf\xe9', u'\xfcber']),
+                         search.tokenize(u"Caf\xe9 \xdcber"))
+
+    def test_long_words_are_truncated(self):
+        self.assertEqual(set(['x' * search.MAX_TERM_LENGTH]),
+                         search.tokenize('x' * (search.MAX_TERM_LENGTH + 10)))
+
+    def test_empty(self):
+        self.assertEqual(set(), search.tokenize(None))
+        self.assertEqual(set(), search.tokenize(""))
+        self.assertEqual(set(), search.tokenize("the, and... of"))
+
+    def test_matches(self):
+        self.assertTrue(search.matches(set(['login']), "Fix the Login"))
+        self.assertTrue(search.matches(set(), "Anything"))
+        self.assertFalse(search.matches(set(['login', 'page']),
+                                        "Fix the login"))
+
+
+class UpdatePostingsTest(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.max_postings = search.MAX_POSTINGS
+
+    def tearDown(self):
+        search.MAX_POSTINGS = self.max_postings
+        TestCase.tearDown(self)
+
+    def postings(self, term):
+        """Returns the stored SearchTerm of |term|, or None."""
+        return db.get(SearchTerm.key_from_term(self.DOMAIN, term))
+
+    def test_add_and_remove(self):
+        search.update_postings(self.DOMAIN,
+                               { 'login': set(['2', '1']),
+                                 'page': set(['1']) },
+                               {})
+        self.assertEqual(['1', '2'], self.postings('login').tasks)
+        self.assertEqual(['1'], self.postings('page').tasks)
+        search.update_postings(self.DOMAIN,
+                               { 'login': set(['3']) },
+                               { 'login': set(['1']) })
+        self.assertEqual(['2', '3'], self.postings('login').tasks)
+        self.assertEqual(['1'], self.postings('page').tasks)
+
+    def test_numeric_order(self):
+        search.update_postings(self.DOMAIN,
+                               { 'login': set(['10', '9', '12', '3-5']) },
+                               {})
+        self.assertEqual(['3-5', '9', '10', '12'],
+                         self.postings('login').tasks)
+        # New tasks are appended after the tasks that are indexed.
+        search.update_postings(self.DOMAIN, { 'login': set(['2']) }, {})
+        self.assertEqual(['3-5', '9', '10', '12', '2'],
+                         self.postings('login').tasks)
+        self.assertEqual(['2', '12', '10', '9', '3-5'],
+                         search.find_candidates(self.DOMAIN,
+                                                set(['login'])))
+
+    def test_empty_posting_lists_are_deleted(self):
+        search.update_postings(self.DOMAIN, { 'login': set(['1']) }, {})
+        search.update_postings(self.DOMAIN, {}, { 'login': set(['1']) })
+        self.assertEqual(None, self.postings('login'))
+        # Removing a task from a term that is not stored is a no-op.
+        search.update_postings(self.DOMAIN, {}, { 'page': set(['1']) })
+        self.assertEqual(None, self.postings('page'))
+
+    def test_idempotent(self):
+        added = { 'login': set(['1', '2']) }
+        removed = { 'page': set(['1']) }
+        search.update_postings(self.DOMAIN, added, removed)
+        search.update_postings(self.DOMAIN, added, removed)
+        self.assertEqual(['1', '2'], self.postings('login').tasks)
+        self.assertEqual(None, self.postings('page'))
+
+    def test_added_wins_over_removed(self):
+        search.update_postings(self.DOMAIN, { 'login': set(['1']) }, {})
+        search.update_postings(self.DOMAIN,
+                               { 'login': set(['1']) },
+                               { 'login': set(['1']) })
+        self.assertEqual(['1'], self.postings('login').tasks)
+
+    def test_many_terms(self):
+        terms = ['term%d' % number for number in range(search.BATCH_SIZE + 5)]
+        search.update_postings(self.DOMAIN,
+                               dict((term, set(['1'])) for term in terms),
+                               {})
+        keys = [SearchTerm.key_from_term(self.DOMAIN, term)
+                for term in terms]
+        self.assertEqual([['1']] * len(terms),
+                         [entity.tasks for entity in db.get(keys)])
+
+    def test_overflow(self):
+        search.MAX_POSTINGS = 2
+        search.update_postings(self.DOMAIN,
+                               { 'common': set(['1', '2', '3']) }, {})
+        entity = self.postings('common')
+        self.assertTrue(entity.overflow)
+        self.assertEqual([], entity.tasks)
+        # An overflowed posting list is no longer changed.
+        search.update_postings(self.DOMAIN, {}, { 'common': set(['1']) })
+        self.assertTrue(self.postings('common').overflow)
+
+    def test_find_candidates(self):
+        search.MAX_POSTINGS = 3
+        search.update_postings(self.DOMAIN,
+                               { 'login': set(['1', '2', '3']),
+                                 'page': set(['2', '3']),
+                                 'common': set(['1', '2', '3', '4']) },
+                               {})
+        self.assertEqual(['3', '2'],
+                         search.find_candidates(self.DOMAIN,
+                                                set(['login', 'page'])))
+        self.assertEqual(['3', '2'],
+                         search.find_candidates(self.DOMAIN,
+                                                set(['page', 'common'])))
+        self.assertEqual(None,
+                         search.find_candidates(self.DOMAIN,
+                                                set(['common'])))
+        self.assertEqual([],
+                         search.find_candidates(self.DOMAIN,
+                                                set(['login', 'missing'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,467 @@
+#  Copyright 2011 Tijmen Roberti
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Tests of the functions in workers.py.
+"""
+import datetime
+import unittest
+from google.appengine.ext import db
+from model import DirtyTask, Domain, DomainStatistics, Task, TaskIndex, User
+from tests.testcase import TestCase
+import api
+import workers
+
+
+class ComputeNewTaskTreeTest(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        # root
+        #  +- a (assigned to alice)
+        #  +- b
+        #      +- c (assigned to bob, completed)
+        #      +- d (open)
+        self.root = self.new_task(1)
+        self.a = self.new_task(2, parent=self.root, assignee='alice')
+        self.b = self.new_task(3, parent=self.root)
+        self.c = self.new_task(4, parent=self.b, assignee='bob',
+                               completed=True)
+        self.d = self.new_task(5, parent=self.b)
+        self.tasks = [self.root, self.a, self.b, self.c, self.d]
+        self.indexes = [TaskIndex(parent=task.key(), key_name=task.identifier())
+                        for task in self.tasks]
+        workers.compute_new_task_tree(self.tasks, self.indexes,
+                                      [[1, 2], [], [3, 4], [], []])
+
+    def test_atomic_tasks(self):
+        self.assertTrue(self.c.is_completed())
+        self.assertEqual(1, self.c.completed_task_count())
+        self.assertFalse(self.c.has_open_tasks())
+        self.assertTrue(self.d.atomic())
+        self.assertTrue(self.d.has_open_tasks())
+        self.assertEqual(1, self.d.open_task_count())
+        self.assertEqual({ 'alice': { 'id': 'alice', 'completed': 0,
+                                      'all': 1 } },
+                         self.a.derived_assignees)
+
+    def test_composite_tasks(self):
+        self.assertEqual(3, self.b.derived_size)
+        self.assertEqual(2, self.b.atomic_task_count())
+        self.assertFalse(self.b.is_completed())
+        self.assertEqual(5, self.root.derived_size)
+        self.assertEqual(3, self.root.atomic_task_count())
+        self.assertEqual(1, self.root.completed_task_count())
+        self.assertEqual(1, self.root.open_task_count())
+        self.assertTrue(self.root.has_open_tasks())
+        self.assertEqual({ 'alice': { 'id': 'alice', 'completed': 0,
+                                      'all': 1 },
+                           'bob': { 'id': 'bob', 'completed': 1, 'all': 1 } },
+                         self.root.derived_assignees)
+
+    def test_indexes(self):
+        root_index, a_index, b_index, c_index, d_index = self.indexes
+        self.assertEqual(['alice', 'bob'], sorted(root_index.assignees))
+        self.assertEqual(['bob'], b_index.assignees)
+        self.assertFalse(root_index.atomic)
+        self.assertTrue(c_index.atomic)
+        self.assertTrue(c_index.completed)
+        self.assertTrue(d_index.has_open_tasks)
+        self.assertEqual(['alice'], root_index.active_assignees)
+        self.assertEqual(['bob'], root_index.inactive_assignees)
+        self.assertEqual([], c_index.inactive_assignees)
+
+    def test_completed_tree(self):
+        task = self.new_task(10)
+        subtask = self.new_task(11, parent=task, completed=True)
+        indexes = [TaskIndex(parent=t.key(), key_name=t.identifier())
+                   for t in (task, subtask)]
+        workers.compute_new_task_tree([task, subtask], indexes, [[1], []])
+        self.assertTrue(task.is_completed())
+        self.assertFalse(task.has_open_tasks())
+        self.assertEqual(0, task.open_task_count())
+        self.assertTrue(indexes[0].completed)
+        self.assertTrue(indexes[0].sort_key.startswith('1'))
+
+
+class StatisticsTest(TestCase):
+    def record(self, total, atomic, completed, open, assignees={}):
+        return { 'total': total, 'atomic': atomic, 'completed': completed,
+                 'open': open, 'assignees': assignees }
+
+    def counts(self, statistics):
+        return (statistics.total, statistics.atomic, statistics.completed,
+                statistics.open)
+
+    def test_add_and_subtract(self):
+        statistics = DomainStatistics()
+        tree = self.record(5, 3, 1, 1,
+                           { 'alice': { 'completed': 0, 'all': 1 },
+                             'bob': { 'completed': 1, 'all': 1 } })
+        workers.add_statistics(statistics, tree)
+        workers.add_statistics(statistics, self.record(
+                1, 1, 0, 0, { 'alice': { 'completed': 0, 'all': 1 } }))
+        self.assertEqual((6, 4, 1, 1), self.counts(statistics))
+        self.assertEqual({ 'alice': { 'completed': 0, 'all': 2 },
+                           'bob': { 'completed': 1, 'all': 1 } },
+                         statistics.assignees)
+        workers.add_statistics(statistics, tree, sign=-1)
+        self.assertEqual((1, 1, 0, 0), self.counts(statistics))
+        # Assignees without tasks are removed.
+        self.assertEqual({ 'alice': { 'completed': 0, 'all': 1 } },
+                         statistics.assignees)
+
+    def test_assignees_are_copied(self):
+        first = DomainStatistics()
+        workers.add_statistics(first, self.record(
+                1, 1, 0, 0, { 'alice': { 'completed': 0, 'all': 1 } }))
+        assignees = first.assignees
+        workers.add_statistics(first, self.record(
+                1, 1, 0, 0, { 'alice': { 'completed': 0, 'all': 1 } }))
+        self.assertEqual({ 'alice': { 'completed': 0, 'all': 1 } },
+                         assignees)
+        self.assertEqual({}, DomainStatistics().assignees)
+
+    def test_statistics_of_task(self):
+        root = self.new_task(1)
+        subtask = self.new_task(2, parent=root, assignee='alice',
+                                completed=True)
+        indexes = [TaskIndex(parent=task.key(), key_name=task.identifier())
+                   for task in (root, subtask)]
+        workers.compute_new_task_tree([root, subtask], indexes, [[1], []])
+        self.assertEqual(None, workers.statistics_of_task(subtask))
+        record = workers.statistics_of_task(root)
+        self.assertEqual(
+            self.record(2, 1, 1, 0, { 'alice': { 'completed': 1, 'all': 1 } }),
+            record)
+        statistics = DomainStatistics()
+        workers.add_statistics(statistics, record)
+        workers.add_statistics(statistics, record, sign=-1)
+        self.assertEqual((0, 0, 0, 0), self.counts(statistics))
+        self.assertEqual({}, statistics.assignees)
+
+
+class DeltaTest(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        # root
+        #  +- a (assigned to alice)
+        #  +- b (assigned to bob, completed)
+        self.root = self.new_task(1)
+        self.a = self.new_task(2, parent=self.root, assignee='alice')
+        self.b = self.new_task(3, parent=self.root, assignee='bob',
+                               completed=True)
+        self.tasks = [self.root, self.a, self.b]
+        self.indexes = [TaskIndex(parent=task.key(), key_name=task.identifier())
+                        for task in self.tasks]
+        workers.compute_new_task_tree(self.tasks, self.indexes,
+                                      [[1, 2], [], []])
+
+    def delta(self, task, index):
+        """
+        Recomputes the atomic |task| after a change, and returns the
+        delta of its contribution to its ancestors.
+        """
+        old = workers._atomic_contribution(task)
+        workers._compute_derived_properties(task, index, [])
+        return workers._merge_deltas(workers._atomic_contribution(task),
+                                     old, -1)
+
+    def assertDerivedEqual(self, expected, task):
+        for name in ['derived_completed', 'derived_has_open_tasks',
+                     'derived_completed_task_count',
+                     'derived_open_task_count', 'derived_assignees']:
+            self.assertEqual(getattr(expected, name), getattr(task, name),
+                             name)
+
+    def recomputed_root(self):
+        root = self.new_task(1)
+        workers._compute_derived_properties(
+            root, TaskIndex(parent=root.key(), key_name='1'),
+            [self.a, self.b])
+        return root
+
+    def test_merge_deltas(self):
+        delta = { 'completed': 1, 'open': 0,
+                  'assignees': { 'alice': { 'id': 'alice',
+                                            'completed': 1, 'all': 0 } } }
+        other = { 'completed': 1, 'open': -1,
+                  'assignees': { 'alice': { 'id': 'alice',
+                                            'completed': 1, 'all': 0 },
+                                 'bob': { 'id': 'bob',
+                                          'completed': 0, 'all': 1 } } }
+        self.assertEqual(
+            { 'completed': 2, 'open': -1,
+              'assignees': { 'alice': { 'id': 'alice',
+                                        'completed': 2, 'all': 0 },
+                             'bob': { 'id': 'bob', 'completed': 0,
+                                      'all': 1 } } },
+            workers._merge_deltas(delta, other))
+        # Assignee records that become zero are removed, and the
+        # arguments are not modified.
+        self.assertEqual(
+            { 'completed': 0, 'open': 1,
+              'assignees': { 'bob': { 'id': 'bob', 'completed': 0,
+                                      'all': -1 } } },
+            workers._merge_deltas(delta, other, -1))
+        self.assertEqual(1, delta['assignees']['alice']['completed'])
+        self.assertEqual(workers._empty_delta(),
+                         workers._merge_deltas(other, other, -1))
+
+    def test_apply_completion(self):
+        self.a.completed = True
+        delta = self.delta(self.a, self.indexes[1])
+        self.assertEqual(1, delta['completed'])
+        version = self.root.version
+        self.assertTrue(workers._apply_delta(self.root, self.indexes[0],
+                                             delta))
+        self.assertDerivedEqual(self.recomputed_root(), self.root)
+        self.assertTrue(self.root.is_completed())
+        self.assertTrue(self.indexes[0].completed)
+        self.assertEqual(version + 1, self.root.version)
+
+    def test_apply_reassignment(self):
+        self.b.assignee = self.user_key('alice')
+        delta = self.delta(self.b, self.indexes[2])
+        self.assertTrue(workers._apply_delta(self.root, self.indexes[0],
+                                             delta))
+        self.assertDerivedEqual(self.recomputed_root(), self.root)
+        # Assignees without tasks are removed.
+        self.assertEqual(['alice'], self.root.derived_assignees.keys())
+        self.assertEqual(['alice'], self.indexes[0].assignees)
+
+    def test_apply_without_counters(self):
+        self.root.derived_completed_task_count = None
+        self.a.completed = True
+        delta = self.delta(self.a, self.indexes[1])
+        version = self.root.version
+        self.assertFalse(workers._apply_delta(self.root, self.indexes[0],
+                                              delta))
+        self.assertEqual(None, self.root.completed_task_count())
+        self.assertEqual(version, self.root.version)
+
+
+class PropagationTest(TestCase):
+    def setUp(self):
+        TestCase.setUp(self)
+        self.alice = self.create_domain()
+        self.bob = User(key_name='bob', name='Bob', domains=[self.DOMAIN])
+        self.bob.put()
+        self.group_key = Domain.key_from_name(self.DOMAIN)
+        # root
+        #  +- a (assigned to alice)
+        #  +- b
+        #      +- c (assigned to alice)
+        #      +- d
+        # other
+        #  +- e
+        self.root = self.create('root')
+        self.a = self.create('a', self.root, assignee=self.alice)
+        self.b = self.create('b', self.root)
+        self.c = self.create('c', self.b, assignee=self.alice)
+        self.d = self.create('d', self.b)
+        self.other = self.create('other')
+        self.e = self.create('e', self.other)
+        self.propagate()
+
+    def create(self, description, parent=None, assignee=None):
+        return api.create_task(self.DOMAIN, self.alice, description,
+                               assignee=assignee,
+                               parent_task_identifier=(
+                                   parent.identifier() if parent else None))
+
+    def marker(self, task):
+        return DirtyTask.get_by_key_name(task.identifier(),
+                                         parent=self.group_key)
+
+    def propagate(self):
+        """Runs the propagation worker until all markers are handled."""
+        while DirtyTask.all().ancestor(self.group_key).count():
+            db.run_in_transaction(workers._propagate_dirty_tasks,
+                                  self.group_key)
+
+    def derived(self, task):
+        return (task.derived_completed,
+                task.derived_size,
+                task.derived_atomic_task_count,
+                task.derived_has_open_tasks,
+                task.derived_completed_task_count,
+                task.derived_open_task_count,
+                task.derived_assignees)
+
+    def assertRecomputed(self):
+        """
+        Asserts that the stored derived properties of all tasks are
+        equal to those of a full recompute of the task trees.
+        """
+        stored = Task.all().ancestor(self.group_key).fetch(100)
+        tasks = dict((task.key(), task) for task in
+                     Task.all().ancestor(self.group_key).fetch(100))
+        subtasks = dict((key, []) for key in tasks)
+        for task in tasks.itervalues():
+            if task.parent_task_key():
+                subtasks[task.parent_task_key()].append(task)
+
+        def recompute(task):
+            for subtask in subtasks[task.key()]:
+                recompute(subtask)
+            workers._compute_derived_properties(
+                task, TaskIndex(parent=task.key(),
+                                key_name=task.identifier()),
+                subtasks[task.key()])
+        for task in tasks.itervalues():
+            if not task.parent_task_key():
+                recompute(task)
+        for task in stored:
+            self.assertEqual(self.derived(tasks[task.key()]),
+                             self.derived(task),
+                             task.description)
+
+    def test_initial_tree(self):
+        self.assertRecomputed()
+        root = api.get_task(self.DOMAIN, self.root.identifier())
+        self.assertEqual(3, root.atomic_task_count())
+        self.assertEqual(1, root.open_task_count())
+
+    def test_complete_uses_delta(self):
+        api.set_task_completed(self.DOMAIN, self.alice, self.c.identifier(),
+                               True)
+        marker = self.marker(self.c)
+        self.assertFalse(marker.full)
+        self.assertEqual(1, marker.delta['completed'])
+        self.propagate()
+        self.assertRecomputed()
+        self.assertEqual(None, self.marker(self.c))
+
+    def test_complete_and_uncomplete(self):
+        for completed in [True, False, True]:
+            api.set_task_completed(self.DOMAIN, self.alice,
+                                   self.a.identifier(), completed)
+        api.set_task_completed(self.DOMAIN, self.alice, self.c.identifier(),
+                               True)
+        self.propagate()
+        self.assertRecomputed()
+        api.set_task_completed(self.DOMAIN, self.alice, self.c.identifier(),
+                               False)
+        self.propagate()
+        self.assertRecomputed()
+
+    def test_reassign(self):
+        api.assign_task(self.DOMAIN, self.d.identifier(), self.alice,
+                        self.bob)
+        api.assign_task(self.DOMAIN, self.c.identifier(), self.alice,
+                        self.bob)
+        self.propagate()
+        self.assertRecomputed()
+        api.set_task_completed(self.DOMAIN, self.bob, self.d.identifier(),
+                               True)
+        api.assign_task(self.DOMAIN, self.d.identifier(), self.bob,
+                        self.alice)
+        self.propagate()
+        self.assertRecomputed()
+        root = api.get_task(self.DOMAIN, self.root.identifier())
+        self.assertEqual(['alice', 'bob'],
+                         sorted(root.derived_assignees.keys()))
+
+    def test_reparent(self):
+        api.set_task_completed(self.DOMAIN, self.alice, self.c.identifier(),
+                               True)
+        api.change_task_parent(self.DOMAIN, self.alice, self.c.identifier(),
+                               self.other.identifier())
+        api.change_task_parent(self.DOMAIN, self.alice, self.d.identifier(),
+                               self.a.identifier())
+        self.propagate()
+        self.assertRecomputed()
+        api.set_task_completed(self.DOMAIN, self.alice, self.c.identifier(),
+                               False)
+        api.change_task_parent(self.DOMAIN, self.alice, self.b.identifier(),
+                               None)
+        self.propagate()
+        self.assertRecomputed()
+
+    def test_mark_dirty_merges_markers(self):
+        delta = { 'completed': 1, 'open': 0, 'assignees': {} }
+
+        def txn():
+            workers.PropagateTaskCompletion.mark_dirty(
+                self.DOMAIN, self.c.identifier(), delta=delta)
+            workers.PropagateTaskCompletion.mark_dirty(
+                self.DOMAIN, self.c.identifier(), delta=delta)
+            workers.PropagateTaskCompletion.mark_dirty(
+                self.DOMAIN, self.d.identifier(), delta=delta)
+            workers.PropagateTaskCompletion.mark_dirty(
+                self.DOMAIN, self.d.identifier())
+        db.run_in_transaction(txn)
+        marker = self.marker(self.c)
+        self.assertFalse(marker.full)
+        self.assertEqual(2, marker.delta['completed'])
+        # A delta and a full recompute merge into a full recompute.
+        marker = self.marker(self.d)
+        self.assertTrue(marker.full)
+        self.assertEqual(None, marker.delta)
+        # A full marker stays full.
+        workers.PropagateTaskCompletion.mark_dirty(
+            self.DOMAIN, self.d.identifier(), delta=delta)
+        self.assertTrue(self.marker(self.d).full)
+
+    def test_mark_dirty_queues_one_worker(self):
+        taskqueue = self.testbed.get_stub('taskqueue')
+        taskqueue.FlushQueue('update-task-hierarchy')
+
+        def txn():
+            for task in [self.a, self.c, self.d]:
+                workers.PropagateTaskCompletion.mark_dirty(
+                    self.DOMAIN, task.identifier())
+        db.run_in_transaction(txn)
+        urls = [task['url'] for task in
+                taskqueue.GetTasks('update-task-hierarchy')]
+        self.assertEqual(1, urls.count('/workers/propagate-task-completion'))
+
+    def test_bottom_up(self):
+        tasks = dict((task.key(), task) for task in
+                     Task.all().ancestor(self.group_key))
+        ordered = [task.key() for task in workers._bottom_up(tasks)]
+        for task in tasks.itervalues():
+            if task.parent_task_key():
+                self.assertTrue(ordered.index(task.key()) <
+                                ordered.index(task.parent_task_key()))
+
+    def test_stale_ancestors_are_recomputed(self):
+        # Corrupt the derived properties of the ancestors of c, and
+        # mark c as dirty, so the whole chain is recomputed bottom-up.
+        for task in [self.root, self.b]:
+            task = Task.get(task.key())
+            task.derived_open_task_count = 10
+            task.derived_assignees = {}
+            task.put()
+        workers.PropagateTaskCompletion.mark_dirty(self.DOMAIN,
+                                                   self.c.identifier())
+        self.propagate()
+        self.assertRecomputed()
+
+
+class PropagationLagTest(TestCase):
+    def test_lag_in_seconds(self):
+        now = datetime.datetime.utcnow()
+        workers._record_propagation_lag(
+            self.DOMAIN, [now - datetime.timedelta(days=1, seconds=30),
+                          None,
+                          now - datetime.timedelta(seconds=2.5)])
+        lags = sorted(workers.get_samples(['lag:%s' % self.DOMAIN])[0])
+        self.assertEqual(2, len(lags))
+        self.assertTrue(2.5 <= lags[0] < 5)
+        self.assertTrue(86430 <= lags[1] < 86435)
+
+
+if __name__ == '__main__':
+    unittest.main()
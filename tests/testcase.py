@@ -0,0 +1,91 @@
+#  Copyright 2011 Tijmen Roberti
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+A base class for the tests that use the datastore and memcache.
+"""
+import os
+import unittest
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+from model import Domain, Task
+import api
+
+
+class TestCase(unittest.TestCase):
+    """
+    Activates a fresh datastore and memcache stub for each test. The
+    datastore is strongly consistent, so queries see all writes.
+    """
+    DOMAIN = 'test-domain'
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def create_domain(self, shard_count=0):
+        """
+        Logs in the user 'alice' and creates the domain DOMAIN, of
+        which she is the admin. The task queues of queue.yaml are
+        available, but the queued workers are not run.
+
+        Returns:
+            The User instance of alice.
+        """
+        root_path = os.path.dirname(os.path.dirname(__file__))
+        self.testbed.init_taskqueue_stub(root_path=root_path)
+        self.testbed.init_user_stub()
+        self.testbed.setup_env(USER_EMAIL='alice@example.com',
+                               USER_ID='alice',
+                               USER_IS_ADMIN='0',
+                               overwrite=True)
+        api.create_domain(self.DOMAIN, 'Test', api.get_logged_in_user(),
+                          shard_count=shard_count)
+        return api.get_user('alice', use_cache=False)
+
+    def user_key(self, user_identifier):
+        """Returns the key of the User with the given identifier."""
+        return db.Key.from_path('User', user_identifier)
+
+    def new_task(self, id, parent=None, assignee=None, completed=False,
+                 **kwds):
+        """
+        Returns a new Task in the entity group of DOMAIN, which is
+        not stored. The derived properties are not computed.
+
+        Args:
+            id: The numeric id of the task
+            parent: The parent Task, or None.
+            assignee: The identifier of the assignee, or None.
+            completed: Whether the task is completed.
+            **kwds: Other properties of the task
+        """
+        kwds.setdefault('description', 'Task %d' % id)
+        kwds.setdefault('user', self.user_key('creator'))
+        return Task(key=db.Key.from_path('Task', id,
+                                         parent=Domain.key_from_name(
+                                             self.DOMAIN)),
+                    parent_task=parent.key() if parent else None,
+                    assignee=(self.user_key(assignee) if assignee
+                              else None),
+                    completed=completed,
+                    **kwds)
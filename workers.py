@@ -18,15 +18,28 @@ performed in the background. Tasks in the taskqueue sense are called
 'workers', to prevent any confusing with Tasks in the SPS sense.
 """
 import os
+import time
+import random
+import calendar
 import logging
+import copy
+import datetime
+import zlib
+import threading
 from google.appengine.api import users, datastore
 from google.appengine.api import taskqueue
+from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.datastore import datastore_rpc
 import webapp2 as webapp
+from webapp2_extras import jinja2
 import json
 import api
-from model import Domain, Task, TaskIndex, Context, User
+import caching
+import search
+from model import Domain, DomainShard, Task, TaskIndex, Context, User
+from model import DirtyTask, PropagationState, TaskTreeSnapshot
+from model import Inbox, DomainStatistics, ProgressSeries, TaskSearchTerms
 
 # A test to check if we are on the development sdk, as that one
 # does not support multi entity groups yet.
@@ -34,6 +47,611 @@ import os
 DEV_SERVER = os.environ.get('SERVER_SOFTWARE','').startswith('Development')
 
 
+# Whether updates of the derived properties are coalesced per
+# domain. If enabled, mutations only mark tasks as dirty and a single
+# PropagateTaskCompletion worker recomputes the ancestor chains of all
+# dirty tasks of the domain in one pass.
+COALESCE_PROPAGATION = True
+# Number of seconds a propagation worker is delayed, so that a burst
+# of mutations is handled by a single worker run.
+PROPAGATION_DELAY = 5
+# Maximum number of dirty markers that are handled in a single run of
+# the propagation worker. A run is a single transaction on the entity
+# group, which fails if a mutation of the group commits first, so it
+# is kept short. The remainder is left for the next run, which is
+# queued without delay.
+MAX_DIRTY_TASKS_PER_RUN = 20
+# Maximum size in bytes of the compressed data of a task tree
+# snapshot, which must fit in a single entity.
+MAX_SNAPSHOT_SIZE = 900 * 1024
+# Number of seconds between requests to build a missing task tree
+# snapshot, and the number of seconds before a new snapshot is built
+# for a domain whose snapshot was too large.
+SNAPSHOT_REQUEST_TIME = 60
+SNAPSHOT_RETRY_TIME = 24 * 3600
+_SNAPSHOT_REQUEST_KEY = 'tasktree-request:%s'
+_SNAPSHOT_TOO_LARGE_KEY = 'tasktree-too-large:%s'
+# Number of tasks that are fetched in a single batch while a new task
+# tree snapshot is built.
+SNAPSHOT_BATCH_SIZE = 1000
+# If a propagation worker has been pending for longer than this number
+# of seconds, it is assumed to be lost and a new one is queued.
+PROPAGATION_TIMEOUT = 600
+# Maximum number of workers that are added to a queue in a single
+# call.
+QUEUE_BATCH_SIZE = 100
+# Number of tasks of which the hierarchy is rewritten in a single
+# transaction, if the hierarchy of a subtree is updated by a single
+# worker.
+HIERARCHY_BATCH_SIZE = 100
+# Number of recent samples that are kept of each metric, and the
+# number of seconds they are kept in memcache. See record_samples().
+METRIC_SAMPLE_COUNT = 1000
+METRIC_TIME = 7 * 24 * 3600
+# Number of memcache keys over which the samples of a metric are
+# sharded, so concurrent workers rarely update the same key.
+METRIC_SHARDS = 8
+_METRIC_KEY = 'metric:%s:%d'
+# Maximum number of tasks that are handled by a single search index
+# or inbox worker.
+TASK_BATCH_SIZE = 100
+# The queue of the search index workers. The other workers use the
+# update-task-hierarchy queue.
+SEARCH_QUEUE = 'update-search-index'
+# Number of seconds between requests to backfill the order of the
+# TaskIndexes of a domain, see OrderTaskIndexes.
+ORDER_REQUEST_TIME = 3600
+_ORDER_REQUEST_KEY = 'order-indexes-request:%s'
+
+
+def _queue_worker(url, params, transactional=False, countdown=None,
+                  queue_name='update-task-hierarchy'):
+    """
+    Adds a worker to the update-task-hierarchy queue, or to the queue
+    with the given name.
+
+    Args:
+        url: The url of the worker handler
+        params: Dictionary with the POST parameters of the worker
+        transactional: If set to true, then the task will be added
+            as a transactional task.
+        countdown: Optional number of seconds to delay the worker.
+        queue_name: The name of the queue.
+
+    Raises:
+        ValueError: If transactional is set to True and the
+             function is not called as part of a transaction.
+    """
+    if transactional and not db.is_in_transaction():
+        raise ValueError("Adding a transactional worker requires a"
+                         " transaction")
+
+    queue = taskqueue.Queue(queue_name)
+    task = taskqueue.Task(url=url, params=params, countdown=countdown)
+    try:
+        queue.add(task, transactional=transactional)
+    except taskqueue.TransientError:
+        queue.add(task, transactional=transactional)
+
+
+def _queue_workers(url, params_list, queue_name='update-task-hierarchy'):
+    """
+    Adds a worker for each dictionary of POST parameters in
+    |params_list| to the update-task-hierarchy queue, or to the queue
+    with the given name, with a single queue.add() call for every
+    QUEUE_BATCH_SIZE workers. The workers are not transactional.
+
+    Args:
+        url: The url of the worker handler
+        params_list: A list of dictionaries with the POST parameters
+            of the workers.
+        queue_name: The name of the queue.
+    """
+    queue = taskqueue.Queue(queue_name)
+    for start in range(0, len(params_list), QUEUE_BATCH_SIZE):
+        tasks = [taskqueue.Task(url=url, params=params)
+                 for params in params_list[start:start + QUEUE_BATCH_SIZE]]
+        try:
+            queue.add(tasks)
+        except taskqueue.TransientError:
+            queue.add(tasks)
+
+
+def _queue_task_batches(url, domain_identifier, task_identifiers,
+                        queue_name='update-task-hierarchy'):
+    """
+    Adds workers that take a comma separated list of task identifiers,
+    one for every TASK_BATCH_SIZE tasks. The workers are not
+    transactional.
+
+    Args:
+        url: The url of the worker handler
+        domain_identifier: The domain identifier string
+        task_identifiers: A list of task identifier strings
+        queue_name: The name of the queue.
+    """
+    _queue_workers(url,
+                   [{ 'tasks': ','.join(task_identifiers[
+                            start:start + TASK_BATCH_SIZE]),
+                      'domain': domain_identifier }
+                    for start in range(0, len(task_identifiers),
+                                       TASK_BATCH_SIZE)],
+                   queue_name=queue_name)
+
+
+def record_samples(metric, values):
+    """
+    Appends samples to a metric, which is kept in memcache. The
+    samples are appended to one of METRIC_SHARDS keys at random, each
+    of which keeps its latest METRIC_SAMPLE_COUNT / METRIC_SHARDS
+    samples. Samples can be lost if memcache is flushed, or if many
+    workers record samples of the same metric at the same time.
+
+    Args:
+        metric: The name of the metric
+        values: A list of numbers
+    """
+    if not values:
+        return
+    count = METRIC_SAMPLE_COUNT // METRIC_SHARDS
+    client = memcache.Client()
+    key = _METRIC_KEY % (metric, random.randrange(METRIC_SHARDS))
+    for attempt in range(3):
+        samples = client.gets(key)
+        if samples is None:
+            if client.add(key, values[-count:], time=METRIC_TIME):
+                return
+        elif client.cas(key, (samples + values)[-count:],
+                        time=METRIC_TIME):
+            return
+
+
+def get_samples(metrics):
+    """
+    Returns the recorded samples of the given metrics, with a single
+    memcache call.
+
+    Args:
+        metrics: A list of metric names
+
+    Returns:
+        A list with the samples of each metric. The samples are not
+        in order.
+    """
+    keys = [[_METRIC_KEY % (metric, shard) for shard in range(METRIC_SHARDS)]
+            for metric in metrics]
+    cached = memcache.get_multi([key for shards in keys for key in shards])
+    return [[sample for key in shards for sample in cached.get(key, [])]
+            for shards in keys]
+
+
+def _record_propagation_lag(domain_identifier, start_times):
+    """
+    Records the propagation lag of changes in a domain, which have
+    been propagated up to the root tasks now.
+
+    Args:
+        domain_identifier: The domain identifier string
+        start_times: A list with the datetime in UTC at which each
+            change was made.
+    """
+    now = datetime.datetime.utcnow()
+    lags = [(now - start).total_seconds()
+            for start in start_times if start]
+    record_samples('lag:%s' % domain_identifier, lags)
+
+
+def _timed(name):
+    """
+    Decorator of the post() method of a worker, which records the
+    duration of each run of the worker in the metric 'duration:<name>'.
+    """
+    def decorator(method):
+        def timed_method(self, *args, **kwargs):
+            start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                record_samples('duration:%s' % name,
+                               [time.time() - start])
+        return timed_method
+    return decorator
+
+
+def _compute_derived_properties(task, index, subtasks):
+    """
+    Computes all the derived properties of |task| and its |index| from
+    the properties of |task| and its direct subtasks. The instances
+    are updated, but not stored in the datastore.
+
+    Args:
+        task: An instance of the Task model
+        index: The TaskIndex instance of |task|
+        subtasks: A list of Task instances with all the direct
+            subtasks of |task|. Their derived properties must be up
+            to date.
+    """
+    if not subtasks:    # atomic task
+        task.derived_completed = task.completed
+        task.derived_size = 1
+        task.derived_atomic_task_count = 1
+        task.derived_has_open_tasks = task.open()
+        task.derived_completed_task_count = int(task.is_completed())
+        task.derived_open_task_count = int(task.has_open_tasks())
+        assignees = {}
+        assignee_identifier = task.assignee_identifier()
+        if assignee_identifier:
+            assignees[assignee_identifier] = {
+                'id': assignee_identifier,
+                'completed': int(task.is_completed()),
+                'all': 1
+                }
+        task.derived_assignees = assignees
+        index.assignees = list(assignees.iterkeys())
+    else:               # composite task
+        task.derived_completed = all(t.is_completed() for t in subtasks)
+        task.derived_size = 1 + sum(t.derived_size for t in subtasks)
+        task.derived_atomic_task_count = sum(t.atomic_task_count()
+                                             for t in subtasks)
+        task.derived_has_open_tasks = any(t.has_open_tasks()
+                                          for t in subtasks)
+        task.derived_completed_task_count = _sum_counts(
+            t.completed_task_count() for t in subtasks)
+        task.derived_open_task_count = _sum_counts(
+            t.open_task_count() for t in subtasks)
+        # Compute derived assignees, and sum the total of all
+        # their assigned and completed subtasks.
+        assignees = {}
+        for subtask in subtasks:
+            subtask_assignees = subtask.derived_assignees
+            for id, record in subtask_assignees.iteritems():
+                if not id in assignees:
+                    assignees[id] = {
+                        'id': id,
+                        'completed': 0,
+                        'all': 0
+                        }
+                assignees[id]['completed'] += record['completed']
+                assignees[id]['all'] += record['all']
+        task.derived_assignees = assignees
+        index.assignees = list(assignees.iterkeys())
+    index.completed = task.is_completed()
+    index.has_open_tasks = task.has_open_tasks()
+    index.atomic = task.atomic()
+    _update_index_order(task, index)
+    task.version += 1
+
+
+def _new_task_index(task):
+    """
+    Returns a new TaskIndex with the hierarchy of |task|, for a task
+    that does not have an index yet, and updates the level of the
+    task. Neither is stored. Must be run in a transaction on the
+    entity group of the task.
+
+    The index of a new task is created by UpdateTaskHierarchy, but
+    the derived properties of the task can be computed first. The
+    index must then have the hierarchy, as it is used by the queries
+    of the task lists.
+    """
+    hierarchy = [ancestor.identifier()
+                 for ancestor in api.get_ancestors(task)]
+    task.derived_level = len(hierarchy)
+    return TaskIndex(parent=task, key_name=task.identifier(),
+                     hierarchy=hierarchy)
+
+
+def _update_index_order(task, index):
+    """
+    Updates the properties of |index| that determine the order of
+    |task| in the task lists, so the lists can be ordered by the
+    datastore.
+    """
+    index.sort_key = TaskIndex.sort_key_for(task.is_completed(), task.time)
+    index.active_assignees = [identifier for identifier in index.assignees
+                              if task.is_active(identifier)]
+    index.inactive_assignees = []
+    if not task.is_completed():
+        index.inactive_assignees = [identifier
+                                    for identifier in index.assignees
+                                    if identifier not in
+                                    index.active_assignees]
+
+
+def compute_new_task_tree(tasks, indexes, subtasks):
+    """
+    Computes the derived properties of a tree of new tasks in memory,
+    in a single bottom-up pass. No datastore operations are performed
+    and no workers are queued, so this can be used for tasks that are
+    not stored yet, such as imported tasks.
+
+    Args:
+        tasks: A list of Task instances, in pre-order: each task is
+            listed before all its subtasks.
+        indexes: A list with the TaskIndex instance of each task.
+        subtasks: A list with, for each task, the list of the
+            positions of its direct subtasks in |tasks|.
+    """
+    for position in reversed(range(len(tasks))):
+        _compute_derived_properties(tasks[position],
+                                    indexes[position],
+                                    [tasks[subtask]
+                                     for subtask in subtasks[position]])
+
+
+def statistics_of_task(task):
+    """
+    Returns the contribution of |task| to the DomainStatistics of its
+    entity group, which is None if the task is not a root task. The
+    contribution is a record with the fields of DomainStatistics.
+    """
+    if not task.root():
+        return None
+    return {
+        'total': task.derived_size,
+        'atomic': task.atomic_task_count(),
+        'completed': task.completed_task_count() or 0,
+        'open': task.open_task_count() or 0,
+        'assignees': dict((id, { 'completed': record['completed'],
+                                 'all': record['all'] })
+                          for id, record
+                          in task.derived_assignees.iteritems())
+        }
+
+
+def add_statistics(statistics, record, sign=1):
+    """
+    Adds a contribution |record| multiplied by |sign| to the counters
+    of |statistics|, an instance of DomainStatistics. Assignees
+    without tasks are removed.
+    """
+    statistics.total += sign * record['total']
+    statistics.atomic += sign * record['atomic']
+    statistics.completed += sign * record['completed']
+    statistics.open += sign * record['open']
+    assignees = copy.deepcopy(statistics.assignees)
+    for id, counts in record['assignees'].iteritems():
+        if not id in assignees:
+            assignees[id] = { 'completed': 0, 'all': 0 }
+        assignees[id]['completed'] += sign * counts['completed']
+        assignees[id]['all'] += sign * counts['all']
+        if not assignees[id]['completed'] and not assignees[id]['all']:
+            del assignees[id]
+    statistics.assignees = assignees
+
+
+def update_domain_statistics(tasks):
+    """
+    Counts the changes of the root tasks among |tasks| in the
+    DomainStatistics of their entity groups. Tasks that are no longer
+    root tasks are no longer counted. The counted contribution of each task is updated, but
+    the tasks are not stored.
+
+    If the number of completed or of all atomic tasks changes, a
+    sample is added to the ProgressSeries of the root task and of
+    the entity group.
+
+    Must be called in a transaction on the entity groups of the
+    tasks, before the tasks are stored.
+
+    Args:
+        tasks: A list of Task instances, with up to date derived
+            properties.
+    """
+    changes = {}
+    sampled = []
+    for task in tasks:
+        contribution = statistics_of_task(task)
+        counted = task.counted_statistics
+        if contribution == counted:
+            continue
+        records = changes.setdefault(task.group_key(), [])
+        if counted:
+            records.append((counted, -1))
+        if contribution:
+            records.append((contribution, 1))
+            if (not counted or
+                counted['completed'] != contribution['completed'] or
+                counted['atomic'] != contribution['atomic']):
+                sampled.append(task)
+        task.counted_statistics = contribution
+    if not changes:
+        return
+    # The shards and the progress series are fetched in a single batch.
+    group_keys = changes.keys()
+    keys = ([DomainStatistics.key_from_group_key(group_key)
+             for group_key in group_keys] +
+            [ProgressSeries.key_from_parent_key(group_key)
+             for group_key in group_keys] +
+            [ProgressSeries.key_from_parent_key(task.key())
+             for task in sampled])
+    fetched = dict(zip(keys, db.get(keys)))
+    now = datetime.datetime.now()
+    entities = []
+    for group_key in group_keys:
+        key = DomainStatistics.key_from_group_key(group_key)
+        shard = fetched[key] or DomainStatistics(key=key)
+        counts = (shard.completed, shard.atomic)
+        for record, sign in changes[group_key]:
+            add_statistics(shard, record, sign)
+        entities.append(shard)
+        key = ProgressSeries.key_from_parent_key(group_key)
+        series = fetched[key] or ProgressSeries(key=key)
+        if ((counts != (shard.completed, shard.atomic) or
+             not series.hours) and
+            series.add_sample(now, shard.completed, shard.atomic)):
+            entities.append(series)
+    for task in sampled:
+        key = ProgressSeries.key_from_parent_key(task.key())
+        series = fetched[key] or ProgressSeries(key=key)
+        if series.add_sample(now,
+                             task.counted_statistics['completed'],
+                             task.counted_statistics['atomic']):
+            entities.append(series)
+    caching.put(entities)
+
+
+def _sum_counts(counts):
+    """
+    Returns the sum of the counts, or None if any of the counts is
+    None.
+    """
+    total = 0
+    for count in counts:
+        if count is None:
+            return None
+        total += count
+    return total
+
+
+def _atomic_contribution(task):
+    """
+    Returns a delta record, as stored in DirtyTask.delta, that
+    describes the contribution of the atomic |task| to the derived
+    properties of its ancestors.
+    """
+    return {
+        'completed': int(task.is_completed()),
+        'open': int(task.has_open_tasks()),
+        'assignees': copy.deepcopy(task.derived_assignees)
+        }
+
+
+def _merge_deltas(delta, other, sign=1):
+    """
+    Returns the delta record that is the sum of |delta| and |other|
+    multiplied by |sign|. Assignee records that are zero are removed.
+    Neither argument is modified.
+    """
+    result = copy.deepcopy(delta)
+    result['completed'] += sign * other['completed']
+    result['open'] += sign * other['open']
+    assignees = result['assignees']
+    for id, record in other['assignees'].iteritems():
+        if not id in assignees:
+            assignees[id] = { 'id': id,
+                              'completed': 0,
+                              'all': 0 }
+        assignees[id]['completed'] += sign * record['completed']
+        assignees[id]['all'] += sign * record['all']
+        if not assignees[id]['completed'] and not assignees[id]['all']:
+            del assignees[id]
+    return result
+
+
+def _empty_delta():
+    """Returns a delta record without any changes."""
+    return { 'completed': 0, 'open': 0, 'assignees': {} }
+
+
+def _apply_delta(task, index, delta):
+    """
+    Applies a delta record of one of the subtasks of the composite
+    |task| to the derived properties of |task| and its |index|, in
+    O(1) time with respect to the number of subtasks.
+
+    Returns:
+        False if the counters of |task| have not been computed yet,
+        in which case nothing is changed and the task must be fully
+        recomputed instead.
+    """
+    if (task.completed_task_count() is None or
+        task.open_task_count() is None):
+        return False
+    task.derived_completed_task_count += delta['completed']
+    task.derived_open_task_count += delta['open']
+    assignees = _merge_deltas({ 'completed': 0,
+                                'open': 0,
+                                'assignees': task.derived_assignees },
+                              delta)['assignees']
+    for id in assignees.keys():
+        if assignees[id]['all'] <= 0:
+            del assignees[id]
+    task.derived_assignees = assignees
+    task.derived_completed = (task.completed_task_count() ==
+                              task.atomic_task_count())
+    task.derived_has_open_tasks = task.open_task_count() > 0
+    index.assignees = list(assignees.iterkeys())
+    index.completed = task.is_completed()
+    index.has_open_tasks = task.has_open_tasks()
+    _update_index_order(task, index)
+    task.version += 1
+    return True
+
+
+def update_atomic_task(task, old_assignee_identifier=None):
+    """
+    Updates the derived properties of an atomic task after its
+    |completed| or |assignee| property has been changed, and stores
+    the task and its index. The change is propagated upwards through
+    the hierarchy as a delta, so ancestors are updated without
+    fetching their subtasks.
+
+    If COALESCE_PROPAGATION is disabled, or the task is not atomic,
+    the derived properties of the task and its ancestors are fully
+    recomputed by a worker instead.
+
+    The inboxes of the assignees are updated by a worker.
+
+    Must be called in a transaction on the entity group of the task.
+
+    Args:
+        task: An instance of the Task model, with the changes applied.
+        old_assignee_identifier: The identifier of the previous
+            assignee, if the assignee has been changed.
+
+    Raises:
+        ValueError: If not called inside a transaction.
+    """
+    if not db.is_in_transaction():
+        raise ValueError("Updating an atomic task requires a transaction")
+    domain_identifier = task.domain_identifier()
+    UpdateInbox.enqueue(domain_identifier,
+                        [task.identifier()],
+                        old_assignee=old_assignee_identifier,
+                        transactional=True)
+    if not COALESCE_PROPAGATION or not task.atomic():
+        task.version += 1
+        caching.put(task)
+        UpdateTaskCompletion.enqueue(domain_identifier,
+                                     task.identifier(),
+                                     transactional=True)
+        return
+
+    old_contribution = _atomic_contribution(task)
+    index = TaskIndex.get(TaskIndex.key_from_task_key(task.key()))
+    if not index:
+        index = _new_task_index(task)
+    _compute_derived_properties(task, index, [])
+    update_domain_statistics([task])
+    caching.put([task, index])
+    delta = _merge_deltas(_atomic_contribution(task), old_contribution, -1)
+    if delta != _empty_delta():
+        PropagateTaskCompletion.mark_dirty(domain_identifier,
+                                           task.identifier(),
+                                           delta=delta)
+
+
+def refresh_task(task):
+    """
+    Records that a property of |task| that is not derived, such as its
+    description, has changed, so that the task is updated in the task
+    tree snapshot of its domain. The derived properties of the
+    ancestors of the task are not changed.
+
+    Must be called in a transaction on the entity group of the task.
+
+    Raises:
+        ValueError: If not called inside a transaction.
+    """
+    if not db.is_in_transaction():
+        raise ValueError("Refreshing a task requires a transaction")
+    if COALESCE_PROPAGATION:
+        PropagateTaskCompletion.mark_dirty(task.domain_identifier(),
+                                           task.identifier(),
+                                           delta=_empty_delta())
+
+
 class UpdateTaskCompletion(webapp.RequestHandler):
     """
     Updates all derived properties of the tasks in a hierarchy.
@@ -50,104 +668,76 @@ class UpdateTaskCompletion(webapp.RequestHandler):
     b is the average branching factor in the task hierarchy and
     d the depth of the starting task in the hierarchy.
 
+    If COALESCE_PROPAGATION is enabled, enqueue() marks the task as
+    dirty instead, and the update is performed by the
+    PropagateTaskCompletion worker.
+
     This operation is idempotent.
     """
+    @_timed('update-task-completion')
     def post(self):
         domain_identifier = self.request.get('domain')
-        domain_key = Domain.key_from_name(domain_identifier)
         task_identifier = self.request.get('task')
+        start = self.request.get('start')
+        start = (datetime.datetime.utcfromtimestamp(float(start))
+                 if start else None)
 
         def txn():
             task = api.get_task(domain_identifier, task_identifier)
             if not task:
                 logging.error("Task '%s/%s' does not exist",
                               domain_identifier, task_identifier)
-                return
+                return None
             index = TaskIndex.get_by_key_name(task_identifier, parent=task)
             if not index:
-                index = TaskIndex(parent=task, key_name=task_identifier)
+                index = _new_task_index(task)
+            atomic = index.atomic if index.is_saved() else None
             # Get all subtasks. The ancestor queries are strongly
             # consistent, so when propagating upwards through the
             # hierarchy the changes are reflected.
             subtasks = list(Task.all().
-                            ancestor(domain_key).
+                            ancestor(task.group_key()).
                             filter('parent_task =', task.key()))
-            if not subtasks:    # atomic task
-                task.derived_completed = task.completed
-                task.derived_size = 1
-                task.derived_atomic_task_count = 1
-                task.derived_has_open_tasks = task.open()
-                assignee_identifier = task.assignee_identifier()
-                if assignee_identifier:
-                    index.assignees = [assignee_identifier]
-                    if not DEV_SERVER:
-                        # Uses a multi entity group transaction to get the name
-                        # of the assignee. This is cached in the record for
-                        # quick descriptions.
-                        assignee = api.get_user(assignee_identifier)
-                        name = assignee.name if assignee else '<Missing>'
-                    else:
-                        name = 'temp'
-                    task.derived_assignees[task.assignee_identifier()] = {
-                        'id': task.assignee_identifier(),
-                        'name': name,
-                        'completed': int(task.is_completed()),
-                        'all': 1
-                        }
-            else:               # composite task
-                task.derived_completed = all(t.is_completed() for t in subtasks)
-                task.derived_size = 1 + sum(t.derived_size for t in subtasks)
-                task.derived_atomic_task_count = sum(t.atomic_task_count()
-                                                     for t in subtasks)
-                task.derived_has_open_tasks = any(t.has_open_tasks()
-                                                  for t in subtasks)
-                # Compute derived assignees, and sum the total of all
-                # their assigned and completed subtasks.
-                assignees = {}
-                for subtask in subtasks:
-                    subtask_assignees = subtask.derived_assignees
-                    for id, record in subtask_assignees.iteritems():
-                        if not id in assignees:
-                            assignees[id] = {
-                                'id': id,
-                                'name': record['name'],
-                                'completed': 0,
-                                'all': 0
-                                }
-                        assignees[id]['completed'] += record['completed']
-                        assignees[id]['all'] += record['all']
-                task.derived_assignees = assignees
-                index.assignees = list(assignees.iterkeys())
-            task.put()
-            index.completed = task.is_completed()
-            index.has_open_tasks = task.has_open_tasks()
-            index.atomic = task.atomic()
-            index.put()
+            _compute_derived_properties(task, index, subtasks)
+            update_domain_statistics([task])
+            caching.put([task, index])
+            # Only atomic tasks are listed in the inbox of their
+            # assignee.
+            if task.assignee_key() and index.atomic != atomic:
+                UpdateInbox.enqueue(domain_identifier, [task_identifier],
+                                    transactional=True)
             # Propagate further upwards
             if task.parent_task_identifier():
                 UpdateTaskCompletion.enqueue(domain_identifier,
                                              task.parent_task_identifier(),
-                                             transactional=True)
-        # Use a multi entity group transaction, if available
-        if DEV_SERVER:
-            db.run_in_transaction(txn)
-        else:
-            xg_on = db.create_transaction_options(xg=True)
-            db.run_in_transaction_options(xg_on, txn)
+                                             transactional=True,
+                                             start=start)
+            return task
+        task = db.run_in_transaction(txn)
+        api.increment_modification_counter(domain_identifier)
+        if task and not task.parent_task_identifier():
+            _record_propagation_lag(domain_identifier, [start])
 
 
 
     @staticmethod
-    def enqueue(domain_identifier, task_identifier, transactional=False):
+    def enqueue(domain_identifier, task_identifier, transactional=False,
+                start=None):
         """
         Queues a new worker to update the task hierarchy of the task
         with the given identifier.
 
+        If COALESCE_PROPAGATION is enabled, the task is marked as
+        dirty instead. See PropagateTaskCompletion.mark_dirty().
+
         Args:
             domain_identifier: The domain identifier string
             task_identifier: The task identifier string
             transactional: If set to true, then the task will be added
                 as a transactional task.
+            start: The datetime in UTC of the change that is
+                propagated, used to measure the propagation lag.
+                Defaults to now.
 
         Raises:
             ValueError: If transactional is set to True and the
@@ -156,16 +746,570 @@ class UpdateTaskCompletion(webapp.RequestHandler):
         if transactional and not db.is_in_transaction():
             raise ValueError("Adding a transactional worker requires a"
                              " transaction")
+        if COALESCE_PROPAGATION:
+            PropagateTaskCompletion.mark_dirty(domain_identifier,
+                                               task_identifier)
+            return
+        start = start or datetime.datetime.utcnow()
+        _queue_worker('/workers/update-task-completion',
+                      { 'task': task_identifier,
+                        'domain': domain_identifier,
+                        'start': calendar.timegm(start.utctimetuple()) +
+                                 start.microsecond / 1e6 },
+                      transactional=transactional)
 
-        queue = taskqueue.Queue('update-task-hierarchy')
-        task = taskqueue.Task(url='/workers/update-task-completion',
-                              params={ 'task': task_identifier,
-                                       'domain': domain_identifier })
-        try:
-            queue.add(task, transactional=transactional)
-        except taskqueue.TransientError:
-            queue.add(task, transactional=transactional)
 
+_transaction_local = threading.local()
+
+
+def _transaction_entities():
+    """
+    Returns a dictionary that is shared by all callers in the current
+    transaction attempt, in which entities that have been read and
+    changed in the transaction can be kept by key, together with other
+    bookkeeping of the transaction. As the datastore
+    does not reflect the writes in a transaction to later reads in
+    that same transaction, callers that read and write the same entity
+    must use the instance in this dictionary. Must be called inside a
+    transaction.
+    """
+    # Every attempt of a transaction uses a new connection.
+    connection = datastore._GetConnection()
+    if getattr(_transaction_local, 'connection', None) is not connection:
+        _transaction_local.connection = connection
+        _transaction_local.entities = {}
+    return _transaction_local.entities
+
+
+def _get_propagation_state(group_key):
+    """
+    Returns the PropagationState of an entity group, or a new instance
+    if it does not exist. Inside a transaction, all callers share the
+    same instance, see _transaction_entities().
+    """
+    key = PropagationState.key_from_group_key(group_key)
+    entities = _transaction_entities() if db.is_in_transaction() else {}
+    if not key in entities:
+        entities[key] = (PropagationState.get(key) or
+                         PropagationState(key=key))
+    return entities[key]
+
+
+class PropagateTaskCompletion(webapp.RequestHandler):
+    """
+    Coalescing variant of the UpdateTaskCompletion worker. Mutations
+    mark the tasks they change as dirty through mark_dirty(), and a
+    single run of this worker recomputes the derived properties of
+    the union of the ancestor chains of all dirty tasks in an entity
+    group of a domain. The tasks are updated bottom-up, so that
+    ancestors that are shared by multiple dirty tasks are only
+    recomputed once.
+
+    The whole run is performed in a single transaction on the entity
+    group, so the dirty markers are consumed atomically with the
+    updates they caused. As every mutation of the group writes to the
+    group as well, a run only handles MAX_DIRTY_TASKS_PER_RUN markers,
+    so its transaction is short enough to commit during a burst of
+    mutations. If a run cannot handle all the markers, the next run
+    is queued without delay in the same transaction. In a sharded
+    domain, each shard has its own propagation worker.
+
+    This post request takes two arguments, the domain identifier and
+    the optional shard number.
+
+    This operation is idempotent.
+    """
+    @_timed('propagate-task-completion')
+    def post(self):
+        domain_identifier = self.request.get('domain')
+        shard = self.request.get('shard')
+        if shard:
+            group_key = DomainShard.key_from_shard(domain_identifier,
+                                                   int(shard))
+        else:
+            group_key = Domain.key_from_name(domain_identifier)
+        start_times = []
+        missing = db.run_in_transaction(_propagate_dirty_tasks, group_key,
+                                        start_times)
+        _record_propagation_lag(domain_identifier, start_times)
+        api.increment_modification_counter(domain_identifier)
+        if missing:
+            _build_task_tree_snapshot(group_key)
+
+    @staticmethod
+    def mark_dirty(domain_identifier, task_identifier, delta=None):
+        """
+        Marks a task as dirty, so its derived properties and those of
+        all its ancestors will be updated by the next run of the
+        propagation worker of its entity group. A new worker is only
+        queued if none is pending yet.
+
+        If called inside a transaction, the transaction must include
+        the entity group of the task. Otherwise a new transaction is
+        used. Multiple calls in the same transaction share the marker
+        and the PropagationState they write, so at most one worker is
+        queued per transaction.
+
+        Args:
+            domain_identifier: The domain identifier string
+            task_identifier: The task identifier string
+            delta: Optional delta record, see DirtyTask.delta. If
+                provided, only the ancestors of the task are updated by
+                applying the delta. Otherwise the task and all its
+                ancestors are fully recomputed.
+        """
+        group_key = Task.key_from_identifier(domain_identifier,
+                                             task_identifier).parent()
+
+        def txn():
+            entities = _transaction_entities()
+            marker_key = db.Key.from_path('DirtyTask', str(task_identifier),
+                                          parent=group_key)
+            if not marker_key in entities:
+                entities[marker_key] = (DirtyTask.get(marker_key) or
+                                        DirtyTask(key=marker_key,
+                                                  full=False,
+                                                  delta=_empty_delta()))
+            marker = entities[marker_key]
+            if delta is None or marker.full:
+                marker.full = True
+                marker.delta = None
+            else:
+                marker.delta = _merge_deltas(marker.delta, delta)
+            marker.put()
+            queued = ('queued', group_key)
+            if queued in entities:
+                return
+            state = _get_propagation_state(group_key)
+            timeout = datetime.timedelta(seconds=PROPAGATION_TIMEOUT)
+            if (state.pending and state.time and
+                datetime.datetime.now() - state.time < timeout):
+                return
+            state.pending = True
+            caching.put(state)
+            PropagateTaskCompletion.enqueue(group_key, transactional=True)
+            entities[queued] = True
+
+        if db.is_in_transaction():
+            txn()
+        else:
+            db.run_in_transaction(txn)
+
+    @staticmethod
+    def enqueue(group_key, transactional=False, countdown=PROPAGATION_DELAY):
+        """
+        Queues a new propagation worker for an entity group of a
+        domain. The worker is delayed by PROPAGATION_DELAY seconds, or
+        by |countdown| seconds.
+
+        Args:
+            group_key: The key of the Domain or DomainShard that is the
+                root of the entity group.
+            transactional: If set to true, then the task will be added
+                as a transactional task.
+            countdown: The delay of the worker in seconds.
+
+        Raises:
+            ValueError: If transactional is set to True and the
+                 function is not called as part of a transaction.
+        """
+        shard = DomainShard.shard_from_key(group_key)
+        _queue_worker('/workers/propagate-task-completion',
+                      { 'domain': Domain.identifier_from_group_key(group_key),
+                        'shard': '' if shard is None else str(shard) },
+                      transactional=transactional,
+                      countdown=countdown)
+
+
+def _fetch_ancestor_chains(domain_identifier, task_identifiers):
+    """
+    Fetches the tasks with the given identifiers, together with all
+    their ancestor tasks. The ancestors are fetched in a single batch
+    get using the hierarchies stored in the TaskIndexes. Where those
+    are not up to date, the hierarchy is traversed upwards one level
+    at a time, with a single batch get per level. Each shared
+    ancestor is only fetched once.
+
+    Returns:
+        A dictionary from task key to Task instance.
+    """
+    tasks = {}
+    task_keys = [Task.key_from_identifier(domain_identifier, identifier)
+                 for identifier in task_identifiers]
+    # Prefetch all ancestors that are listed in the indexes of the
+    # tasks. Ancestors that are missing because an index is not up
+    # to date are fetched by the traversal below.
+    ancestor_identifiers = set()
+    for index in TaskIndex.get([TaskIndex.key_from_task_key(key)
+                                for key in task_keys]):
+        if index:
+            ancestor_identifiers.update(index.hierarchy)
+    keys = set(task_keys)
+    keys.update(Task.key_from_identifier(domain_identifier, identifier)
+                for identifier in ancestor_identifiers)
+    while keys:
+        fetched = Task.get(list(keys))
+        keys = set()
+        for task in fetched:
+            if not task:
+                continue
+            tasks[task.key()] = task
+            parent_key = task.parent_task_key()
+            if parent_key and not parent_key in tasks:
+                keys.add(parent_key)
+    return tasks
+
+
+def _bottom_up(tasks):
+    """
+    Returns the tasks of the dictionary, as returned by
+    _fetch_ancestor_chains(), ordered such that every task appears
+    before its parent task.
+    """
+    depths = {}
+    for key in tasks:
+        chain = []
+        while key in tasks and not key in depths:
+            chain.append(key)
+            key = tasks[key].parent_task_key()
+        depth = depths.get(key, -1)
+        for chain_key in reversed(chain):
+            depth += 1
+            depths[chain_key] = depth
+    return sorted(tasks.itervalues(), key=lambda task: -depths[task.key()])
+
+
+def _propagate_dirty_tasks(group_key, start_times=None):
+    """
+    Recomputes the derived properties of all dirty tasks of an entity
+    group and their ancestors, and deletes the dirty markers. Must be
+    run in a transaction.
+
+    At most MAX_DIRTY_TASKS_PER_RUN markers are handled, to keep the
+    transaction short. If not all dirty markers can be handled in this
+    run, the next run is queued without delay in the same transaction,
+    and the propagation of the group stays pending until then.
+
+    The records of the updated tasks in the task tree snapshot of the
+    group are updated as well. If the group does not have a snapshot,
+    it must be built afterwards by _build_task_tree_snapshot().
+
+    As the datastore does not reflect writes in a transaction to later
+    reads in that same transaction, the recomputed tasks are kept in
+    memory and substituted for the subtasks that are fetched.
+
+    Args:
+        group_key: The key of the Domain or DomainShard that is the
+            root of the entity group.
+        start_times: Optional list, which is set to the times of the
+            first mutation of each handled marker.
+
+    Returns:
+        True if the entity group does not have a task tree snapshot.
+    """
+    domain_identifier = Domain.identifier_from_group_key(group_key)
+    state = _get_propagation_state(group_key)
+    snapshot = TaskTreeSnapshot.get(
+        TaskTreeSnapshot.key_from_group_key(group_key))
+    markers = DirtyTask.all().\
+        ancestor(group_key).\
+        fetch(MAX_DIRTY_TASKS_PER_RUN + 1)
+    remaining = len(markers) > MAX_DIRTY_TASKS_PER_RUN
+    markers = markers[:MAX_DIRTY_TASKS_PER_RUN]
+    if remaining:
+        PropagateTaskCompletion.enqueue(group_key, transactional=True,
+                                        countdown=0)
+    # The state is stored even if it is already pending, so the
+    # timeout of mark_dirty() starts again.
+    changed = remaining or state.pending
+    state.pending = remaining
+    if start_times is not None:
+        # The transaction can be retried, so the list is replaced.
+        start_times[:] = [marker.created or marker.time
+                          for marker in markers]
+    if not markers:
+        if changed:
+            caching.put(state)
+        return not snapshot
+
+    tasks = _fetch_ancestor_chains(domain_identifier,
+                                   [marker.key().name()
+                                    for marker in markers])
+    # Every task on the ancestor chains also consumes its own marker,
+    # if it has one that was not fetched in this run.
+    marker_keys = set(marker.key() for marker in markers)
+    extra_keys = [db.Key.from_path('DirtyTask', str(key.id_or_name()),
+                                   parent=group_key)
+                  for key in tasks]
+    extra_keys = [key for key in extra_keys if not key in marker_keys]
+
+    markers.extend(DirtyTask.get(extra_keys))
+    markers = [marker for marker in markers if marker]
+
+    # The tasks on the ancestor chains of fully recomputed tasks are
+    # recomputed as well. The deltas of the other markers are summed
+    # per ancestor, up to the first ancestor that is recomputed.
+    full = set()
+    for marker in markers:
+        if marker.full:
+            key = Task.key_from_identifier(domain_identifier,
+                                           marker.key().name())
+            while key in tasks and not key in full:
+                full.add(key)
+                key = tasks[key].parent_task_key()
+    deltas = {}
+    for marker in markers:
+        if marker.full or marker.delta == _empty_delta():
+            continue
+        key = Task.key_from_identifier(domain_identifier,
+                                       marker.key().name())
+        key = tasks[key].parent_task_key() if key in tasks else None
+        while key in tasks and not key in full:
+            deltas[key] = _merge_deltas(deltas.get(key, _empty_delta()),
+                                        marker.delta)
+            key = tasks[key].parent_task_key()
+
+    ordered = [task for task in _bottom_up(tasks)
+               if task.key() in full or task.key() in deltas]
+    index_keys = [TaskIndex.key_from_task_key(task.key()) for task in ordered]
+    indexes = TaskIndex.get(index_keys)
+    updated = {}
+    entities = []
+    inbox_tasks = []
+    for task, index_key, index in zip(ordered, index_keys, indexes):
+        if not index:
+            index = _new_task_index(task)
+        atomic = index.atomic if index.is_saved() else None
+        if (task.key() in full or
+            not _apply_delta(task, index, deltas[task.key()])):
+            subtasks = Task.all().\
+                ancestor(group_key).\
+                filter('parent_task =', task.key())
+            subtasks = [updated.get(subtask.key(), subtask)
+                        for subtask in subtasks]
+            _compute_derived_properties(task, index, subtasks)
+        updated[task.key()] = task
+        entities.extend([task, index])
+        if task.assignee_key() and index.atomic != atomic:
+            inbox_tasks.append(task.identifier())
+    update_domain_statistics(ordered)
+    caching.put(entities)
+    db.delete([marker.key() for marker in markers])
+    # Only atomic tasks are listed in the inbox of their assignee.
+    if inbox_tasks:
+        UpdateInbox.enqueue(domain_identifier, inbox_tasks,
+                            transactional=True)
+
+    # Update the records of all the tasks that were fetched in this
+    # run, which includes the tasks of all markers.
+    if snapshot:
+        snapshot.update_tasks([updated.get(task.key(), task)
+                               for task in tasks.itervalues()])
+        snapshot.remove_tasks(
+            [marker.key().name() for marker in markers
+             if not Task.key_from_identifier(domain_identifier,
+                                             marker.key().name()) in tasks])
+    _put_task_tree_snapshot(snapshot, state)
+    return not snapshot
+
+
+def request_task_tree_snapshot(group_key):
+    """
+    Queues a propagation worker to build the task tree snapshot of an
+    entity group that does not have a snapshot yet. Repeated requests
+    for the same group are ignored for a while.
+
+    Args:
+        group_key: The key of the Domain or DomainShard that is the
+            root of the entity group.
+    """
+    if memcache.add(_SNAPSHOT_REQUEST_KEY % group_key, True,
+                    time=SNAPSHOT_REQUEST_TIME):
+        PropagateTaskCompletion.enqueue(group_key)
+
+
+def update_task_tree_snapshot(group_key, tasks=[], removed=[]):
+    """
+    Updates the records of the given tasks in the task tree snapshot
+    of an entity group, if it has one. The snapshot revision of the
+    group is increased in either case, so a snapshot that is being
+    built is not stored. Must be run in a transaction on the entity
+    group.
+
+    Args:
+        group_key: The key of the Domain or DomainShard that is the
+            root of the entity group.
+        tasks: A list of Task instances that have been changed.
+        removed: A list of identifiers of tasks that no longer exist
+            in the entity group.
+    """
+    state = _get_propagation_state(group_key)
+    snapshot = TaskTreeSnapshot.get(
+        TaskTreeSnapshot.key_from_group_key(group_key))
+    if snapshot:
+        snapshot.update_tasks(tasks)
+        snapshot.remove_tasks(removed)
+    _put_task_tree_snapshot(snapshot, state)
+
+
+def discard_task_tree_snapshot(group_key):
+    """
+    Deletes the task tree snapshot of an entity group, so that it is
+    built again from the stored tasks after the next propagation run.
+    Used before tasks are stored outside a transaction, see
+    api.import_tasks(). The snapshot revision of the group is
+    increased, so a snapshot that is being built is not stored. Must
+    be run in a transaction on the entity group.
+
+    Args:
+        group_key: The key of the Domain or DomainShard that is the
+            root of the entity group.
+    """
+    state = _get_propagation_state(group_key)
+    snapshot_key = TaskTreeSnapshot.key_from_group_key(group_key)
+    db.delete(snapshot_key)
+    caching.invalidate(snapshot_key)
+    _put_task_tree_snapshot(None, state)
+
+
+def _build_task_tree_snapshot(group_key):
+    """
+    Builds and stores a new TaskTreeSnapshot for an entity group that
+    does not have one yet, from all its tasks.
+
+    The tasks are read outside a transaction. The snapshot is only
+    stored if the snapshot revision of the group has not changed in
+    the meantime, see PropagationState.snapshot_revision. Otherwise
+    it is built again after the next propagation run.
+
+    Args:
+        group_key: The key of the Domain or DomainShard that is the
+            root of the entity group.
+    """
+    if memcache.get(_SNAPSHOT_TOO_LARGE_KEY % group_key):
+        return
+    state_key = PropagationState.key_from_group_key(group_key)
+    state = PropagationState.get(state_key)
+    revision = state.snapshot_revision if state else 0
+    snapshot = TaskTreeSnapshot(
+        parent=group_key,
+        key_name=TaskTreeSnapshot.KEY_NAME)
+    snapshot.update_tasks(Task.all().
+                          ancestor(group_key).
+                          run(batch_size=SNAPSHOT_BATCH_SIZE))
+    if _task_tree_snapshot_too_large(snapshot):
+        return
+
+    def txn():
+        state = PropagationState.get(state_key)
+        if (state.snapshot_revision if state else 0) != revision:
+            return
+        if TaskTreeSnapshot.get(snapshot.key()):
+            return
+        if not state:
+            state = PropagationState(parent=group_key,
+                                     key_name=PropagationState.KEY_NAME)
+        _put_task_tree_snapshot(snapshot, state)
+    db.run_in_transaction(txn)
+
+
+def _task_tree_snapshot_too_large(snapshot):
+    """
+    Encodes the snapshot, and returns true if it has become too large
+    to be stored in a single entity. In that case no new snapshot is
+    built for the entity group for a while.
+    """
+    snapshot.encode()
+    # The compressed size is only computed if it might be too large.
+    if (len(snapshot.data) > MAX_SNAPSHOT_SIZE and
+        len(zlib.compress(snapshot.data)) > MAX_SNAPSHOT_SIZE):
+        logging.warning("Task tree of '%s' is too large for a snapshot",
+                        snapshot.parent_key())
+        # Prevent new requests for a snapshot for a while.
+        for key in [_SNAPSHOT_REQUEST_KEY, _SNAPSHOT_TOO_LARGE_KEY]:
+            memcache.set(key % snapshot.parent_key(), True,
+                         time=SNAPSHOT_RETRY_TIME)
+        return True
+    return False
+
+
+def _put_task_tree_snapshot(snapshot, state):
+    """
+    Stores the task tree snapshot of an entity group together with
+    its PropagationState, of which the snapshot revision is increased.
+    If the snapshot has become too large to be stored in a single
+    entity, it is deleted instead, and the handlers fall back to
+    querying the datastore. Must be run in a transaction on the
+    entity group.
+
+    Args:
+        snapshot: The TaskTreeSnapshot of the group, or None if the
+            group does not have one.
+        state: The PropagationState of the group.
+    """
+    state.snapshot_revision += 1
+    if snapshot and _task_tree_snapshot_too_large(snapshot):
+        if snapshot.is_saved():
+            db.delete(snapshot)
+            caching.invalidate(snapshot.key())
+        snapshot = None
+    caching.put([state, snapshot] if snapshot else state)
+
+
+def _rewrite_subtree_hierarchy(task):
+    """
+    Updates the hierarchy and level of all the descendants of |task|,
+    after the hierarchy of |task| itself has been updated. The
+    hierarchy of every descendant starts with the hierarchy of |task|,
+    so this prefix is replaced by the new hierarchy of |task|.
+
+    The descendants are found through their TaskIndexes, and updated
+    in transactions of HIERARCHY_BATCH_SIZE tasks on the entity group
+    of |task|. Descendants that do not have a TaskIndex yet are
+    updated by the worker that was queued when they were created.
+
+    Args:
+        task: An instance of the Task model, whose TaskIndex is up
+            to date.
+    """
+    task_identifier = task.identifier()
+    index_key = TaskIndex.key_from_task_key(task.key())
+
+    def txn(index_keys):
+        index = db.get(index_key)
+        subtask_indexes = db.get(index_keys)
+        subtasks = db.get([key.parent() for key in index_keys])
+        entities = []
+        for subtask, subtask_index in zip(subtasks, subtask_indexes):
+            if (not subtask or not subtask_index or
+                not task_identifier in subtask_index.hierarchy):
+                continue        # Moved or removed in the meantime
+            position = subtask_index.hierarchy.index(task_identifier)
+            hierarchy = index.hierarchy + subtask_index.hierarchy[position:]
+            if (hierarchy == subtask_index.hierarchy and
+                subtask.derived_level == len(hierarchy)):
+                continue
+            subtask_index.hierarchy = hierarchy
+            _update_index_order(subtask, subtask_index)
+            subtask.derived_level = len(hierarchy)
+            subtask.version += 1
+            entities.extend([subtask_index, subtask])
+        caching.put(entities)
+
+    # The query is repeated to find the indexes that were created
+    # while the subtree was updated.
+    done = set()
+    while True:
+        query = TaskIndex.all(keys_only=True).\
+            ancestor(task.group_key()).\
+            filter('hierarchy =', task_identifier)
+        keys = [key for key in query if not key in done]
+        if not keys:
+            break
+        for start in range(0, len(keys), HIERARCHY_BATCH_SIZE):
+            db.run_in_transaction(txn,
+                                  keys[start:start + HIERARCHY_BATCH_SIZE])
+        done.update(keys)
 
 
 class UpdateTaskHierarchy(webapp.RequestHandler):
@@ -175,14 +1319,19 @@ class UpdateTaskHierarchy(webapp.RequestHandler):
     downwards in the entire tree.
 
     This post request takes two arguments, a domain and a task identifier.
-    The update touches all the tasks in the hierarchy.
+    The update touches all the tasks in the hierarchy. By default, a
+    worker is queued for each subtask. If the optional argument
+    'subtree' is set, the hierarchy of all the descendants is
+    rewritten by this worker instead, which requires that the
+    descendants have a TaskIndex.
 
     This operation is idempotent.
     """
+    @_timed('update-task-hierarchy')
     def post(self):
         domain_identifier = self.request.get('domain')
-        domain_key = Domain.key_from_name(domain_identifier)
         task_identifier = self.request.get('task')
+        subtree = bool(self.request.get('subtree'))
 
         def txn():
             task = api.get_task(domain_identifier, task_identifier)
@@ -190,15 +1339,23 @@ class UpdateTaskHierarchy(webapp.RequestHandler):
                 logging.error("Task '%s/%s' does not exist",
                               domain_identifier, task_identifier)
                 return None
-            parent_task = api.get_task(domain_identifier,
-                                       task.parent_task_identifier())
+            # Fetch the index of the task together with the parent
+            # task and its index in a single batch get.
+            index_key = TaskIndex.key_from_task_key(task.key())
+            parent_key = task.parent_task_key()
+            if parent_key:
+                index, parent_task, parent_index = db.get(
+                    [index_key,
+                     parent_key,
+                     TaskIndex.key_from_task_key(parent_key)])
+            else:
+                index = TaskIndex.get(index_key)
+                parent_task = None
             if parent_task:
-                parent_index = TaskIndex.get_by_key_name(
-                    parent_task.identifier(),
-                    parent=parent_task.key())
                 if not parent_index:
                     logging.error("Missing index for parent task '%s/%s'",
-                                  domain_identifier, parent_identifier)
+                                  domain_identifier,
+                                  parent_task.identifier())
                     self.error(400) # Retry later
                     return None
                 hierarchy = list(parent_index.hierarchy)
@@ -207,18 +1364,27 @@ class UpdateTaskHierarchy(webapp.RequestHandler):
             else:               # root task
                 hierarchy = []
                 level = 0
-            index = TaskIndex.get_by_key_name(task_identifier, parent=task)
             if not index:
                 index = TaskIndex(parent=task, key_name=task_identifier)
             index.hierarchy = hierarchy
-            index.put()
+            _update_index_order(task, index)
             task.derived_level = level
-            task.put()
+            task.version += 1
+            caching.put([index, task])
             return task
 
         task = db.run_in_transaction(txn)
         if not task:
             return
+        if subtree:
+            _rewrite_subtree_hierarchy(task)
+            api.increment_modification_counter(domain_identifier)
+            UpdateInbox.enqueue(domain_identifier, [task_identifier],
+                                subtree=True)
+            return
+        api.increment_modification_counter(domain_identifier)
+        if task.atomic():
+            UpdateInbox.enqueue(domain_identifier, [task_identifier])
 
         # Spawn new tasks to propagate downwards. This is done outside
         # the transaction, as only 5 transactional tasks can be
@@ -226,15 +1392,16 @@ class UpdateTaskHierarchy(webapp.RequestHandler):
         # transaction, as this task is then retried, so the
         # propagation will always proceeed.
         query = Task.all(keys_only=True).\
-            ancestor(Domain.key_from_name(domain_identifier)).\
+            ancestor(task.group_key()).\
             filter('parent_task =', task.key())
-        for subtask_key in query:
-            subtask_identifier = subtask_key.id_or_name()
-            # TODO(tijmen): Batch queue tasks
-            UpdateTaskHierarchy.enqueue(domain_identifier, subtask_identifier)
+        _queue_workers('/workers/update-task-hierarchy',
+                       [{ 'task': subtask_key.id_or_name(),
+                          'domain': domain_identifier }
+                        for subtask_key in query])
 
     @staticmethod
-    def enqueue(domain_identifier, task_identifier, transactional=False):
+    def enqueue(domain_identifier, task_identifier, transactional=False,
+                subtree=False):
         """
         Queues a new worker to update the task hierarchy of the task
         with the given identifier.
@@ -244,28 +1411,508 @@ class UpdateTaskHierarchy(webapp.RequestHandler):
             task_identifier: The task identifier string
             transactional: If set to true, then the task will be added
                 as a transactional task.
+            subtree: If set to true, the worker rewrites the hierarchy
+                of all the descendants of the task itself, instead of
+                queueing a worker for each subtask. Used after a move,
+                when all descendants have a TaskIndex.
 
         Raises:
             ValueError: If transactional is set to True and the
                  function is not called as part of a transaction.
         """
-        if transactional and not db.is_in_transaction():
-            raise ValueError("Adding a transactional worker requires a"
-                             " transaction")
+        params = { 'task': task_identifier,
+                   'domain': domain_identifier }
+        if subtree:
+            params['subtree'] = 1
+        _queue_worker('/workers/update-task-hierarchy',
+                      params,
+                      transactional=transactional)
+
+
+def _record_search_terms(tasks, terms):
+    """
+    Records the terms under which |tasks| have been indexed in their
+    TaskSearchTerms. Must be run in a transaction on the entity group
+    of the tasks.
+
+    If the description of a task has changed since its terms were
+    indexed, the indexed terms are added to the recorded terms, so
+    they are removed by the worker of the new description.
+
+    Args:
+        tasks: A list of Task instances, as they were indexed.
+        terms: A list with the set of indexed terms of each task.
+
+    Returns:
+        True if the descriptions of all tasks are unchanged.
+    """
+    keys = [task.key() for task in tasks]
+    record_keys = [TaskSearchTerms.key_from_task_key(key) for key in keys]
+    fetched = db.get(keys + record_keys)
+    unchanged = True
+    records = []
+    for task, current, record, task_terms in zip(tasks,
+                                                 fetched[:len(keys)],
+                                                 fetched[len(keys):],
+                                                 terms):
+        if not current:
+            continue
+        if not record:
+            record = TaskSearchTerms(parent=current,
+                                     key_name=TaskSearchTerms.KEY_NAME)
+        if current.description != task.description:
+            unchanged = False
+            task_terms = task_terms | set(record.terms)
+        if set(record.terms) != task_terms:
+            record.terms = sorted(task_terms)
+            records.append(record)
+    db.put(records)
+    return unchanged
+
 
-        queue = taskqueue.Queue('update-task-hierarchy')
-        task = taskqueue.Task(url='/workers/update-task-hierarchy',
-                              params={ 'task': task_identifier,
-                                       'domain': domain_identifier })
+class UpdateSearchIndex(webapp.RequestHandler):
+    """
+    Updates the search index of the task descriptions, see search.py.
+
+    This post request takes a domain and a comma separated list of
+    task identifiers. The terms of the current description of each
+    task are added to the index, and the terms that are recorded in
+    the TaskSearchTerms of the task but are no longer in the
+    description are removed from the index. The indexed terms are
+    then recorded. If a description has changed in the meantime, the
+    worker fails, so it is retried with the new description.
+
+    This operation is idempotent.
+    """
+    @_timed('update-search-index')
+    def post(self):
+        domain_identifier = self.request.get('domain')
+        identifiers = [identifier for identifier
+                       in self.request.get('tasks').split(',') if identifier]
+        keys = [Task.key_from_identifier(domain_identifier, identifier)
+                for identifier in identifiers]
+        fetched = db.get(keys + [TaskSearchTerms.key_from_task_key(key)
+                                 for key in keys])
+        tasks = fetched[:len(keys)]
+        records = fetched[len(keys):]
+
+        added = {}
+        removed = {}
+        indexed = {}
+        for identifier, task, record in zip(identifiers, tasks, records):
+            terms = search.tokenize(task.description) if task else set()
+            for term in terms:
+                added.setdefault(term, set()).add(identifier)
+            old_terms = set(record.terms) if record else set()
+            for term in old_terms - terms:
+                removed.setdefault(term, set()).add(identifier)
+            if task:
+                indexed.setdefault(task.group_key(), []).append((task, terms))
+        search.update_postings(domain_identifier, added, removed)
+        # Search results that were served before are outdated.
+        api.increment_modification_counter(domain_identifier)
+
+        unchanged = True
+        for pairs in indexed.itervalues():
+            unchanged &= db.run_in_transaction(_record_search_terms,
+                                               [task for task, terms in pairs],
+                                               [terms for task, terms in pairs])
+        if not unchanged:
+            logging.info("Descriptions changed while they were indexed")
+            self.error(400) # Retry with the new descriptions
+
+    @staticmethod
+    def enqueue(domain_identifier, task_identifiers, transactional=False):
+        """
+        Queues a new worker to update the search index of the tasks
+        with the given identifiers.
+
+        Args:
+            domain_identifier: The domain identifier string
+            task_identifiers: A list of task identifier strings
+            transactional: If set to true, then the task will be added
+                as a transactional task.
+
+        Raises:
+            ValueError: If transactional is set to True and the
+                 function is not called as part of a transaction.
+        """
+        _queue_worker('/workers/update-search-index',
+                      { 'tasks': ','.join(task_identifiers),
+                        'domain': domain_identifier },
+                      transactional=transactional,
+                      queue_name=SEARCH_QUEUE)
+
+    @staticmethod
+    def enqueue_new_tasks(domain_identifier, task_identifiers):
+        """
+        Queues workers that add new tasks to the search index, one
+        for every TASK_BATCH_SIZE tasks. The workers are not
+        transactional.
+
+        Args:
+            domain_identifier: The domain identifier string
+            task_identifiers: A list of task identifier strings
+        """
+        _queue_task_batches('/workers/update-search-index',
+                            domain_identifier,
+                            task_identifiers,
+                            queue_name=SEARCH_QUEUE)
+
+
+def _update_inbox(user_identifier, domain_identifier, removed, records):
+    """
+    Replaces tasks in the inbox of a user. Must be run in a
+    transaction.
+
+    Args:
+        user_identifier: The user identifier of the owner of the inbox
+        domain_identifier: The domain identifier of the tasks
+        removed: A set with the identifiers of the tasks that are
+            removed from the inbox.
+        records: A list of the inbox records of the tasks that are
+            added to the inbox, see Inbox.tasks.
+    """
+    key = Inbox.key_from_user_identifier(user_identifier)
+    inbox = db.get(key)
+    if not inbox:
+        if not records:
+            return
+        inbox = Inbox(key=key)
+    tasks = [record for record in inbox.tasks
+             if not (record['domain'] == domain_identifier and
+                     record['id'] in removed)]
+    tasks.extend(records)
+    tasks.sort(key=lambda record: (record['domain'], record['sort_key']))
+    if len(tasks) > Inbox.MAX_TASKS:
+        inbox.truncated = True
+        tasks = tasks[:Inbox.MAX_TASKS]
+    if tasks == inbox.tasks:
+        return
+    inbox.tasks = tasks
+    caching.put(inbox)
+
+
+class UpdateInbox(webapp.RequestHandler):
+    """
+    Updates the inboxes of the assignees of tasks, see Inbox.
+
+    This post request takes a domain and a comma separated list of
+    task identifiers. The records of the tasks are replaced in the
+    inbox of their assignee, and removed if the task is completed or
+    has subtasks. The optional arguments are:
+      old_assignee: The previous assignee of the tasks, from whose
+          inbox the tasks are removed.
+      subtree: If set, workers are queued that update the records of
+          all the uncompleted atomic descendants of the tasks, after
+          their ancestor paths have changed.
+
+    Whether a task is atomic is read from its TaskIndex. When that
+    changes, the propagation queues this worker for the task again.
+
+    This operation is idempotent.
+    """
+    @_timed('update-inbox')
+    def post(self):
+        domain_identifier = self.request.get('domain')
+        identifiers = [identifier for identifier
+                       in self.request.get('tasks').split(',') if identifier]
+        old_assignee = self.request.get('old_assignee') or None
+
+        keys = [Task.key_from_identifier(domain_identifier, identifier)
+                for identifier in identifiers]
+        if self.request.get('subtree'):
+            descendants = []
+            for key, identifier in zip(keys, identifiers):
+                query = TaskIndex.all(keys_only=True).\
+                    ancestor(key.parent()).\
+                    filter('hierarchy =', identifier).\
+                    filter('atomic =', True).\
+                    filter('completed =', False)
+                descendants.extend(index_key.name() for index_key in query)
+            _queue_task_batches('/workers/update-inbox',
+                                domain_identifier,
+                                sorted(set(descendants) - set(identifiers)))
+        fetched = db.get(keys + [TaskIndex.key_from_task_key(key)
+                                 for key in keys])
+        tasks = fetched[:len(keys)]
+        indexes = fetched[len(keys):]
+
+        removed = {}
+        assigned = {}
+        for task, index in zip(tasks, indexes):
+            if not task:
+                continue
+            identifier = task.identifier()
+            assignee = task.assignee_identifier()
+            for user_identifier in (assignee, old_assignee):
+                if user_identifier:
+                    removed.setdefault(user_identifier, set()).add(identifier)
+            if not assignee:
+                continue
+            if index and index.atomic and not task.completed:
+                assigned.setdefault(assignee, []).append((task, index))
+
+        # The titles of the ancestors are fetched in a single batch.
+        ancestor_identifiers = set()
+        for pairs in assigned.itervalues():
+            for task, index in pairs:
+                ancestor_identifiers.update(index.hierarchy)
+        ancestor_identifiers = list(ancestor_identifiers)
+        ancestors = caching.get([Task.key_from_identifier(domain_identifier,
+                                                          identifier)
+                                 for identifier in ancestor_identifiers])
+        titles = dict((identifier, ancestor.title())
+                      for identifier, ancestor in zip(ancestor_identifiers,
+                                                      ancestors)
+                      if ancestor)
+
+        for user_identifier in set(removed) | set(assigned):
+            records = [{ 'domain': domain_identifier,
+                         'id': task.identifier(),
+                         'title': task.title(),
+                         'path': [{ 'id': identifier,
+                                    'title': titles.get(identifier, '') }
+                                  for identifier in index.hierarchy],
+                         'sort_key': TaskIndex.sort_key_for(False, task.time) }
+                       for task, index in assigned.get(user_identifier, [])]
+            db.run_in_transaction(_update_inbox,
+                                  user_identifier,
+                                  domain_identifier,
+                                  removed.get(user_identifier, set()),
+                                  records)
+
+    @staticmethod
+    def enqueue_new_tasks(domain_identifier, task_identifiers):
+        """
+        Queues workers that add new tasks to the inboxes of their
+        assignees, one for every TASK_BATCH_SIZE tasks. The workers
+        are not transactional.
+
+        Args:
+            domain_identifier: The domain identifier string
+            task_identifiers: A list of task identifier strings
+        """
+        _queue_task_batches('/workers/update-inbox',
+                            domain_identifier,
+                            task_identifiers)
+
+    @staticmethod
+    def enqueue(domain_identifier, task_identifiers, old_assignee=None,
+                subtree=False, transactional=False):
+        """
+        Queues a new worker to update the inbox records of the tasks
+        with the given identifiers.
+
+        Args:
+            domain_identifier: The domain identifier string
+            task_identifiers: A list of task identifier strings
+            old_assignee: The identifier of the previous assignee of
+                the tasks, after a new assignment.
+            subtree: If set to true, the records of the descendants of
+                the tasks are updated as well.
+            transactional: If set to true, then the task will be added
+                as a transactional task.
+
+        Raises:
+            ValueError: If transactional is set to True and the
+                 function is not called as part of a transaction.
+        """
+        params = { 'tasks': ','.join(task_identifiers),
+                   'domain': domain_identifier }
+        if old_assignee:
+            params['old_assignee'] = old_assignee
+        if subtree:
+            params['subtree'] = 1
+        _queue_worker('/workers/update-inbox',
+                      params,
+                      transactional=transactional)
+
+
+def _order_task_indexes(index_keys):
+    """
+    Updates the properties that order the task lists in the TaskIndexes
+    with the given keys, see _update_index_order(). Only the indexes
+    that change are stored. Must be run in a transaction on their
+    entity group.
+    """
+    fetched = db.get(index_keys + [key.parent() for key in index_keys])
+    indexes = fetched[:len(index_keys)]
+    tasks = fetched[len(index_keys):]
+    changed = []
+    for task, index in zip(tasks, indexes):
+        if not task or not index:
+            continue
+        order = (index.sort_key, index.active_assignees,
+                 index.inactive_assignees)
+        _update_index_order(task, index)
+        if order != (index.sort_key, index.active_assignees,
+                     index.inactive_assignees):
+            changed.append(index)
+    caching.put(changed)
+
+
+class OrderTaskIndexes(webapp.RequestHandler):
+    """
+    Backfills the properties that order the task lists, see
+    TaskIndex.sort_key, in the TaskIndexes of a domain that were
+    stored before these properties existed. Until the backfill has
+    finished, see Domain.ordered_indexes, the task lists of the domain
+    are not ordered.
+
+    The indexes of the entity groups of the domain are updated one
+    group after the other, in transactions of HIERARCHY_BATCH_SIZE
+    indexes. Each worker handles a single batch and queues the worker
+    of the next batch. The last worker sets Domain.ordered_indexes.
+
+    This post request takes the domain identifier, and optionally the
+    position of the entity group in Domain.group_keys() and the
+    datastore cursor of the next batch in that group.
+
+    This operation is idempotent.
+    """
+    @_timed('order-task-indexes')
+    def post(self):
+        domain_identifier = self.request.get('domain')
+        group = int(self.request.get('group') or 0)
+        domain = api.get_domain(domain_identifier, use_cache=False)
+        if not domain or domain.ordered_indexes:
+            return
+        group_keys = domain.group_keys()
+        query = TaskIndex.all(keys_only=True).ancestor(group_keys[group])
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(HIERARCHY_BATCH_SIZE)
+        if keys:
+            db.run_in_transaction(_order_task_indexes, keys)
+        if len(keys) == HIERARCHY_BATCH_SIZE:
+            OrderTaskIndexes.enqueue(domain_identifier, group,
+                                     query.cursor())
+            return
+        if group + 1 < len(group_keys):
+            OrderTaskIndexes.enqueue(domain_identifier, group + 1)
+            return
+
+        def txn():
+            domain = Domain.get(Domain.key_from_name(domain_identifier))
+            domain.ordered_indexes = True
+            caching.put(domain)
+        db.run_in_transaction(txn)
+        logging.info("TaskIndexes of '%s' are ordered", domain_identifier)
+        api.increment_modification_counter(domain_identifier)
+
+    @staticmethod
+    def enqueue(domain_identifier, group=0, cursor=None):
+        """
+        Queues a new worker to backfill the order of a batch of the
+        TaskIndexes of a domain.
+
+        Args:
+            domain_identifier: The domain identifier string
+            group: The position of the entity group in
+                Domain.group_keys().
+            cursor: The datastore cursor of the batch in the entity
+                group, or None for the first batch.
+        """
+        params = { 'domain': domain_identifier,
+                   'group': str(group) }
+        if cursor:
+            params['cursor'] = cursor
+        _queue_worker('/workers/order-task-indexes', params)
+
+
+def request_index_order(domain_identifier):
+    """
+    Queues a worker to backfill the order of the TaskIndexes of a
+    domain, see OrderTaskIndexes. Repeated requests for the same
+    domain are ignored for a while.
+
+    Args:
+        domain_identifier: The domain identifier string
+    """
+    if memcache.add(_ORDER_REQUEST_KEY % domain_identifier, True,
+                    time=ORDER_REQUEST_TIME):
+        OrderTaskIndexes.enqueue(domain_identifier)
+
+
+def _percentile(values, fraction):
+    """
+    Returns the value below which the given fraction of the |values|
+    lies, or None if there are no values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _metric_summary(name, samples):
+    return { 'name': name,
+             'count': len(samples),
+             'p50': _percentile(samples, 0.5),
+             'p95': _percentile(samples, 0.95),
+             'max': max(samples) if samples else None }
+
+
+class WorkerStatus(webapp.RequestHandler):
+    """
+    Admin page with the propagation lag per domain, the run durations
+    of the workers and the statistics of the update-task-hierarchy
+    queue. The lag of a change is the time between the mutation and
+    the update of its root task. The metrics are computed over the
+    latest METRIC_SAMPLE_COUNT samples.
+    """
+    def get(self):
+        domains = sorted(key.name()
+                         for key in Domain.all(keys_only=True))
+        lags = [_metric_summary(domain, samples)
+                for domain, samples
+                in zip(domains,
+                       get_samples(['lag:%s' % domain
+                                    for domain in domains]))
+                if samples]
+        names = ['update-task-completion',
+                 'propagate-task-completion',
+                 'update-task-hierarchy',
+                 'update-search-index',
+                 'update-inbox',
+                 'order-task-indexes']
+        durations = [_metric_summary(name, samples)
+                     for name, samples
+                     in zip(names,
+                            get_samples(['duration:%s' % name
+                                         for name in names]))]
+        queue = None
         try:
-            queue.add(task, transactional=transactional)
-        except taskqueue.TransientError:
-            queue.add(task, transactional=transactional)
+            statistics = taskqueue.Queue(
+                'update-task-hierarchy').fetch_statistics()
+            queue = { 'tasks': statistics.tasks,
+                      'in_flight': statistics.in_flight,
+                      'executed_last_minute': statistics.executed_last_minute,
+                      'oldest_eta': None }
+            if statistics.oldest_eta_usec:
+                queue['oldest_eta'] = datetime.datetime.utcfromtimestamp(
+                    statistics.oldest_eta_usec / 1e6)
+        except taskqueue.Error:
+            logging.exception("Could not fetch the queue statistics")
+        self.response.write(jinja2.get_jinja2(app=self.app).render_template(
+                'worker-status.html',
+                coalesce=COALESCE_PROPAGATION,
+                propagation_delay=PROPAGATION_DELAY,
+                lags=lags,
+                durations=durations,
+                queue=queue))
 
 
 mapping = [
+    ('/workers/status', WorkerStatus),
     ('/workers/update-task-hierarchy', UpdateTaskHierarchy),
-    ('/workers/update-task-completion', UpdateTaskCompletion)
+    ('/workers/update-search-index', UpdateSearchIndex),
+    ('/workers/update-inbox', UpdateInbox),
+    ('/workers/order-task-indexes', OrderTaskIndexes),
+    ('/workers/update-task-completion', UpdateTaskCompletion),
+    ('/workers/propagate-task-completion', PropagateTaskCompletion)
     ]
 
 application = webapp.WSGIApplication(mapping)